@@ -1,22 +1,515 @@
 """Dummy webserver doing handouts of lunar elevation squares"""
 
-from os import path
+import io
+import os
+import time
+import numpy as np
 from flask import Flask
-from flask import request, send_file
+from flask import request, send_file, jsonify, g
+from werkzeug.wsgi import ClosingIterator
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
 from moon import io as mio
+from moon import metrics
+from moon.config import Constants
+from moon.features import LunarFeatures
+from moon.cache import CutoutCache, cache_key
+from moon.workers import BoundedExecutor, Overloaded
+from moon.tiles import TileSource, LAYERS, tile_bounds
+from moon.formats import FORMATS, write_cutout, check_format
+from moon.mesh import crater_meshes, to_glb
+from moon.sampling import METHODS
 
 app = Flask(__name__)
 
+# a few hundred MB worth of warped cutouts should be plenty for a dummy server
+CUTOUT_CACHE = CutoutCache('webcache', max_bytes=512 * 1024**2,
+                           max_entries=1000, suffix='.cutout')
+
+# cutout format picked by the Accept header, unless `format` is given
+NEGOTIATED_FORMATS = {"image/tiff": "deflate", "application/x-npy": "npy",
+                      "application/x-npz": "npz"}
+
+# the warps are done here, and not in the request threads; if too many of
+# them pile up, we'd rather tell the client to come back later
+WARP_POOL = BoundedExecutor(max_workers=4, max_queued=32)
+RETRY_AFTER_SECONDS = 5
+
+# largest output image side that can be requested, in pixels
+MAX_OUTPUT_SIZE = 4096
+
+# map tiles are small and many, and don't change unless the DEM does
+TILE_SOURCE = TileSource(mio.lola_source())
+TILE_CACHE = CutoutCache('webcache/tiles', max_bytes=1024**3,
+                         max_entries=200000, suffix='.tile', name='tile')
+TILE_MAX_AGE = 7 * 24 * 3600  # in seconds
+
+# levels of detail a single mesh request can ask for
+MAX_MESH_LODS = 4
+
+# a few seconds worth of sampling, and a few tens of MB of coordinates
+MAX_SAMPLE_POINTS = 10_000_000
+
+# the spans and counters of moon.io & co. are no-ops unless a hook is set;
+# here they're aggregated for the /metrics endpoint
+METRICS = metrics.set_hook(metrics.Recorder())
+
+
+class BadRequest(ValueError):
+    """Raised on missing or malformed query parameters"""
+
+
+class NotFound(LookupError):
+    """Raised on unknown lunar feature names"""
+
+
+@app.errorhandler(Overloaded)
+def too_many_requests(err):
+    """Back-pressure: the warp queue is full"""
+
+    response = jsonify(error=str(err))
+    response.status_code = 429
+    response.headers['Retry-After'] = str(RETRY_AFTER_SECONDS)
+    return response
+
+
+@app.errorhandler(BadRequest)
+def bad_request(err):
+    """Malformed query"""
+
+    response = jsonify(error=str(err))
+    response.status_code = 400
+    return response
+
+
+@app.errorhandler(NotFound)
+def unknown_feature(err):
+    """Unknown feature name"""
+
+    response = jsonify(error=str(err))
+    response.status_code = 404
+    return response
+
+
+@app.before_request
+def _start_timer():
+    g.t_start = time.perf_counter()
+
+
+@app.after_request
+def _record_request(response):
+    """Request latency per endpoint, and response status counts"""
+
+    t_start = g.pop('t_start', None)
+    if t_start is not None:
+        # by route rather than path, unknown URLs shouldn't add metrics
+        route = request.url_rule.rule if request.url_rule else "unknown"
+        METRICS.observe(f"request:{route}", time.perf_counter() - t_start)
+    METRICS.count(f"responses_{response.status_code}")
+
+    return response
+
+
+def _send_file(fileobj, **kwargs):
+    """
+    `flask.send_file` of an open cache file, timed until it's streamed out
+
+    The file comes from `CutoutCache.open_or_create`, opened while the cache
+    was locked, so a concurrent eviction can't delete it before it is read.
+    Being a file object, it has no size for `send_file` to answer Range
+    requests with, hence the explicit `make_conditional`.
+
+    The body is only sent after the view returns, so the span is closed by
+    the body iterator, once the server is done with it. Wrapping it turns
+    off the server's `wsgi.file_wrapper` shortcut, which is the price of
+    seeing the transfer time.
+    """
+
+    t_start = time.perf_counter()
+    stat = os.fstat(fileobj.fileno())
+    response = send_file(fileobj, conditional=False,
+                         last_modified=stat.st_mtime, **kwargs)
+    response.content_length = stat.st_size
+    try:
+        response = response.make_conditional(
+            request.environ, accept_ranges=True, complete_length=stat.st_size)
+    except RequestedRangeNotSatisfiable:
+        fileobj.close()
+        raise
+    response.response = ClosingIterator(response.response, lambda: (
+        METRICS.observe("send_file", time.perf_counter() - t_start)))
+
+    return response
+
+
+def _crater_position_size(crater_name):
+    """Lat/lon/diameter of a feature, NotFound if there's no such name"""
+
+    try:
+        return LunarFeatures().crater_position_size(crater_name)
+    except KeyError as err:
+        raise NotFound(f"Unknown lunar feature: {crater_name}") from err
+
+
+def _float_arg(name, default=None, positive=False):
+    """
+    Fetches a finite float query parameter, complaining if it's not there
+
+    Python's float() takes "nan" and "inf" too, which no warp can do much
+    with, so these are rejected here; as are non-positive values if
+    `positive` is set.
+    """
+
+    value = request.args.get(name, default)
+    try:
+        # the default only stands in for missing values, not malformed ones
+        value = float(value)
+    except (TypeError, ValueError) as err:
+        raise BadRequest(f"Missing or malformed '{name}' parameter") from err
+    if not np.isfinite(value):
+        raise BadRequest(f"Need a finite '{name}'")
+    if positive and value <= 0:
+        raise BadRequest(f"Need a positive '{name}'")
+
+    return value
+
+
+def _size_params():
+    """
+    Optional `size` (in pixels) of the output image, as gdal.Warp options
+
+    Fixing the output size lets the warp read from a coarser overview level,
+    which is a lot faster for the large craters.
+    """
+
+    size = request.args.get('size', type=int)
+    if size is None:
+        return {}
+
+    if not 0 < size <= MAX_OUTPUT_SIZE:
+        raise BadRequest(f"Need 0 < size <= {MAX_OUTPUT_SIZE}")
+
+    return {"width": size, "height": size}
+
+
+def _format_params():
+    """
+    Output format and value encoding of a cutout, see `moon.formats`
+
+    Taken from the `format` and `encoding` query parameters, or else the
+    format is negotiated from the Accept header (GeoTiff by default).
+    """
+
+    fmt = request.args.get('format')
+    if fmt is None:
+        fmt = NEGOTIATED_FORMATS[request.accept_mimetypes.best_match(
+            NEGOTIATED_FORMATS, default="image/tiff")]
+    encoding = request.args.get('encoding', 'int16')
+
+    try:
+        check_format(fmt, encoding)
+    except ValueError as err:
+        raise BadRequest(str(err)) from err
+
+    return fmt, encoding
+
+
+def cached_cutout(key, warp_func, fmt, encoding, **params):
+    """
+    Returns an open cached cutout, warping it on a worker thread if needed
+
+    Cache misses for the same parameters are coalesced into a single warp,
+    which is then queued on the worker pool (that might raise `Overloaded`).
+    """
+
+    def producer(tmp_fname):
+        submitted = time.perf_counter()
+
+        def _warp():
+            METRICS.observe("warp_queue_wait", time.perf_counter() - submitted)
+            # raw, as there's no point in scaling the array we don't send
+            # back; the GeoTiffs have int16 pixels and a scale in metadata
+            write_cutout(tmp_fname, warp_func, fmt, encoding, **params)
+
+        WARP_POOL.submit(_warp).result()
+
+    return CUTOUT_CACHE.open_or_create(key, producer)
+
+
+def cutout_response(warp_func, attachment_name, **params):
+    """
+    Sends a cutout back, making it first if it's not in the cache
+
+    The cache key doubles as a strong ETag, so clients holding a current copy
+    get a 304 on If-None-Match without the cutout even being looked up, and
+    Range requests are served as partial content.
+    """
+
+    fmt, encoding = _format_params()
+    key = cache_key(warp=warp_func.__name__, fmt=fmt, encoding=encoding,
+                    version=TILE_SOURCE.version, **params)
+
+    if key in request.if_none_match:
+        response = app.response_class(status=304)
+        response.set_etag(key)
+    else:
+        cutout = cached_cutout(key, warp_func, fmt, encoding, **params)
+        extension, mimetype = FORMATS[fmt]
+        response = _send_file(cutout, mimetype=mimetype, etag=key,
+                              download_name=f"{attachment_name}"
+                              f".{extension}")
+
+    response.vary.add('Accept')
+    return response
+
 
 @app.route('/craters', methods=['GET'])
 def logo():
-    """Reprojects LOLA DEM around a requested crater and returns back a .tif"""
+    """
+    Reprojects LOLA DEM around a requested crater and returns it back
+
+    As a DEFLATE-compressed GeoTiff by default; see `_format_params` for the
+    other formats and encodings.
+    """
+
+    crater_name = request.args.get('name')
+    if not crater_name:
+        raise BadRequest("Missing 'name' parameter")
+    _crater_position_size(crater_name)  # 404 before any warping
+    pad = _float_arg('pad', 1.3, positive=True)
+
+    return cutout_response(mio.crater_cutout, crater_name.replace(' ', '_'),
+                           crater_name=crater_name.lower(), pad=pad,
+                           **_size_params())
+
+
+@app.route('/window', methods=['GET'])
+def window():
+    """
+    Reprojects LOLA DEM in an arbitrary square and returns it back
+
+    Takes either `lon`, `lat`, and `side` (in km), or a crater `name` and a
+    `pad` (cutout side in units of the crater diameter). An optional `size`
+    sets the output image side in pixels. Output formats are the same as for
+    `/craters`.
+    """
+
+    crater_name = request.args.get('name')
+    if crater_name:
+        lat, lon, diameter = _crater_position_size(crater_name)
+        side = diameter * _float_arg('pad', 1.3, positive=True)
+        attachment_name = crater_name.replace(' ', '_')
+    else:
+        lon, lat = _float_arg('lon'), _float_arg('lat')
+        side = _float_arg('side', positive=True)
+        attachment_name = f"window_{lon:g}_{lat:g}_{side:g}"
+
+    # the side can still be zero for the craters without a diameter
+    if not -90 < lat < 90 or side <= 0:
+        raise BadRequest("Need -90 < lat < 90 and a positive side")
+
+    return cutout_response(mio.read_warped_window, attachment_name, lon=lon,
+                           lat=lat, side=side, convert_km_to_deg=True,
+                           **_size_params())
+
+
+def _sample_points():
+    """
+    Lon/lat arrays of the points to sample, from the request body
+
+    Either a JSON object with `lon` and `lat` lists, or an (N, 2) .npy array
+    of lon/lat rows with the `application/x-npy` content type. The JSON
+    object can also hold the sampling options, returned as a dict.
+    """
+
+    options = {}
+
+    try:
+        if request.mimetype == 'application/x-npy':
+            points = np.load(io.BytesIO(request.get_data()),
+                             allow_pickle=False)
+            if points.ndim != 2 or points.shape[1] != 2:
+                raise ValueError("need an (N, 2) array of lon/lat rows")
+            lons, lats = points[:, 0], points[:, 1]
+        else:
+            options = request.get_json(force=True, silent=True)
+            if not isinstance(options, dict):
+                raise ValueError("need a JSON object with lon/lat lists")
+            lons, lats = np.broadcast_arrays(
+                np.asarray(options.pop('lon', None), dtype=np.float64),
+                np.asarray(options.pop('lat', None), dtype=np.float64))
+    except (ValueError, TypeError) as err:
+        raise BadRequest(f"Malformed points: {err}") from err
+
+    if lons.ndim != 1 or lons.size > MAX_SAMPLE_POINTS:
+        raise BadRequest(f"Need a list of up to {MAX_SAMPLE_POINTS} points")
+
+    return lons, lats, options
+
+
+@app.route('/sample', methods=['POST'])
+def sample():
+    """
+    Elevation at arbitrary lon/lat points, see `mio.sample_elevation`
+
+    Takes the points as JSON (`{"lon": [...], "lat": [...]}`) or as an
+    (N, 2) .npy array, and answers in kind: a JSON `elevation` list or a
+    .npy float64 array. The `method` ("nearest", "bilinear", "bicubic")
+    and `absolute` (local radius instead of elevation) options can be given
+    as query parameters, or in the JSON object.
+    """
+
+    lons, lats, options = _sample_points()
+    method = options.get('method', request.args.get('method', 'bilinear'))
+    if method not in METHODS:
+        raise BadRequest(f"Unknown method: {method}, pick one of"
+                         f" {', '.join(METHODS)}")
+    # JSON booleans only, as bool("false") is True
+    absolute = options.get('absolute', request.args.get(
+        'absolute', 'false').lower() in ('1', 'true', 'yes'))
+    if not isinstance(absolute, bool):
+        raise BadRequest("Need a true or false 'absolute'")
+
+    def _sample():
+        # the tile source has a dataset per thread, and these can't be
+        # shared between the pool threads
+        return mio.sample_elevation(lons, lats, method, absolute,
+                                    reader=TILE_SOURCE.reader())
+
+    try:
+        elevation = WARP_POOL.submit(_sample).result()
+    except ValueError as err:
+        raise BadRequest(str(err)) from err
+    metrics.count("points_sampled", lons.size)
+
+    if request.mimetype == 'application/x-npy':
+        buffer = io.BytesIO()
+        np.save(buffer, elevation)
+        return app.response_class(buffer.getvalue(),
+                                  mimetype='application/x-npy')
+
+    # NaN isn't valid JSON, and only comes out of non-finite coordinates
+    values = elevation.astype(object)
+    values[np.isnan(elevation)] = None
+    return jsonify(elevation=values.tolist())
+
+
+@app.route('/mesh', methods=['GET'])
+def mesh():
+    """
+    Simplified 3D mesh of a crater, as binary glTF
+
+    Takes the crater `name`, `pad`, the cutout `size` in pixels (513 by
+    default), and a comma-separated list of `max_error` vertical error
+    bounds in meters (5 by default), one level of detail for each, in a
+    scene of its own; see `moon.mesh`. Cached and ETagged as the cutouts.
+    """
 
     crater_name = request.args.get('name')
-    fname = path.join('webcache', crater_name.replace(' ', '_') + '.tif')
+    if not crater_name:
+        raise BadRequest("Missing 'name' parameter")
+    _crater_position_size(crater_name)
+    pad = _float_arg('pad', 1.3, positive=True)
+    size = request.args.get('size', 513, type=int)
+    if not 2 <= size <= MAX_OUTPUT_SIZE:
+        raise BadRequest(f"Need 2 <= size <= {MAX_OUTPUT_SIZE}")
+    try:
+        max_errors = [float(error) for error in
+                      request.args.get('max_error', '5').split(',')]
+    except ValueError as err:
+        raise BadRequest("Malformed 'max_error' parameter") from err
+    # written as a negation so that NaNs fail it too
+    if not (0 < len(max_errors) <= MAX_MESH_LODS
+            and all(0 <= error < np.inf for error in max_errors)):
+        raise BadRequest(f"Need 1 to {MAX_MESH_LODS} finite, non-negative"
+                         " 'max_error' values")
+
+    key = cache_key(mesh=crater_name.lower(), pad=pad, size=size,
+                    max_errors=max_errors, version=TILE_SOURCE.version)
+    if key in request.if_none_match:
+        response = app.response_class(status=304)
+        response.set_etag(key)
+        return response
+
+    def producer(tmp_fname):
+        def _build():
+            meshes = crater_meshes(crater_name.lower(), pad, size,
+                                   max_errors)
+            with open(tmp_fname, 'wb') as glbfile:
+                glbfile.write(to_glb(meshes, [f"lod{i}_{error:g}m" for
+                                              i, error in
+                                              enumerate(max_errors)]))
+
+        WARP_POOL.submit(_build).result()
+
+    glb = CUTOUT_CACHE.open_or_create(key, producer)
+    return _send_file(glb, mimetype='model/gltf-binary', etag=key,
+                      download_name=crater_name.replace(' ', '_') + '.glb')
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+    Latency histograms and counters aggregated since the server start
+
+    JSON by default, or the Prometheus text format with `format=prometheus`.
+    Spans include the requests per endpoint, the feature lookups, the warps
+    and the time they waited in the queue, GeoTiff encoding, and sending
+    the files out, up to the last byte.
+    """
+
+    if request.args.get('format') == 'prometheus':
+        return METRICS.to_prometheus(), 200, {
+            'Content-Type': 'text/plain; version=0.0.4'}
+
+    snapshot = METRICS.snapshot()
+    snapshot["warp_pool"] = {"pending": WARP_POOL.pending}
+    snapshot["cutout_cache"] = {"entries": len(CUTOUT_CACHE),
+                                "bytes": CUTOUT_CACHE.total_bytes,
+                                "hits": CUTOUT_CACHE.hits,
+                                "misses": CUTOUT_CACHE.misses}
+
+    return jsonify(snapshot)
+
+
+@app.route('/tiles/<layer>/<int:z>/<int:x>/<int:y>.<ext>', methods=['GET'])
+def tile(layer, z, x, y, ext):
+    """
+    Z/X/Y tile of the DEM on a geographic grid (two tiles at zoom 0)
+
+    Layers are `raw/{z}/{x}/{y}.bin` (little-endian int16 values, 256 x 256,
+    times the X-Scale-Factor header for meters) and
+    `hillshade/{z}/{x}/{y}.png`. Tiles are cached on disk and come with an
+    ETag, so repeat requests with If-None-Match get a 304 without any work.
+    """
+
+    if layer not in LAYERS or LAYERS[layer][0] != ext:
+        raise BadRequest(f"Unknown tile layer: {layer}.{ext}")
+    try:
+        tile_bounds(z, x, y)
+    except ValueError as err:
+        raise BadRequest(str(err)) from err
+    if z > TILE_SOURCE.max_zoom:
+        raise BadRequest(f"Zoom {z} is past the maximum of"
+                         f" {TILE_SOURCE.max_zoom}")
+
+    key = cache_key(tile=layer, z=z, x=x, y=y, version=TILE_SOURCE.version)
+
+    if key not in request.if_none_match:
+        def producer(tmp_fname):
+            with open(tmp_fname, 'wb') as tilefile:
+                tilefile.write(TILE_SOURCE.render(layer, z, x, y))
+
+        with TILE_CACHE.open_or_create(key, producer) as tilefile:
+            data = tilefile.read()
+    else:
+        data = b''  # not modified, the body won't be sent anyway
 
-    if not path.isfile(fname):
-        mio.crater_cutout(crater_name, destNameOrDestDS=fname, format="GTIFF")
+    response = app.response_class(data, mimetype=LAYERS[layer][1])
+    response.set_etag(key)
+    response.cache_control.public = True
+    response.cache_control.max_age = TILE_MAX_AGE
+    if layer == "raw":
+        response.headers['X-Scale-Factor'] = str(
+            Constants.lola_dem_scaling_factor)
 
-    return send_file(fname, attachment_filename=path.basename(fname),
-                     mimetype='image/tiff')
+    return response.make_conditional(request)
@@ -0,0 +1,256 @@
+"""
+Bulk crater cutouts over the IAU catalogue, spread over a process pool
+
+Call it from command line as `python -m moon.batch --help`, e.g.:
+$ python -m moon.batch webcache/craters --min-diameter 20 --processes 8
+"""
+
+import os
+import sys
+import csv
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import gdal
+from moon.config import Paths
+from moon.catalogue import FeatureCatalogue, NAME_COLUMN
+from moon import io as mio
+
+# every worker process keeps its own open source dataset around; opening the
+# 8 GB GeoTIFF (or worse, the S3 object) for each crater is a waste of time
+_WORKER_SOURCE = None
+
+
+def select_craters(fname=os.path.join(Paths.table_dir,
+                                      Paths.iau_craters_fname),
+                   min_diameter=None, max_diameter=None,
+                   lat_range=None, lon_range=None, names=None):
+    """
+    Picks crater names from an IAU table, optionally filtered by size/region
+
+    Parameters
+    ----------
+    fname : str
+        Path to the IAU csv table, defaults to the approved craters table.
+
+    min_diameter, max_diameter : float, optional
+        Diameter limits, in km.
+
+    lat_range, lon_range : tuple of float, optional
+        A (min, max) pair of degrees the crater centre should fall into.
+
+    names : iterable of str, optional
+        Only keep craters with these (case-insensitive) names.
+
+    Returns
+    -------
+    crater_names : list of str
+    """
+
+    catalogue = FeatureCatalogue.from_csv(fname)
+    keep = np.ones(len(catalogue), dtype=bool)
+
+    if min_diameter is not None:
+        keep &= catalogue["diameter"] >= min_diameter
+    if max_diameter is not None:
+        keep &= catalogue["diameter"] <= max_diameter
+    for column, limits in (("center_latitude", lat_range),
+                           ("center_longitude", lon_range)):
+        if limits is not None:
+            keep &= ((catalogue[column] >= limits[0])
+                     & (catalogue[column] <= limits[1]))
+    if names is not None:
+        keep &= np.isin(np.char.lower(catalogue[NAME_COLUMN]),
+                        [name.lower() for name in names])
+
+    return catalogue[NAME_COLUMN][keep].tolist()
+
+
+def cutout_fname(crater_name, out_dir, ext='.tif'):
+    """Output file name for a crater, same convention as the web cache"""
+
+    return os.path.join(out_dir, crater_name.replace(' ', '_') + ext)
+
+
+def is_valid_cutout(fname):
+    """Checks if a file exists and can be opened as a non-empty raster"""
+
+    if not os.path.isfile(fname) or not os.path.getsize(fname):
+        return False
+
+    dataset = gdal.Open(fname)
+    if dataset is None:
+        return False
+
+    return dataset.RasterXSize > 0 and dataset.RasterYSize > 0
+
+
+def _init_worker(source):
+    """Process pool initializer - opens the source dataset once per worker"""
+
+    global _WORKER_SOURCE  # pylint: disable=global-statement
+    _WORKER_SOURCE = gdal.Open(source)
+    if _WORKER_SOURCE is None:
+        raise RuntimeError(f"Can't open the source dataset {source}")
+
+
+def _cutout_worker(crater_name, fname, pad, kwargs):
+    """Writes a single crater cutout, atomically via a temporary file"""
+
+    # crashing mid-write leaves a .part file behind instead of a broken .tif
+    # that would otherwise pass for a finished cutout on the next run
+    tmp_fname = f"{fname}.{os.getpid()}.part"
+    try:
+        mio.crater_cutout(crater_name, pad=pad, source=_WORKER_SOURCE,
+                          destNameOrDestDS=tmp_fname, format="GTIFF",
+                          raw=True, **kwargs)
+        os.replace(tmp_fname, fname)
+    finally:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+
+    return crater_name
+
+
+def batch_crater_cutouts(crater_names, out_dir, pad=1.3, processes=None,
+                         source=os.path.join(Paths.data_dir, Paths.tif_fname),
+                         overwrite=False, progress_every=50, log=sys.stderr,
+                         **kwargs):
+    """
+    Writes warped GeoTiff cutouts for many craters using a process pool
+
+    The job is resumable: finished cutouts are written atomically, and the
+    ones that already exist (and can be opened) are skipped unless asked not
+    to, so rerunning a crashed job picks up where it stopped.
+
+    Parameters
+    ----------
+    crater_names : iterable of str
+        Names of the features to cut out, e.g. from `select_craters`.
+
+    out_dir : str
+        Folder to write the .tif files into, created if missing.
+
+    pad : float, default: 1.3
+        Cutout side in units of crater diameter.
+
+    processes : int, optional
+        Number of worker processes, defaults to the number of CPUs.
+
+    source : str
+        Path or URL of the LOLA GeoTiff, opened once per worker.
+
+    overwrite : bool, default: False
+        Whether to redo cutouts that are already on disk.
+
+    progress_every : int, default: 50
+        Report throughput every so many finished craters; 0 to silence.
+
+    log : file-like, default: sys.stderr
+        Where to write the progress reports.
+
+    Returns
+    -------
+    stats : dict
+        Counts of done/skipped/failed craters, wall time, and throughput.
+        Failed craters are listed with their error messages under "errors".
+
+    Other Parameters
+    ----------------
+    **kwargs
+        All other keyword arguments are passed to `moon.io.crater_cutout`.
+    """
+
+    os.makedirs(out_dir, exist_ok=True)
+
+    todo, skipped = [], 0
+    for crater_name in crater_names:
+        fname = cutout_fname(crater_name, out_dir)
+        if not overwrite and is_valid_cutout(fname):
+            skipped += 1
+            continue
+        todo.append((crater_name, fname))
+
+    errors = {}
+    done = 0
+    t_start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                             initargs=(source,)) as executor:
+        futures = {executor.submit(_cutout_worker, crater_name, fname,
+                                   pad, kwargs): crater_name
+                   for crater_name, fname in todo}
+        for future in as_completed(futures):
+            try:
+                future.result()
+                done += 1
+            except Exception as err:  # pylint: disable=broad-except
+                # one odd crater (e.g. at the pole) shouldn't kill the batch
+                errors[futures[future]] = repr(err)
+
+            finished = done + len(errors)
+            if progress_every and not finished % progress_every:
+                elapsed = time.perf_counter() - t_start
+                print(f"{finished}/{len(todo)} craters,"
+                      f" {done / elapsed:.2f} craters/s", file=log)
+
+    elapsed = time.perf_counter() - t_start
+    stats = {"done": done, "skipped": skipped, "failed": len(errors),
+             "errors": errors, "seconds": elapsed,
+             "craters_per_second": done / elapsed if elapsed else 0.}
+
+    if progress_every:
+        print(f"Done: {done} written, {skipped} skipped, {len(errors)} failed"
+              f" in {elapsed:.1f} s ({stats['craters_per_second']:.2f}"
+              " craters/s)", file=log)
+
+    return stats
+
+
+def _parse_range(value):
+    """argparse helper for "min,max" pairs"""
+
+    low, high = (float(v) for v in value.split(','))
+    return low, high
+
+
+def main(argv=None):
+    """Command line entry point for bulk crater cutouts"""
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument("out_dir", help="folder to write the .tif files to")
+    parser.add_argument("--table", default=os.path.join(
+        Paths.table_dir, Paths.iau_craters_fname), help="IAU csv table")
+    parser.add_argument("--source", default=os.path.join(
+        Paths.data_dir, Paths.tif_fname), help="LOLA GeoTiff path or URL")
+    parser.add_argument("--pad", type=float, default=1.3,
+                        help="cutout side in units of crater diameter")
+    parser.add_argument("--min-diameter", type=float, help="in km")
+    parser.add_argument("--max-diameter", type=float, help="in km")
+    parser.add_argument("--lat-range", type=_parse_range, metavar="MIN,MAX")
+    parser.add_argument("--lon-range", type=_parse_range, metavar="MIN,MAX")
+    parser.add_argument("--names", nargs="+", help="only these craters")
+    parser.add_argument("--processes", type=int, help="defaults to CPU count")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="redo the cutouts that are already on disk")
+    parser.add_argument("--errors", help="write failed craters to this .csv")
+    args = parser.parse_args(argv)
+
+    crater_names = select_craters(args.table, args.min_diameter,
+                                  args.max_diameter, args.lat_range,
+                                  args.lon_range, args.names)
+    stats = batch_crater_cutouts(crater_names, args.out_dir, pad=args.pad,
+                                 processes=args.processes, source=args.source,
+                                 overwrite=args.overwrite)
+
+    if args.errors and stats["errors"]:
+        with open(args.errors, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(("feature_name", "error"))
+            writer.writerows(stats["errors"].items())
+
+    return 1 if stats["failed"] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,433 @@
+"""
+Timing a few things we care about being fast
+
+By default everything runs against a synthetic LOLA-like GeoTiff (see
+`moon.synthetic`), made on the first run, so no 8 GB download or S3 access
+is needed. Results come out as JSON together with the commit they were run
+on; pass an earlier results file with `--compare` to flag regressions.
+
+Call it from command line as `python -m moon.benchmarks`, e.g.:
+$ python -m moon.benchmarks import --repeat 20
+$ python -m moon.benchmarks --output new.json --compare old.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+import numpy as np
+
+# top-level folder, so that the subprocesses find the package
+_REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# default folder for the synthetic GeoTiff
+_FIXTURE_DIR = os.path.join(tempfile.gettempdir(), "moon_benchmarks")
+
+# run in a fresh interpreter, so that nothing is imported yet
+_IMPORT_TIMER = """
+import time
+t_start = time.perf_counter()
+import {module}
+print(time.perf_counter() - t_start)
+"""
+
+# same, for the first feature lookup (catalogue load included)
+_LOOKUP_TIMER = """
+import time
+from moon.features import LunarFeatures
+t_start = time.perf_counter()
+LunarFeatures().crater_position_size("tycho")
+print(time.perf_counter() - t_start)
+"""
+
+# a spread of crater sizes for the cutout benchmarks, diameters in km
+_CRATERS = ("linne", "tycho", "copernicus", "clavius")
+
+
+def _summary(timings):
+    """Basic statistics over a list of timings, in seconds"""
+
+    return {"min": min(timings), "median": statistics.median(timings),
+            "max": max(timings), "repeat": len(timings)}
+
+
+def time_call(func, repeat=10, warmup=1):
+    """Times repeated calls of a no-argument function"""
+
+    for _ in range(warmup):
+        func()
+
+    timings = []
+    for _ in range(repeat):
+        t_start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - t_start)
+
+    return _summary(timings)
+
+
+def time_script(script, repeat=10):
+    """
+    Times a snippet in a new Python process each time
+
+    The snippet prints out its own timing as the last line of its output,
+    so that the interpreter startup isn't counted.
+    """
+
+    timings = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", script], check=True, capture_output=True,
+            text=True, cwd=_REPO_DIR).stdout
+        timings.append(float(output.strip().splitlines()[-1]))
+
+    return _summary(timings)
+
+
+def time_import(module="moon.io", repeat=10):
+    """Times a cold import of a module, each time in a new Python process"""
+
+    return time_script(_IMPORT_TIMER.format(module=module), repeat)
+
+
+def _random_centres(n, seed=0, max_lat=60):
+    """Reproducible lon/lat pairs, away from the poles"""
+
+    rng = np.random.default_rng(seed)
+    return rng.uniform(-180, 180, n), rng.uniform(-max_lat, max_lat, n)
+
+
+def bench_import(repeat=10):
+    """Import time of the modules our tools and API workers start with"""
+
+    return {module: time_import(module, repeat)
+            for module in ("moon.config", "moon.features", "moon.io")}
+
+
+def bench_warp(repeat=10, source=None, sides_km=(5, 20, 100), size=256,
+               lon=-11.36, lat=-43.31):
+    """
+    Per-call gdal.Warp (read_warped_window) against the persistent engine
+
+    Every call is for a slightly different centre, same as a batch of
+    cutouts of similar size would be, so no results are reused.
+    """
+
+    from moon import io as mio
+    from moon.config import Paths
+    from moon.warp import WarpEngine
+
+    source = source or os.path.join(Paths.data_dir, Paths.tif_fname)
+    engine = WarpEngine(source)
+
+    results = {}
+    for side in sides_km:
+        offsets = iter(range(10**6))
+
+        def _gdal_call():
+            mio.read_warped_window(lon + next(offsets) * 1e-3, lat, side,
+                                   convert_km_to_deg=True, source=source,
+                                   width=size, height=size, raw=True)
+
+        def _engine_call():
+            engine.warp(lon + next(offsets) * 1e-3, lat, side,
+                        convert_km_to_deg=True, size=size)
+
+        gdal_stats = time_call(_gdal_call, repeat)
+        engine_stats = time_call(_engine_call, repeat)
+        results[f"{side}km"] = {
+            "gdal.Warp": gdal_stats, "WarpEngine": engine_stats,
+            "speedup": gdal_stats["median"] / engine_stats["median"]}
+
+    engine.close()
+
+    return results
+
+
+def bench_features(repeat=10):
+    """Crater lookups, name search, and nearest feature queries"""
+
+    from moon.features import LunarFeatures
+
+    features = LunarFeatures()
+    names = [str(name) for name in features.feature_names[::50]]
+    lons, lats = _random_centres(100)
+
+    def _lookups():
+        for name in names:
+            features.crater_position_size(name)
+
+    return {
+        "first_lookup": time_script(_LOOKUP_TIMER, max(1, repeat // 2)),
+        f"lookup_x{len(names)}": time_call(_lookups, repeat),
+        "search": time_call(lambda: features.search("ty"), repeat),
+        "suggest": time_call(lambda: features.suggest("tyco"), repeat),
+        "nearest_x100": time_call(lambda: features.nearest(lons, lats),
+                                  repeat)}
+
+
+def bench_square_cutout(repeat=10, sides_km=(10, 50, 200)):
+    """Unwarped square cutouts of a few sizes, all over the map"""
+
+    from moon import io as mio
+
+    lons, lats = _random_centres(repeat + 1)
+    mio.square_cutout(0, 0, 1)  # opens the GeoTiff
+
+    results = {}
+    for side in sides_km:
+        centres = iter(zip(lons, lats))
+        results[f"{side}km"] = time_call(
+            lambda: mio.square_cutout(*next(centres), side,
+                                      convert_km_to_deg=True), repeat)
+
+    return results
+
+
+def bench_cutouts(repeat=10, sizes=(128, 512, 1024), side_km=100):
+    """
+    Warped cutouts: fixed side at several output sizes, and a few craters
+
+    Every window call is for a slightly different centre, so nothing is
+    reused between calls.
+    """
+
+    from moon import io as mio
+
+    results = {"read_warped_window": {}, "crater_cutout": {}}
+    for size in sizes:
+        offsets = iter(range(10**6))
+        results["read_warped_window"][f"{size}px"] = time_call(
+            lambda: mio.read_warped_window(
+                -11.36 + next(offsets) * 1e-3, -43.31, side_km,
+                convert_km_to_deg=True, width=size, height=size, raw=True),
+            repeat)
+
+    for name in _CRATERS:
+        results["crater_cutout"][name] = time_call(
+            lambda: mio.crater_cutout(name, raw=True), repeat)
+
+    return results
+
+
+def bench_sample(repeat=5, n_points=1_000_000):
+    """Elevation at a million random points, for each interpolation"""
+
+    import numpy as np
+    from moon import io as mio
+
+    rng = np.random.default_rng(0)
+    lons = rng.uniform(-180, 180, n_points)
+    lats = rng.uniform(-90, 90, n_points)
+    mio.sample_elevation(0, 0)  # opens the GeoTiff
+
+    return {method: time_call(
+        lambda method=method: mio.sample_elevation(lons, lats, method),
+        repeat) for method in ("nearest", "bilinear", "bicubic")}
+
+
+def bench_downsample(repeat=3, n=5):
+    """Streaming downsample of the whole GeoTiff, in memory"""
+
+    from moon import io as mio
+
+    return {f"n={n}": time_call(lambda: mio.downsample_lola(n=n),
+                                max(1, repeat // 3), warmup=0)}
+
+
+def bench_api(repeat=10, n_requests=20):
+    """
+    Flask API throughput, for cache misses and for cache hits
+
+    Goes through the Flask test client, so it's the request handling and
+    the warps that are measured, not the network. The server cutout cache is
+    swapped for an empty one in a temporary folder.
+    """
+
+    if _REPO_DIR not in sys.path:
+        sys.path.insert(0, _REPO_DIR)
+    import lunar_api
+    from moon.cache import CutoutCache
+
+    results = {}
+    with tempfile.TemporaryDirectory() as cache_dir:
+        lunar_api.CUTOUT_CACHE = CutoutCache(cache_dir)
+        client = lunar_api.app.test_client()
+        offsets = iter(range(10**6))
+
+        def _get(url):
+            response = client.get(url)
+            response.close()
+            if response.status_code != 200:
+                raise RuntimeError(f"{url}: {response.status_code}")
+
+        def _misses():
+            for _ in range(n_requests):
+                lon = -11.36 + next(offsets) * 1e-3
+                _get(f"/window?lon={lon}&lat=-43.31&side=50&size=256")
+
+        def _hits():
+            for _ in range(n_requests):
+                _get("/craters?name=tycho&size=256")
+
+        for label, func in (("window_miss", _misses), ("crater_hit", _hits)):
+            stats = time_call(func, max(1, repeat // 5))
+            stats["requests_per_second"] = n_requests / stats["median"]
+            results[label] = stats
+
+    return results
+
+
+BENCHMARKS = {
+    "import": bench_import,
+    "features": bench_features,
+    "square_cutout": bench_square_cutout,
+    "cutouts": bench_cutouts,
+    "warp": bench_warp,
+    "sample": bench_sample,
+    "downsample": bench_downsample,
+    "api": bench_api,
+}
+
+
+def use_data_dir(data_dir):
+    """
+    Points the package at another data folder, e.g. a synthetic one
+
+    Has to be called before `moon.io` is imported: its functions take the
+    data paths as default arguments. Subprocesses inherit the folder too.
+    """
+
+    if "moon.io" in sys.modules:
+        raise RuntimeError("moon.io is already imported, can't switch"
+                           " the data folder anymore")
+
+    os.environ["MOON_DATA_DIR"] = data_dir
+    from moon.config import Paths
+    Paths.data_dir = data_dir
+    Paths.remote_cache_dir = os.path.join(data_dir, "remote_cache")
+
+
+def _git_commit():
+    """Current commit hash, or None outside of a git checkout"""
+
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], check=True,
+                              capture_output=True, text=True,
+                              cwd=_REPO_DIR).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _medians(results, prefix=()):
+    """Flattens nested results into {path: median} for timing summaries"""
+
+    medians = {}
+    for key, value in results.items():
+        if not isinstance(value, dict):
+            continue
+        if "median" in value:
+            medians["/".join(prefix + (key,))] = value["median"]
+        else:
+            medians.update(_medians(value, prefix + (key,)))
+
+    return medians
+
+
+def compare(old, new, threshold=1.2):
+    """
+    Compares two benchmark runs by their median timings
+
+    Returns
+    -------
+    rows : list of dict
+        One per timing found in both runs, with the old and new medians,
+        their ratio, and whether it's a regression (ratio > threshold).
+    """
+
+    old_medians = _medians(old["results"])
+    new_medians = _medians(new["results"])
+
+    return [{"benchmark": key, "old": old_medians[key],
+             "new": new_medians[key],
+             "ratio": new_medians[key] / old_medians[key],
+             "regression": new_medians[key] / old_medians[key] > threshold}
+            for key in new_medians if key in old_medians]
+
+
+def main(argv=None):
+    """Runs the benchmarks and prints out the results as JSON"""
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument("names", nargs="*", default=list(BENCHMARKS),
+                        help="benchmarks to run, all of them by default:"
+                             f" {', '.join(BENCHMARKS)}")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--output", help="write JSON results to a file")
+    parser.add_argument("--data-dir", default=_FIXTURE_DIR,
+                        help="folder with the GeoTiff to run against; a"
+                             " synthetic one is made there if missing")
+    parser.add_argument("--width", type=int, default=9216,
+                        help="width of the synthetic GeoTiff, in pixels")
+    parser.add_argument("--real-data", action="store_true",
+                        help="run against the actual data folder instead")
+    parser.add_argument("--compare", metavar="OLD_JSON",
+                        help="earlier results to check for regressions")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="slowdown ratio that counts as a regression")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(unknown)}")
+
+    from moon.config import Paths
+
+    if not args.real_data:
+        data_dir = os.path.abspath(args.data_dir)
+        use_data_dir(data_dir)
+        from moon.synthetic import make_synthetic_lola
+        make_synthetic_lola(os.path.join(data_dir, Paths.tif_fname),
+                            width=args.width)
+
+    results = {}
+    for name in args.names:
+        try:
+            results[name] = BENCHMARKS[name](repeat=args.repeat)
+        except Exception as err:  # pylint: disable=broad-except
+            # e.g. no GDAL on this box - the rest of the suite still runs
+            results[name] = {"error": f"{type(err).__name__}: {err}"}
+
+    report = {"meta": {"commit": _git_commit(),
+                       "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "python": platform.python_version(),
+                       "platform": platform.platform(),
+                       "data_dir": Paths.data_dir,
+                       "synthetic": not args.real_data,
+                       "repeat": args.repeat},
+              "results": results}
+
+    dump = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as jsonfile:
+            jsonfile.write(dump)
+    print(dump)
+
+    if args.compare:
+        with open(args.compare) as jsonfile:
+            rows = compare(json.load(jsonfile), report, args.threshold)
+        for row in rows:
+            flag = "REGRESSION" if row["regression"] else ""
+            print(f"{row['benchmark']:<50} {row['old']:10.4g}"
+                  f" {row['new']:10.4g} {row['ratio']:6.2f}x {flag}",
+                  file=sys.stderr)
+        if any(row["regression"] for row in rows):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,328 @@
+"""
+Block-wise processing of the LOLA GeoTiff in bounded memory
+
+The whole image is 8 GB and won't fit in RAM on a small machine, so here it is
+read in windows aligned with the internal GeoTiff blocks, processed window by
+window (optionally on a process pool), and written out incrementally.
+"""
+
+import math
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+# per-process raster handle for the pool workers, see `_init_worker`
+_WORKER_READER = None
+
+
+def aligned_step(block, factor):
+    """Smallest window step that's a multiple of both block and factor"""
+
+    return block * factor // math.gcd(block, factor)
+
+
+def plan_windows(height, width, block_shape, max_pixels, factor=1):
+    """
+    Splits an image into block-aligned windows of at most max_pixels each
+
+    Windows are full rows of blocks if memory allows, otherwise they're also
+    split along columns. Window sides are multiples of both the block shape
+    and `factor` (except at the image edges), so that downsampling by
+    `factor` never straddles two windows.
+
+    Returns
+    -------
+    windows : list of (row_off, col_off, height, width) tuples
+    """
+
+    row_step = aligned_step(block_shape[0], factor)
+    col_step = aligned_step(block_shape[1], factor)
+
+    # as many columns as fit into the budget for a single row step...
+    cols = max(col_step, min(width, max_pixels // row_step)
+               // col_step * col_step)
+    # ... and as many rows as fit with that many columns
+    rows = max(row_step, max_pixels // cols // row_step * row_step)
+
+    return [(row_off, col_off, min(rows, height - row_off),
+             min(cols, width - col_off))
+            for row_off in range(0, height, rows)
+            for col_off in range(0, width, cols)]
+
+
+def reduce_blocks(data, factor, reducer=np.mean, cval=0):
+    """
+    Reduces an array over non-overlapping factor x factor blocks
+
+    Edges not divisible by the factor are padded with `cval`, same as
+    `skimage.transform.downscale_local_mean` does it.
+    """
+
+    pad_rows = -data.shape[0] % factor
+    pad_cols = -data.shape[1] % factor
+    if pad_rows or pad_cols:
+        data = np.pad(data, ((0, pad_rows), (0, pad_cols)),
+                      constant_values=cval)
+
+    rows, cols = data.shape[0] // factor, data.shape[1] // factor
+    return reducer(data.reshape(rows, factor, cols, factor), axis=(1, 3))
+
+
+def bounds_to_windows(transform, lower_x, lower_y, upper_x, upper_y,
+                      shape=None):
+    """
+    Pixel windows for arrays of projected bounding boxes
+
+    Offsets and lengths are rounded to whole pixels, and the windows are
+    clipped to the image `shape` (height, width) if given.
+
+    Returns
+    -------
+    windows : np.ndarray
+        Integer (row_off, col_off, height, width) columns, one row per box.
+    """
+
+    x_size, _, x_off, _, y_size, y_off = tuple(transform)[:6]
+    rows = (np.stack([lower_y, upper_y]) - y_off) / y_size
+    cols = (np.stack([lower_x, upper_x]) - x_off) / x_size
+
+    row_start = np.round(rows.min(axis=0))
+    col_start = np.round(cols.min(axis=0))
+    row_stop = row_start + np.round(rows.max(axis=0) - rows.min(axis=0))
+    col_stop = col_start + np.round(cols.max(axis=0) - cols.min(axis=0))
+
+    if shape is not None:
+        row_start, row_stop = (np.clip(r, 0, shape[0])
+                               for r in (row_start, row_stop))
+        col_start, col_stop = (np.clip(c, 0, shape[1])
+                               for c in (col_start, col_stop))
+
+    return np.stack([row_start, col_start, row_stop - row_start,
+                     col_stop - col_start], axis=-1).astype(np.int64)
+
+
+class BlockReader:
+    """
+    Reads many pixel windows, decoding each GeoTiff block only once
+
+    The windows are known upfront, so we count how many of them need each
+    block, keep decoded blocks around for as long as some window still needs
+    them, and drop them right after. Read the windows in `order` to keep the
+    number of blocks held in memory at once low.
+
+    Parameters
+    ----------
+    reader : rasterio.DatasetReader
+        Open raster to read from.
+
+    windows : array-like
+        Integer (row_off, col_off, height, width) rows, within the image.
+
+    max_run : int, default: 16
+        Up to how many adjacent blocks in a row to fetch in one read.
+    """
+
+    def __init__(self, reader, windows, max_run=16):
+        self.reader = reader
+        self.max_run = max_run
+        self.windows = np.asarray(windows, dtype=np.int64).reshape(-1, 4)
+        self.block_shape = reader.block_shapes[0]
+        self.reads = 0
+
+        self._blocks = {}
+        self._refcounts = Counter()
+        for window in self.windows:
+            self._refcounts.update(self._block_ids(window))
+
+    @property
+    def order(self):
+        """Window indices sorted by the block row and column they start in"""
+
+        block_rows = self.windows[:, 0] // self.block_shape[0]
+        block_cols = self.windows[:, 1] // self.block_shape[1]
+
+        return np.lexsort((block_cols, block_rows))
+
+    def _block_ids(self, window):
+        """(block row, block col) pairs a window overlaps"""
+
+        row_off, col_off, height, width = window
+        if not height or not width:
+            return []
+
+        block_h, block_w = self.block_shape
+        return [(block_row, block_col)
+                for block_row in range(row_off // block_h,
+                                       (row_off + height - 1) // block_h + 1)
+                for block_col in range(col_off // block_w,
+                                       (col_off + width - 1) // block_w + 1)]
+
+    def _block(self, block_id):
+        """A decoded block, read from the raster on first request"""
+
+        if block_id not in self._blocks:
+            self._read_run(*block_id)
+
+        return self._blocks[block_id]
+
+    def _read_run(self, block_row, block_col):
+        """
+        Reads a block together with the still needed blocks to its right
+
+        Neighbouring blocks are merged into a single read call, which saves
+        on the per-read overhead for windows spanning many blocks.
+        """
+
+        from rasterio.windows import Window
+
+        run = 1
+        while (run < self.max_run
+               and self._refcounts[block_row, block_col + run] > 0
+               and (block_row, block_col + run) not in self._blocks):
+            run += 1
+
+        block_h, block_w = self.block_shape
+        row_off, col_off = block_row * block_h, block_col * block_w
+        height = min(block_h, self.reader.height - row_off)
+        width = min(block_w * run, self.reader.width - col_off)
+        data = self.reader.read(1, window=Window(col_off, row_off, width,
+                                                 height))
+        self.reads += 1
+
+        for i in range(run):
+            self._blocks[block_row, block_col + i] = \
+                data[:, i * block_w:(i + 1) * block_w]
+
+    def read(self, i):
+        """Assembles the i-th window out of its blocks"""
+
+        row_off, col_off, height, width = self.windows[i]
+        out = np.empty((height, width), dtype=self.reader.dtypes[0])
+
+        block_h, block_w = self.block_shape
+        for block_id in self._block_ids(self.windows[i]):
+            block = self._block(block_id)
+            block_row, block_col = block_id[0] * block_h, block_id[1] * block_w
+
+            # overlap of the window and the block, in image coordinates
+            top, left = max(row_off, block_row), max(col_off, block_col)
+            bottom = min(row_off + height, block_row + block.shape[0])
+            right = min(col_off + width, block_col + block.shape[1])
+            out[top - row_off:bottom - row_off,
+                left - col_off:right - col_off] = \
+                block[top - block_row:bottom - block_row,
+                      left - block_col:right - block_col]
+
+            self._refcounts[block_id] -= 1
+            if not self._refcounts[block_id]:
+                del self._blocks[block_id], self._refcounts[block_id]
+
+        return out
+
+    def read_all(self):
+        """All the windows, in their original order"""
+
+        out = [None] * len(self.windows)
+        for i in self.order:
+            out[i] = self.read(i)
+
+        return out
+
+
+def _init_worker(source):
+    """Process pool initializer - opens the raster once per worker"""
+
+    import rasterio
+
+    global _WORKER_READER  # pylint: disable=global-statement
+    _WORKER_READER = rasterio.open(source)
+
+
+def _downsample_window(window, factor, reducer, cval, reader=None):
+    """Reads a single window and reduces it"""
+
+    from rasterio.windows import Window
+
+    reader = reader or _WORKER_READER
+    row_off, col_off, height, width = window
+    data = reader.read(1, window=Window(col_off, row_off, width, height))
+
+    return window, reduce_blocks(data, factor, reducer, cval)
+
+
+def downsample_raster(source, factor, out=None, reducer=np.mean, cval=0,
+                      max_memory=256 * 1024**2, processes=1):
+    """
+    Downsamples a raster window by window, in bounded memory
+
+    Parameters
+    ----------
+    source : str
+        Path or URL of the raster.
+
+    factor : int
+        Downscaling factor along both axes.
+
+    out : np.ndarray, optional
+        Output array of shape ceil(height / factor), ceil(width / factor),
+        e.g. an `np.lib.format.open_memmap` to write into a .npy file
+        incrementally. A float64 array is made if not given.
+
+    reducer : callable, default: np.mean
+        Called as `reducer(blocks, axis=(1, 3))`, e.g. np.max, np.median.
+
+    cval : float, default: 0
+        Value to pad the image edges with if not divisible by the factor.
+
+    max_memory : int, default: 256 MB
+        Rough peak memory budget for the input windows, in bytes, shared by
+        all the worker processes.
+
+    processes : int, default: 1
+        Number of worker processes; 1 reads in the calling process.
+
+    Returns
+    -------
+    out : np.ndarray
+    """
+
+    import rasterio
+
+    with rasterio.open(source) as reader:
+        height, width = reader.height, reader.width
+        block_shape = reader.block_shapes[0]
+        itemsize = np.dtype(reader.dtypes[0]).itemsize
+
+        if out is None:
+            out = np.empty((-(-height // factor), -(-width // factor)))
+
+        # the reducer casts the windows to float64, hence the extra 8 bytes;
+        # with several processes, up to two windows per worker are in flight
+        in_flight = 1 if processes == 1 else 2 * processes
+        max_pixels = max_memory // (in_flight * (itemsize + 8))
+        windows = plan_windows(height, width, block_shape, max_pixels, factor)
+
+        def _write(window, reduced):
+            row_off, col_off = window[0] // factor, window[1] // factor
+            out[row_off:row_off + reduced.shape[0],
+                col_off:col_off + reduced.shape[1]] = reduced
+
+        if processes == 1:
+            for window in windows:
+                _write(*_downsample_window(window, factor, reducer, cval,
+                                           reader))
+            return out
+
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                             initargs=(source,)) as executor:
+        pending = []
+        for window in windows:
+            # don't queue up more windows than we've budgeted memory for
+            if len(pending) >= in_flight:
+                _write(*pending.pop(0).result())
+            pending.append(executor.submit(_downsample_window, window,
+                                           factor, reducer, cval))
+        for future in pending:
+            _write(*future.result())
+
+    return out
@@ -0,0 +1,286 @@
+"""
+Bounded on-disk cache for warped cutouts
+
+Files are keyed by a hash of all the parameters that went into making them,
+written atomically, evicted least-recently-used first, and concurrent misses
+for the same key are coalesced so that only one of them does the work.
+"""
+
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+from moon import metrics
+
+# a cache key, and a single extension: the files of a cache, or of one with
+# another suffix from before a format change
+_ENTRY_FNAME = re.compile(r"^([0-9a-f]{64})(\.[A-Za-z0-9]+)$")
+# the temporary files of `CutoutCache._produce`, and whatever the producers
+# make next to them (e.g. the intermediate GeoTiffs of the COGs)
+_PART_FNAME = re.compile(r"^[0-9a-f]{64}(\.[A-Za-z0-9]+)\.\d+\.\d+\.part")
+
+# temporary files older than this are taken for leftovers of crashed
+# producers; younger ones might still be written by another process
+STALE_PART_SECONDS = 3600
+
+
+def cache_key(**params):
+    """Content-addressed key: a hash of all the (JSON-able) parameters"""
+
+    blob = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+
+class _InFlight:
+    """A single pending computation that other threads can wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+
+class CutoutCache:
+    """
+    Least-recently-used file cache with a size and entry count cap
+
+    Parameters
+    ----------
+    cache_dir : str
+        Folder to keep the files in, created if missing.
+
+    max_bytes : int, optional
+        Total size cap on the cached files.
+
+    max_entries : int, optional
+        Cap on the number of cached files.
+
+    suffix : str, default: '.tif'
+        File extension of the cached files.
+
+    name : str, default: 'cutout'
+        Prefix of the hit/miss counters reported to `moon.metrics`.
+    """
+
+    def __init__(self, cache_dir, max_bytes=None, max_entries=None,
+                 suffix='.tif', name='cutout'):
+        # absolute, as Flask's send_file resolves relative paths against the
+        # app root rather than the working directory
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.suffix = suffix
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        # key -> size in bytes, ordered from least to most recently used
+        self._entries = {}
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        """
+        Picks up files left from earlier runs, oldest access first
+
+        Stale temporary files, and entries of another suffix (e.g. from
+        before a format change), are removed, as they would otherwise take
+        up space outside of the caps for good. Anything else in the folder
+        is left alone.
+        """
+
+        found = []
+        for fname in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, fname)
+            entry, part = _ENTRY_FNAME.match(fname), _PART_FNAME.match(fname)
+            if not (entry or part) or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            if part:
+                if (part.group(1) == self.suffix and time.time()
+                        - stat.st_mtime > STALE_PART_SECONDS):
+                    self._remove(path)
+            elif entry.group(2) == self.suffix:
+                found.append((stat.st_mtime, entry.group(1), stat.st_size))
+            else:
+                self._remove(path)
+
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+        self._evict()
+
+    @staticmethod
+    def _remove(path):
+        """Deletes a file, unless someone else already did"""
+
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def path(self, key):
+        """Where the file for a given key lives"""
+
+        return os.path.join(self.cache_dir, key + self.suffix)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def total_bytes(self):
+        """Size of all cached files"""
+
+        return sum(self._entries.values())
+
+    def _touch(self, key):
+        """Marks a key as the most recently used one; call under the lock"""
+
+        self._entries[key] = self._entries.pop(key)
+        try:
+            # keeps the LRU order across restarts, see _scan
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            # someone cleaned up the folder behind our back
+            del self._entries[key]
+            return False
+
+        return True
+
+    def _evict(self):
+        """Drops least recently used files until within caps; under lock"""
+
+        def _over_cap():
+            if self.max_entries is not None:
+                if len(self._entries) > self.max_entries:
+                    return True
+            if self.max_bytes is not None:
+                return self.total_bytes > self.max_bytes
+            return False
+
+        while self._entries and _over_cap():
+            key = next(iter(self._entries))
+            del self._entries[key]
+            self._remove(self.path(key))
+
+    def get(self, key):
+        """Returns a cached file path or None, counting hits and misses"""
+
+        with self._lock:
+            if key in self._entries and self._touch(key):
+                self.hits += 1
+                metrics.count(f"{self.name}_cache_hits")
+                return self.path(key)
+            self.misses += 1
+            metrics.count(f"{self.name}_cache_misses")
+            return None
+
+    def get_or_create(self, key, producer):
+        """
+        Returns a path to the cached file, making it on a miss
+
+        Parameters
+        ----------
+        key : str
+            Cache key, e.g. from `cache_key`.
+
+        producer : callable
+            Called as `producer(tmp_path)`, should write the file there.
+            It is then atomically renamed into the cache. Only one thread
+            runs the producer for a given key, the others wait for it.
+
+        Returns
+        -------
+        path : str
+
+        Notes
+        -----
+        The file can be evicted by another thread as soon as this returns;
+        use `open_or_create` to serve it.
+        """
+
+        return self._get_or_create(key, producer, lambda path: path)
+
+    def open_or_create(self, key, producer):
+        """
+        Same as `get_or_create`, but returns the file opened for reading
+
+        The file is opened under the cache lock, so evictions from other
+        threads (or clean-ups by other processes) can't pull it out from
+        under the caller: on POSIX an open file stays readable after it is
+        unlinked. The caller is responsible for closing it.
+
+        Returns
+        -------
+        f : file object
+        """
+
+        return self._get_or_create(key, producer,
+                                   lambda path: open(path, 'rb'))
+
+    def _get_or_create(self, key, producer, opener):
+        """Looks a key up, making the file on a miss; `opener` runs locked"""
+
+        while True:
+            with self._lock:
+                if key in self._entries and self._touch(key):
+                    try:
+                        result = opener(self.path(key))
+                    except FileNotFoundError:
+                        # gone between the touch and the open
+                        del self._entries[key]
+                    else:
+                        self.hits += 1
+                        metrics.count(f"{self.name}_cache_hits")
+                        return result
+
+                in_flight = self._in_flight.get(key)
+                if in_flight is None:
+                    self.misses += 1
+                    metrics.count(f"{self.name}_cache_misses")
+                    in_flight = self._in_flight[key] = _InFlight()
+                    leader = True
+                else:
+                    leader = False
+
+            if not leader:
+                in_flight.done.wait()
+                if in_flight.error is not None:
+                    raise in_flight.error
+                # loop around - the file should be there now, unless it got
+                # evicted in the meantime, in which case we'll make it anew
+                continue
+
+            try:
+                return self._produce(key, producer, opener)
+            except BaseException as err:
+                in_flight.error = err
+                raise
+            finally:
+                with self._lock:
+                    del self._in_flight[key]
+                in_flight.done.set()
+
+    def _produce(self, key, producer, opener):
+        """Runs the producer into a temporary file and moves it in place"""
+
+        path = self.path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+        try:
+            producer(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = os.path.getsize(path)
+            # before the eviction, which may well drop the new file itself
+            result = opener(path)
+            self._evict()
+
+        return result
@@ -0,0 +1,306 @@
+"""
+Column store for the IAU feature tables, with a name index on top
+
+The csv tables are parsed once into typed NumPy columns and cached as a
+binary .npz file next to them, so the later loads are just a few array reads.
+"""
+
+import os
+import csv
+from collections import defaultdict
+import numpy as np
+
+# typed columns, everything else but the feature name is a categorical
+FLOAT_COLUMNS = ("diameter", "center_latitude", "center_longitude")
+NAME_COLUMN = "feature_name"
+
+# bump this if the layout of the cached .npz files changes
+_CACHE_VERSION = 1
+
+
+def _csv_signature(fname):
+    """Size and modification time of the csv, to tell if the cache is stale"""
+
+    stat = os.stat(fname)
+    return np.array([_CACHE_VERSION, stat.st_size, stat.st_mtime_ns],
+                    dtype=np.int64)
+
+
+def read_iau_table(fname):
+    """
+    Lowercase column names and rows of strings of an IAU csv table
+
+    The only csv parser of the tables, both the column store and the
+    dictionaries of `moon.features.read_iau_csv` are made from its output.
+    The column names are as in the header, trailing empty one included.
+    """
+
+    with open(fname, newline='') as csvfile:
+        csv_row_reader = csv.reader(csvfile, delimiter=',', quotechar='"')
+        column_names = [c_n.lower() for c_n in next(csv_row_reader)]
+        rows = list(csv_row_reader)
+
+    return column_names, rows
+
+
+class FeatureCatalogue:
+    """
+    Lunar features as a set of NumPy columns
+
+    Float columns are stored as float64 arrays, the names as a unicode array,
+    and all the other (mostly repetitive) string columns as integer codes
+    into an array of their unique values.
+
+    Parameters
+    ----------
+    columns : dict
+        Column name -> np.ndarray; categorical columns are stored twice, as
+        `<name>:codes` and `<name>:categories` entries.
+
+    column_names : sequence of str
+        Column names, in the order of the csv header.
+    """
+
+    def __init__(self, columns, column_names):
+        self._columns = columns
+        # plain str, the ones loaded from the .npz cache are np.str_
+        self.column_names = tuple(str(name) for name in column_names)
+        self.name_index = NameIndex(self[NAME_COLUMN])
+
+    @classmethod
+    def from_csv(cls, fname, cache=True):
+        """
+        Loads an IAU csv table, through its binary cache if possible
+
+        Parameters
+        ----------
+        fname : str
+            Path to the csv table.
+
+        cache : bool, default: True
+            Whether to read (and, if stale or missing, write) the parsed
+            table as an .npz file next to the csv.
+        """
+
+        cache_fname = os.path.splitext(fname)[0] + '.npz'
+        signature = _csv_signature(fname)
+
+        if cache:
+            try:
+                with np.load(cache_fname, allow_pickle=False) as npz:
+                    if np.array_equal(npz['_signature'], signature):
+                        return cls({key: npz[key] for key in npz.files
+                                    if not key.startswith('_')},
+                                   npz['_column_names'])
+            except (OSError, KeyError, ValueError):
+                # missing, stale, or broken cache - just reparse the csv
+                pass
+
+        catalogue = cls(*cls._parse_csv(fname))
+
+        if cache:
+            catalogue._save(cache_fname, signature)
+
+        return catalogue
+
+    @staticmethod
+    def _parse_csv(fname):
+        """Reads the csv into typed columns"""
+
+        column_names, rows = read_iau_table(fname)
+
+        # the IAU tables have a trailing comma, i.e. an unnamed empty column
+        keep = [i for i, name in enumerate(column_names) if name]
+        column_names = [column_names[i] for i in keep]
+        raw_columns = {name: [row[i] for row in rows]
+                       for i, name in zip(keep, column_names)}
+
+        columns = {}
+        for name, values in raw_columns.items():
+            if name in FLOAT_COLUMNS:
+                columns[name] = np.array(values, dtype=float)
+            elif name == NAME_COLUMN:
+                columns[name] = np.array(values, dtype=str)
+            else:
+                categories, codes = np.unique(np.array(values, dtype=str),
+                                              return_inverse=True)
+                columns[f"{name}:categories"] = categories
+                columns[f"{name}:codes"] = codes.astype(np.int32)
+
+        return columns, column_names
+
+    def _save(self, cache_fname, signature):
+        """Writes the columns into an .npz file, atomically"""
+
+        tmp_fname = f"{cache_fname}.{os.getpid()}.part.npz"
+        try:
+            np.savez(tmp_fname, _signature=signature,
+                     _column_names=np.array(self.column_names),
+                     **self._columns)
+            os.replace(tmp_fname, cache_fname)
+        except OSError:
+            # read-only table folder? not a big deal, we just won't cache
+            pass
+        finally:
+            if os.path.exists(tmp_fname):
+                os.remove(tmp_fname)
+
+    def __len__(self):
+        return self._columns[NAME_COLUMN].size
+
+    def __getitem__(self, column_name):
+        """Returns a column as an array, decoding categoricals"""
+
+        try:
+            return self._columns[column_name]
+        except KeyError:
+            pass
+
+        return self.categories(column_name)[self.codes(column_name)]
+
+    def codes(self, column_name):
+        """Integer codes of a categorical column"""
+
+        return self._columns[f"{column_name}:codes"]
+
+    def categories(self, column_name):
+        """Unique values of a categorical column"""
+
+        return self._columns[f"{column_name}:categories"]
+
+    def row(self, i):
+        """A single feature as a dictionary of Python values"""
+
+        row_dict = {}
+        for name in self.column_names:
+            if name in self._columns:
+                row_dict[name] = self._columns[name][i].item()
+            else:
+                code = self.codes(name)[i]
+                row_dict[name] = self.categories(name)[code].item()
+
+        return row_dict
+
+    def index(self, feature_name):
+        """Row index of a feature, by its case-insensitive name"""
+
+        return self.name_index.index(feature_name)
+
+
+class NameIndex:
+    """
+    Case-insensitive feature name index for exact, prefix, and fuzzy lookup
+
+    Prefix search is a binary search over the sorted lowercase names, while
+    the typo-tolerant search first narrows down the candidates by common
+    letter bigrams and only then computes the edit distances.
+
+    Parameters
+    ----------
+    names : array-like of str
+        Feature names; lookups return positions in this array.
+    """
+
+    def __init__(self, names):
+        lowercase = np.char.lower(np.asarray(names, dtype=str))
+        self._order = np.argsort(lowercase, kind='stable')
+        self._sorted = lowercase[self._order]
+        self._lengths = np.char.str_len(lowercase)
+        self._lowercase = lowercase
+        self._bigram_index = None
+
+    @property
+    def bigram_index(self):
+        """Bigram -> positions of the names that have it, made on first use"""
+
+        if self._bigram_index is None:
+            bigram_lists = defaultdict(list)
+            for i, name in enumerate(self._lowercase.tolist()):
+                for bigram in set(self._bigrams(name)):
+                    bigram_lists[bigram].append(i)
+            self._bigram_index = {
+                bigram: np.array(positions, dtype=np.int32)
+                for bigram, positions in bigram_lists.items()}
+
+        return self._bigram_index
+
+    def __len__(self):
+        return self._sorted.size
+
+    @staticmethod
+    def _bigrams(name):
+        """Letter pairs of a padded name: "abc" -> ^a, ab, bc, c$"""
+
+        padded = f"^{name}$"
+        return [padded[i:i + 2] for i in range(len(padded) - 1)]
+
+    def index(self, name):
+        """Position of an exact (case-insensitive) name; KeyError if absent"""
+
+        name = name.lower()
+        pos = np.searchsorted(self._sorted, name)
+        if pos < self._sorted.size and self._sorted[pos] == name:
+            return int(self._order[pos])
+
+        raise KeyError(name)
+
+    def prefix(self, prefix, limit=None):
+        """Positions of the names starting with a prefix, alphabetically"""
+
+        prefix = prefix.lower()
+        start = np.searchsorted(self._sorted, prefix, side='left')
+        # all names with the prefix sort before prefix + the largest char
+        stop = np.searchsorted(self._sorted, prefix + chr(0x10ffff),
+                               side='left')
+        if limit is not None:
+            stop = min(stop, start + limit)
+
+        return self._order[start:stop]
+
+    def fuzzy(self, name, max_distance=2, limit=10):
+        """
+        Positions of names within `max_distance` edits, closest first
+
+        Candidates are the names sharing enough bigrams with the query: a
+        single edit can break at most two bigrams of a padded name.
+        """
+
+        name = name.lower()
+        bigrams = set(self._bigrams(name))
+        bigram_index = self.bigram_index
+        hits = [bigram_index[b] for b in bigrams if b in bigram_index]
+        if not hits:
+            return np.array([], dtype=self._order.dtype)
+
+        shared = np.bincount(np.concatenate(hits), minlength=len(self))
+        min_shared = len(bigrams) - 2 * max_distance
+        candidates = np.flatnonzero(
+            (shared >= max(min_shared, 1))
+            & (np.abs(self._lengths - len(name)) <= max_distance))
+
+        found = []
+        for pos in candidates:
+            dist = _bounded_levenshtein(name, self._lowercase[pos],
+                                        max_distance)
+            if dist <= max_distance:
+                found.append((dist, self._lowercase[pos], pos))
+        found.sort()
+
+        return np.array([pos for _, _, pos in found[:limit]],
+                        dtype=self._order.dtype)
+
+
+def _bounded_levenshtein(source, target, max_distance):
+    """Edit distance, or max_distance + 1 once it's clear it's larger"""
+
+    previous = list(range(len(target) + 1))
+    for i, source_char in enumerate(source, 1):
+        current = [i]
+        for j, target_char in enumerate(target, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (source_char != target_char)))
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+
+    return previous[-1]
@@ -14,12 +14,18 @@ def _parent_dir_abspath(folder):
 class Paths:
     """Paths, folders, URLs, and that sort of thing"""
 
-    data_dir = _parent_dir_abspath("data")
+    # MOON_DATA_DIR points everything at another copy of the data, e.g. the
+    # synthetic GeoTiff from moon.synthetic the benchmarks run on
+    data_dir = os.environ.get("MOON_DATA_DIR") or _parent_dir_abspath("data")
     table_dir = _parent_dir_abspath("tables")
     fig_dir = _parent_dir_abspath("figures")
+    # block cache for the remote GeoTiff, see moon.remote
+    remote_cache_dir = os.path.join(data_dir, "remote_cache")
 
     tif_fname = "Lunar_LRO_LOLA_Global_LDEM_118m_Mar2014.tif"
     tif_fname_small = "Lunar_LRO_LOLA_Downsampled.npy"
+    # uncompressed memory-mappable copy of the above, see moon.rawstore
+    raw_fname = "Lunar_LRO_LOLA_Global_LDEM_118m_Mar2014.int16"
 
     # Reference: International Astronomical Union (IAU) Planetary Gazetteer
     # CSV data downloaded from:  https://planetarynames.wr.usgs.gov/
@@ -48,6 +54,8 @@ class Constants:
     # they seem to use a spherical model, not an oblate spheroid above
     lola_dem_moon_radius = 1737400
     lola_dem_scaling_factor = 0.5
+    # pixel size at the equator, 2 * pi * 1737400 m over the 92160 px width
+    lola_dem_resolution = 118.4505876
 
     @classmethod
     def local_radius(cls, pixel_value, absolute=False):
@@ -0,0 +1,342 @@
+"""
+Global terrain products of the LOLA DEM: slope, aspect, hillshade, roughness
+
+The DEM is cut into block-aligned windows (see `moon.blocks.plan_windows`),
+each read with a halo of extra pixels around it, so that the 3 x 3 kernels
+see the same neighbours at the window edges as anywhere else. The halo wraps
+around the +-180 degree meridian, and is padded with the edge rows at the
+poles. Windows are processed on a process pool, and the results are written
+into tiled GeoTiffs as they come, in bounded memory.
+
+Call it from command line as `python -m moon.derived`, e.g.:
+$ python -m moon.derived data/derived --products slope hillshade -j 8
+"""
+
+import os
+import argparse
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from moon.config import Paths, Constants
+from moon import terrain
+from moon.blocks import plan_windows
+
+# per-process raster handle for the pool workers, see `_init_worker`
+_WORKER_READER = None
+
+# rough peak memory per window pixel: the int16 input, its float64 copy and
+# the gradients, plus the float64 output of every product
+_BYTES_PER_PIXEL = 48
+_BYTES_PER_PRODUCT_PIXEL = 16
+
+
+def _hillshade(elevation, dx, dy, **kwargs):
+    """Hillshade scaled to 0-255, see `moon.terrain.hillshade`"""
+
+    return np.round(255 * terrain.hillshade(elevation, dx, dy, **kwargs))
+
+
+def _roughness(elevation, dx, dy):  # pylint: disable=unused-argument
+    """Roughness in a 3 x 3 neighbourhood, see `moon.terrain.roughness`"""
+
+    return terrain.roughness(elevation)
+
+
+# kernel called as kernel(elevation, dx, dy, **options), the halo it needs,
+# and the output GeoTiff dtype and nodata value
+Product = namedtuple("Product", ["kernel", "halo", "dtype", "nodata"])
+
+PRODUCTS = {
+    "slope": Product(terrain.slope, 1, "float32", None),
+    "aspect": Product(terrain.aspect, 1, "float32", np.nan),  # NaN if flat
+    "hillshade": Product(_hillshade, 1, "uint8", None),
+    "roughness": Product(_roughness, 1, "float32", None),
+}
+
+
+def _open(source):
+    """Opens a local raster, or a remote one through `moon.remote`"""
+
+    if source.startswith(("s3://", "http://", "https://")):
+        from moon.remote import open_remote
+        return open_remote(source)
+
+    import rasterio
+    return rasterio.open(source)
+
+
+def read_with_halo(reader, window, halo):
+    """
+    Reads a window with a halo of pixels around it
+
+    Columns wrap around the image sides, as the DEM spans the full 360
+    degrees of longitude, and rows past the top or bottom edges (the poles)
+    repeat the edge rows.
+
+    Parameters
+    ----------
+    reader : rasterio.DatasetReader
+        Open raster to read from.
+
+    window : tuple of int
+        (row_off, col_off, height, width) of the window, within the image.
+
+    halo : int
+        Halo width in pixels.
+
+    Returns
+    -------
+    data : np.ndarray
+        Of shape (height + 2 * halo, width + 2 * halo).
+    """
+
+    from rasterio.windows import Window
+
+    row_off, col_off, height, width = window
+    top = max(row_off - halo, 0)
+    bottom = min(row_off + height + halo, reader.height)
+
+    # the columns as up to three contiguous runs: whatever wraps around the
+    # left edge, the bulk of it, and whatever wraps around the right edge
+    cols = np.arange(col_off - halo, col_off + width + halo) % reader.width
+    breaks = np.flatnonzero(np.diff(cols) != 1) + 1
+    runs = [(run[0], run.size) for run in np.split(cols, breaks)]
+
+    data = np.concatenate([
+        reader.read(1, window=Window(start, top, size, bottom - top))
+        for start, size in runs], axis=1)
+
+    return np.pad(data, ((top - (row_off - halo),
+                          row_off + height + halo - bottom), (0, 0)),
+                  mode='edge')
+
+
+def _row_latitudes(transform, row_off, height, radius):
+    """Latitudes of pixel row centres of an equirectangular raster"""
+
+    rows = np.arange(row_off, row_off + height) + 0.5
+    return np.degrees((transform.f + rows * transform.e) / radius)
+
+
+def derive_window(reader, window, products, options=None,
+                  radius=Constants.lola_dem_moon_radius):
+    """
+    Computes terrain products over a single window
+
+    Parameters
+    ----------
+    reader : rasterio.DatasetReader
+        Open raster of raw LOLA DEM values, in equirectangular projection.
+
+    window : tuple of int
+        (row_off, col_off, height, width) of the window.
+
+    products : list of str
+        Keys of `PRODUCTS`.
+
+    options : dict, optional
+        Per-product keyword arguments, e.g. {"hillshade": {"azimuth": 270}}.
+
+    radius : float
+        Sphere radius of the projection, in meters.
+
+    Returns
+    -------
+    window : tuple of int
+        Same as the input, for matching up results from a pool.
+
+    results : dict
+        Product name -> array of the window shape, in the product dtype.
+    """
+
+    options = options or {}
+    halo = max(PRODUCTS[name].halo for name in products)
+    row_off, _, height, width = window
+
+    data = read_with_halo(reader, window, halo)
+    elevation = Constants.local_radius(data)
+
+    # pixel sizes in meters, the widths shrinking towards the poles
+    transform = reader.transform
+    lats = _row_latitudes(transform, row_off - halo, height + 2 * halo,
+                          radius)
+    lon_step, lat_step = (np.degrees(transform.a / radius),
+                          np.degrees(transform.e / radius))
+    dx, dy = terrain.lonlat_pixel_sizes(lats, lon_step, lat_step, radius)
+
+    results = {}
+    for name in products:
+        product = PRODUCTS[name]
+        out = product.kernel(elevation, dx, dy, **options.get(name, {}))
+        results[name] = out[halo:halo + height, halo:halo + width].astype(
+            product.dtype)
+
+    return window, results
+
+
+def _init_worker(source):
+    """Process pool initializer - opens the raster once per worker"""
+
+    global _WORKER_READER  # pylint: disable=global-statement
+    _WORKER_READER = _open(source)
+
+
+def _derive_window(window, products, options):
+    """Pool task for a single window"""
+
+    return derive_window(_WORKER_READER, window, products, options)
+
+
+def _output_profile(reader, product, compress):
+    """GeoTiff profile of a product, tiled the same way as the source"""
+
+    block_h, block_w = reader.block_shapes[0]
+    profile = {"driver": "GTiff", "width": reader.width,
+               "height": reader.height, "count": 1,
+               "dtype": product.dtype, "nodata": product.nodata,
+               "crs": reader.crs, "transform": reader.transform,
+               "tiled": True, "blockxsize": block_w, "blockysize": block_h,
+               "compress": compress, "BIGTIFF": "IF_SAFER"}
+    if compress:
+        # floating point predictor for the floats, differencing otherwise
+        profile["predictor"] = 3 if product.dtype.startswith("float") else 2
+
+    return profile
+
+
+def make_derived(out_dir, products=tuple(PRODUCTS),
+                 source=os.path.join(Paths.data_dir, Paths.tif_fname),
+                 options=None, max_memory=512 * 1024**2, processes=1,
+                 compress="DEFLATE", overwrite=False):
+    """
+    Writes global terrain products of the LOLA DEM into GeoTiffs
+
+    All the products are computed off a single pass over the DEM.
+
+    Parameters
+    ----------
+    out_dir : str
+        Folder to write `<product>.tif` files into.
+
+    products : sequence of str
+        Keys of `PRODUCTS`, all of them by default.
+
+    source : str
+        Path or URL of the DEM GeoTiff.
+
+    options : dict, optional
+        Per-product keyword arguments, e.g. {"hillshade": {"azimuth": 270}}.
+
+    max_memory : int, default: 512 MB
+        Rough peak memory budget for the windows in flight, in bytes, shared
+        by all the worker processes.
+
+    processes : int, default: 1
+        Number of worker processes; 1 computes in the calling process.
+
+    compress : str, default: "DEFLATE"
+        Output GeoTiff compression.
+
+    overwrite : bool, default: False
+        Whether to remake products that already exist.
+
+    Returns
+    -------
+    fnames : dict
+        Product name -> output path.
+    """
+
+    import rasterio
+    from rasterio.windows import Window
+
+    unknown = set(products) - set(PRODUCTS)
+    if unknown:
+        raise ValueError(f"Unknown products: {', '.join(sorted(unknown))}")
+
+    os.makedirs(out_dir, exist_ok=True)
+    fnames = {name: os.path.join(out_dir, f"{name}.tif")
+              for name in products}
+    todo = [name for name in products
+            if overwrite or not os.path.exists(fnames[name])]
+    if not todo:
+        return fnames
+
+    in_flight = 1 if processes == 1 else 2 * processes
+    max_pixels = max_memory // (in_flight * (
+        _BYTES_PER_PIXEL + _BYTES_PER_PRODUCT_PIXEL * len(todo)))
+
+    reader = _open(source)
+    writers = {}
+    try:
+        windows = plan_windows(reader.height, reader.width,
+                               reader.block_shapes[0], max_pixels)
+        for name in todo:
+            writers[name] = rasterio.open(
+                f"{fnames[name]}.part", 'w',
+                **_output_profile(reader, PRODUCTS[name], compress))
+
+        def _write(window, results):
+            row_off, col_off, height, width = window
+            for name, result in results.items():
+                writers[name].write(result, 1, window=Window(
+                    col_off, row_off, width, height))
+
+        if processes == 1:
+            for window in windows:
+                _write(*derive_window(reader, window, todo, options))
+        else:
+            with ProcessPoolExecutor(max_workers=processes,
+                                     initializer=_init_worker,
+                                     initargs=(source,)) as executor:
+                pending = []
+                for window in windows:
+                    # don't queue up more than the memory budget allows
+                    if len(pending) >= in_flight:
+                        _write(*pending.pop(0).result())
+                    pending.append(executor.submit(_derive_window, window,
+                                                   todo, options))
+                for future in pending:
+                    _write(*future.result())
+    finally:
+        reader.close()
+        for writer in writers.values():
+            writer.close()
+
+    # only now, so that an interrupted run doesn't leave finished-looking
+    # but incomplete products behind
+    for name in todo:
+        os.replace(f"{fnames[name]}.part", fnames[name])
+
+    return fnames
+
+
+def main(argv=None):
+    """Command line entry point for the global terrain products"""
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument("out_dir", help="folder to write the GeoTiffs into")
+    parser.add_argument("--products", nargs="+", choices=list(PRODUCTS),
+                        default=list(PRODUCTS))
+    parser.add_argument("--source",
+                        default=os.path.join(Paths.data_dir, Paths.tif_fname))
+    parser.add_argument("-j", "--processes", type=int, default=1)
+    parser.add_argument("--max-memory", type=int, default=512,
+                        help="memory budget in MB")
+    parser.add_argument("--azimuth", type=float, default=315,
+                        help="hillshade light direction, degrees")
+    parser.add_argument("--altitude", type=float, default=45,
+                        help="hillshade light elevation, degrees")
+    parser.add_argument("--overwrite", action="store_true")
+    args = parser.parse_args(argv)
+
+    options = {"hillshade": {"azimuth": args.azimuth,
+                             "altitude": args.altitude}}
+    fnames = make_derived(args.out_dir, args.products, args.source, options,
+                          args.max_memory * 1024**2, args.processes,
+                          overwrite=args.overwrite)
+    for fname in fnames.values():
+        print(f"Wrote {fname}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,19 @@
 """Per-feature classes and helper methods"""
 
 import os
-import csv
+import threading
+import numpy as np
 from moon.config import Paths
+from moon.catalogue import FeatureCatalogue, NAME_COLUMN, read_iau_table
 
 
 def read_iau_csv(fname):
     """Reads Lunar feature csv file into a list of dictionaries"""
 
-    with open(fname, newline='') as csvfile:
-        csv_row_reader = csv.reader(csvfile, delimiter=',', quotechar='"')
-        column_names = [c_n.lower() for c_n in next(csv_row_reader)]
-        for row_data in csv_row_reader:
-            row_dict = dict(zip(column_names, row_data))
-            yield row_dict['feature_name'], row_dict
+    column_names, rows = read_iau_table(fname)
+    for row_data in rows:
+        row_dict = dict(zip(column_names, row_data))
+        yield row_dict['feature_name'], row_dict
 
 
 class Crater(dict):
@@ -35,26 +35,124 @@ class Crater(dict):
             setattr(self, key.lower(), value)
 
 
+class _LazyClassAttribute:
+    """Class attribute that runs `factory(owner)` on first access only"""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.__doc__ = factory.__doc__
+        self._value = None
+        self._lock = threading.Lock()
+
+    def __get__(self, instance, owner):
+        if self._value is None:
+            with self._lock:
+                if self._value is None:
+                    self._value = self.factory(owner)
+        return self._value
+
+
+def _parse_iau_data(_):
+    """Lowercase name -> Crater dictionary of all the IAU features"""
+
+    return {name.lower(): Crater(feature) for name, feature in read_iau_csv(
+        os.path.join(Paths.table_dir, Paths.iau_features_fname))}
+
+
+def _load_iau_catalogue(_):
+    """All the IAU features as a column store, see `FeatureCatalogue`"""
+
+    return FeatureCatalogue.from_csv(
+        os.path.join(Paths.table_dir, Paths.iau_features_fname))
+
+
+def _build_spatial_index(owner):
+    """Spatial index over feature centres, in `feature_names` order"""
+
+    from moon.spatial import FeatureIndex
+
+    catalogue = owner.catalogue
+    return FeatureIndex(catalogue["center_longitude"],
+                        catalogue["center_latitude"], catalogue["diameter"])
+
+
 class LunarFeatures:
     """Helper class assisting in finding lunar features"""
 
-    # Keeping as class attribute?
-    # Pros: gets executed at import time
-    # Cons: gets executed at import time
-    iau_data = {
-        name.lower(): Crater(feature)
-        for name, feature in read_iau_csv(
-            os.path.join(Paths.table_dir, Paths.iau_features_fname))
-        }
+    # Keeping as class attributes, but loaded on first use, not at import time
+    iau_data = _LazyClassAttribute(_parse_iau_data)
+    catalogue = _LazyClassAttribute(_load_iau_catalogue)
+    spatial_index = _LazyClassAttribute(_build_spatial_index)
+
+    @property
+    def feature_names(self):
+        """Feature names, in the order of `catalogue` rows"""
+
+        return self.catalogue[NAME_COLUMN]
 
     def __getitem__(self, crater_name):
-        """x.__getitem__(y) <==> x.iau_data[y.lower()]"""
+        """
+        x.__getitem__(y) <==> x.iau_data[y.lower()]
 
-        return self.iau_data[crater_name.lower()]
+        Looked up in the `catalogue`, so that `iau_data` doesn't have to be
+        parsed for it.
+        """
+
+        return Crater(self.catalogue.row(self.catalogue.index(crater_name)))
 
     def crater_position_size(self, crater_name):
         """A helper shortcut for extracting lat/lon/diameter tuple"""
 
-        return (self[crater_name].center_latitude,
-                self[crater_name].center_longitude,
-                self[crater_name].diameter)
+        i = self.catalogue.index(crater_name)
+        return (float(self.catalogue["center_latitude"][i]),
+                float(self.catalogue["center_longitude"][i]),
+                float(self.catalogue["diameter"][i]))
+
+    def search(self, prefix, limit=20):
+        """Names starting with a (case-insensitive) prefix, for autocomplete"""
+
+        return self.feature_names[self.catalogue.name_index.prefix(prefix,
+                                                                   limit)]
+
+    def suggest(self, crater_name, max_distance=2, limit=10):
+        """Names within a few typos of a given one, closest first"""
+
+        return self.feature_names[self.catalogue.name_index.fuzzy(
+            crater_name, max_distance, limit)]
+
+    def nearest(self, lon, lat, k=1, min_diameter=None):
+        """
+        Names of and distances (in km) to the nearest features to lon/lat
+
+        Takes arrays of points as well, see `FeatureIndex.nearest`. Where
+        fewer than k features match, the name is '' and the distance inf.
+        """
+
+        dist, idx = self.spatial_index.nearest(lon, lat, k, min_diameter)
+        names = np.where(idx >= 0, self.feature_names[idx], '')
+
+        return names[()], dist
+
+    def within_radius(self, lon, lat, radius_km, min_diameter=None):
+        """
+        Names of all features within radius_km from lon/lat, nearest first
+
+        Returns a list of names for every point if given arrays of points.
+        """
+
+        found = self.spatial_index.within_radius(lon, lat, radius_km,
+                                                 min_diameter)
+        if isinstance(found, list):
+            return [self.feature_names[idx] for idx in found]
+
+        return self.feature_names[found]
+
+    def within_square(self, lon, lat, side_km, min_diameter=None):
+        """Names of all features inside a square cutout centred at lon/lat"""
+
+        found = self.spatial_index.within_square(lon, lat, side_km,
+                                                 min_diameter)
+        if isinstance(found, list):
+            return [self.feature_names[idx] for idx in found]
+
+        return self.feature_names[found]
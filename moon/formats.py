@@ -0,0 +1,148 @@
+"""
+Payload formats for the cutouts: compressed GeoTiffs and NumPy files
+
+GeoTiffs always hold the raw int16 DEM values, with the scale factor to
+meters in their band metadata. The NumPy formats can also carry elevation in
+meters as float16 or float32, float16 being lossy (~0.1% relative error) but
+half the size.
+"""
+
+import os
+import numpy as np
+from moon.config import Constants
+
+# format name -> (file extension, mimetype)
+FORMATS = {
+    "tif": ("tif", "image/tiff"),  # uncompressed
+    "deflate": ("tif", "image/tiff"),
+    "zstd": ("tif", "image/tiff"),
+    "cog": ("tif", "image/tiff; application=geotiff;"
+                   " profile=cloud-optimized"),
+    "npy": ("npy", "application/x-npy"),
+    "npz": ("npz", "application/x-npz"),
+}
+
+GEOTIFF_FORMATS = ("tif", "deflate", "zstd", "cog")
+
+# value encodings; int16 are the raw values, to be multiplied by the scale
+ENCODINGS = ("int16", "float16", "float32")
+
+# horizontal differencing makes smooth elevation models compress a lot better
+_CREATION_OPTIONS = {
+    "tif": [],
+    "deflate": ["COMPRESS=DEFLATE", "PREDICTOR=2", "TILED=YES"],
+    "zstd": ["COMPRESS=ZSTD", "PREDICTOR=2", "TILED=YES"],
+    "cog": ["COMPRESS=DEFLATE", "PREDICTOR=YES", "OVERVIEWS=AUTO"],
+}
+
+
+def check_format(fmt, encoding):
+    """Raises a ValueError on unknown or unsupported format/encoding pairs"""
+
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format: {fmt}, pick one of"
+                         f" {', '.join(FORMATS)}")
+    if encoding not in ENCODINGS:
+        raise ValueError(f"Unknown encoding: {encoding}, pick one of"
+                         f" {', '.join(ENCODINGS)}")
+    if fmt in GEOTIFF_FORMATS and encoding != "int16":
+        raise ValueError("GeoTiffs only come with int16 values and a scale")
+
+
+def encode_array(image, encoding):
+    """
+    Casts raw DEM values into an encoding
+
+    Returns
+    -------
+    values : np.ndarray
+        Raw values for int16, elevation in meters for the float encodings.
+
+    scale : float
+        Factor to multiply the values by to get meters.
+    """
+
+    if encoding == "int16":
+        return image.astype(np.int16, copy=False), \
+            Constants.lola_dem_scaling_factor
+
+    return Constants.local_radius(image).astype(encoding), 1.0
+
+
+def save_array(fname, image, fmt="npz", encoding="int16"):
+    """
+    Writes raw DEM values into a .npy or a compressed .npz file
+
+    The .npz file has the `elevation` values and their `scale` to meters.
+    """
+
+    values, scale = encode_array(image, encoding)
+
+    # file objects, or numpy would tack its own extension onto the name
+    with open(fname, 'wb') as npfile:
+        if fmt == "npy":
+            np.save(npfile, values)
+        elif fmt == "npz":
+            np.savez_compressed(npfile, elevation=values,
+                                scale=np.float64(scale))
+        else:
+            raise ValueError(f"Not a NumPy format: {fmt}")
+
+
+def write_cutout(fname, warp_func, fmt="deflate", encoding="int16",
+                 **params):
+    """
+    Warps a cutout straight into a file of a given format
+
+    Parameters
+    ----------
+    fname : str
+        Output path.
+
+    warp_func : callable
+        `moon.io.read_warped_window` or a function that passes its keyword
+        arguments on to it, e.g. `moon.io.crater_cutout`.
+
+    fmt : str, default: "deflate"
+        One of `FORMATS`.
+
+    encoding : str, default: "int16"
+        One of `ENCODINGS`; only int16 for the GeoTiffs.
+
+    **params
+        Passed on to `warp_func`.
+    """
+
+    check_format(fmt, encoding)
+
+    def _warp(**kwargs):
+        # GDAL doesn't raise on failed warps, it returns None
+        image = warp_func(raw=True, **kwargs, **params)
+        if image is None:
+            raise RuntimeError(f"Warp failed for {params}")
+        return image
+
+    if fmt not in GEOTIFF_FORMATS:
+        save_array(fname, _warp(), fmt, encoding)
+        return
+
+    if fmt != "cog":
+        _warp(destNameOrDestDS=fname, format="GTIFF",
+              creationOptions=_CREATION_OPTIONS[fmt])
+        return
+
+    import gdal
+
+    # the COG driver only makes copies of existing datasets; the scale
+    # metadata comes along from the intermediate GeoTiff
+    tmp_fname = f"{fname}.warp.tif"
+    try:
+        _warp(destNameOrDestDS=tmp_fname, format="GTIFF")
+        cog = gdal.Translate(fname, tmp_fname, format="COG",
+                             creationOptions=_CREATION_OPTIONS["cog"])
+        if cog is None:
+            raise RuntimeError(f"COG translation failed for {params}")
+        cog = None  # closes the file
+    finally:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
@@ -16,39 +16,163 @@ Example 3: find the centre of Tycho crater:
 """
 
 import os
-from functools import wraps
+import threading
+from functools import wraps, lru_cache
 import numpy as np
-import gdal
-import rasterio  # for proper crs-grokking GeoTiff loading
-from pyproj import CRS, Transformer
 from moon.config import Paths, Constants
 from moon.features import LunarFeatures
+from moon import metrics
 
-# defining as a bunch of constants to avoid accidental reloading
-try:
-    LOLA_READER = rasterio.open(os.path.join(Paths.data_dir, Paths.tif_fname))
-except rasterio.errors.RasterioIOError:
-    # If the file isn't in the data dir, try reading from the S3 bucket instead
-    LOLA_READER = rasterio.open(Paths.s3_url)
+# NOTE: gdal, rasterio, and pyproj are imported where they're needed - they
+#       take a good while to load, as does opening the 8 GB GeoTiff file, and
+#       a lot of what we do (e.g. a crater name lookup) doesn't need either
+
+# a bunch of lazily initialized constants, see `lazy_constant`
+_LAZY_CONSTANTS = {}
+_LAZY_ACCESSORS = {}
+_LAZY_LOCK = threading.RLock()
+
+
+def lazy_constant(factory):
+    """
+    Makes a thread-safe accessor that runs `factory` on the first call only
+
+    The result is also reachable as a module attribute of the same name as
+    the factory, minus the leading `_open_`/`_make_` and in upper case, so
+    `mio.LOLA_READER` still works, it's just not opened at import time.
+    """
+
+    name = factory.__name__.split('_', 2)[-1].upper()
+
+    @wraps(factory)
+    def accessor():
+        try:
+            return _LAZY_CONSTANTS[name]
+        except KeyError:
+            pass
+
+        # re-entrant - the transformers below need the reader to be open
+        with _LAZY_LOCK:
+            if name not in _LAZY_CONSTANTS:
+                _LAZY_CONSTANTS[name] = factory()
+        return _LAZY_CONSTANTS[name]
+
+    accessor.constant_name = name
+    _LAZY_ACCESSORS[name] = accessor
+
+    return accessor
+
+
+def __getattr__(name):
+    """Module-level attribute access for the lazy constants (PEP 562)"""
+
+    try:
+        return _LAZY_ACCESSORS[name]()
+    except KeyError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def lola_source():
+    """Path to LOLA GeoTiff, or its S3 URL if there's no local copy"""
+
+    path = os.path.join(Paths.data_dir, Paths.tif_fname)
+    return path if os.path.exists(path) else Paths.s3_url
+
+
+@lazy_constant
+def _open_lola_reader():
+    """Opens LOLA GeoTiff with rasterio, falling back to the S3 bucket"""
+
+    import rasterio  # for proper crs-grokking GeoTiff loading
+
+    try:
+        return rasterio.open(os.path.join(Paths.data_dir, Paths.tif_fname))
+    except rasterio.errors.RasterioIOError:
+        # If the file isn't in the data dir, try reading from the S3 bucket,
+        # keeping the blocks we've read in a local on-disk cache
+        from moon.remote import open_remote
+        return open_remote(Paths.s3_url)
+
+
+@lazy_constant
+def _open_lola_memmap():
+    """Memory-mapped raw copy of LOLA GeoTiff, see `moon.rawstore`"""
+
+    from moon.rawstore import RawDEM
+
+    try:
+        return RawDEM(os.path.join(Paths.data_dir, Paths.raw_fname))
+    except FileNotFoundError as err:
+        raise RuntimeError("Convert the GeoTiff first with"
+                           " `python -m moon.rawstore`") from err
+
+
+@lazy_constant
+def _open_warp_engine():
+    """In-process reprojection engine over LOLA GeoTiff, see `moon.warp`"""
+
+    import rasterio
+    from moon.warp import WarpEngine
+
+    try:
+        return WarpEngine(os.path.join(Paths.data_dir, Paths.tif_fname))
+    except (rasterio.errors.RasterioIOError, OSError):
+        # same fallback as for the rasterio reader, block cache included
+        from moon.remote import open_remote
+        return WarpEngine(open_remote(Paths.s3_url))
+
+
+@lazy_constant
+def _make_lola_crs():
+    """Coordinate reference system of the LOLA dataset"""
+
+    from pyproj import CRS
+
+    return CRS(_open_lola_reader().crs)
 
-LOLA_CRS = CRS(LOLA_READER.crs)
 
 # transformation shortcuts - maaaybe I should not overuse constants here
-XY_TO_LONLAT = Transformer.from_crs(LOLA_CRS, LOLA_CRS.geodetic_crs)
-LONLAT_TO_XY = Transformer.from_crs(LOLA_CRS.geodetic_crs, LOLA_CRS)
+@lazy_constant
+def _make_xy_to_lonlat():
+    """LOLA x/y to lon/lat transformer"""
+
+    from pyproj import Transformer
+
+    lola_crs = _make_lola_crs()
+    return Transformer.from_crs(lola_crs, lola_crs.geodetic_crs)
+
+
+@lazy_constant
+def _make_lonlat_to_xy():
+    """Lon/lat to LOLA x/y transformer"""
 
+    from pyproj import Transformer
 
-# TODO: the scaling factor is nice and all but it changes int8 into float64,
+    lola_crs = _make_lola_crs()
+    return Transformer.from_crs(lola_crs.geodetic_crs, lola_crs)
+
+
+# NOTE: the scaling factor is nice and all but it changes int16 into float64,
 #       leading to increased data file size. If the goal is to make small
 #       GeoTiff cutouts to be sent over the network, then the scaling factor
-#       should *absolutely* be applied on the client side!
+#       should *absolutely* be applied on the client side! Hence `raw=True`,
+#       and the scale written into the GeoTiff metadata by read_warped_window
 def apply_scaling_factor(image_loader):
-    """Applies a scaling factor to a return array of the decorated function"""
+    """
+    Applies a scaling factor to a return array of the decorated function
+
+    The decorated function gets an extra `raw` keyword argument: if True,
+    the array is returned as is, in its native (integer) dtype, and it is up
+    to the caller to apply `Constants.local_radius` when (and if) needed.
+    """
 
     @wraps(image_loader)
-    def scaler_wrapper(*args, **kwargs):
+    def scaler_wrapper(*args, raw=False, **kwargs):
         image = image_loader(*args, **kwargs)
 
+        if raw:
+            return image
+
         # not everything is scalable! case in point - read_warped_window will
         # return None if we choose to write into a file and not load into MEM
         # numpy won't let us check if an array is None via bool()
@@ -60,38 +184,290 @@ def apply_scaling_factor(image_loader):
 
 
 @apply_scaling_factor
-def square_cutout(lon, lat, side, convert_km_to_deg=False):
-    """Extracts a numpy array for a given square centered at lon/lat"""
+def square_cutout(lon, lat, side, convert_km_to_deg=False, out_shape=None,
+                  backend="rasterio"):
+    """
+    Extracts a numpy array for a given square centered at lon/lat
+
+    The window is rounded to whole pixels (see `moon.blocks.
+    bounds_to_windows`), so the pixels come out as they are in the GeoTiff,
+    the same ones for both backends and for `square_cutouts`. If
+    `out_shape` is given, the window is resampled to it, and rasterio reads
+    it from the coarsest overview level that's still good enough.
+
+    With `backend="memmap"`, the window is sliced out of the raw copy of the
+    GeoTiff made by `moon.rawstore` instead, which skips the decoding
+    altogether. Resampling to `out_shape` isn't supported then. Together with
+    `raw=True`, the returned array is a zero-copy view of the memory map.
+    """
 
     if convert_km_to_deg:
         side = Constants.km_to_deg(side)
 
+    if backend == "memmap":
+        if out_shape is not None:
+            raise ValueError("Can't resample memory-mapped windows")
+        return _open_lola_memmap().square(lon, lat, side)
+    if backend != "rasterio":
+        raise ValueError(f"Unknown backend: {backend}")
+
+    from rasterio.windows import Window
+    from moon.blocks import bounds_to_windows
+
     # FIXME: rewrite with rasterio.warp! As a workaround, use the GDAL-based
     #        read_warped_window function to get rid of projection errors
-    window = rasterio.windows.from_bounds(*square_lonlat_to_xy(lon, lat, side),
-                                          transform=LOLA_READER.transform)
-    return LOLA_READER.read(window=window)[0]  # only one channel
+    lola_reader = _open_lola_reader()
+    with metrics.span("transform"):
+        bounds = square_lonlat_to_xy(lon, lat, side)
+    row_off, col_off, height, width = (int(n) for n in bounds_to_windows(
+        lola_reader.transform, *bounds, lola_reader.shape))
+    window = Window(col_off, row_off, width, height)
+
+    with metrics.span("read"):
+        if out_shape is None:
+            image = lola_reader.read(window=window)[0]  # only one channel
+        else:
+            image = lola_reader.read(1, window=window, out_shape=out_shape)
+    metrics.count("bytes_read", image.nbytes)
+
+    return image
+
+
+def square_cutouts(lons, lats, sides, convert_km_to_deg=False, raw=False):
+    """
+    Extracts many squares at once, decoding each GeoTiff block only once
+
+    Same as calling `square_cutout` for every lon/lat/side, but the windows
+    are worked out in one vectorized transform, and the reads are ordered by
+    the internal block layout of the GeoTiff, so overlapping windows share
+    the decoded blocks instead of decoding them over and over.
+
+    Parameters
+    ----------
+    lons, lats, sides : array-like
+        Square centres and sides (in degrees, or km with
+        `convert_km_to_deg`); broadcast against each other.
+
+    raw : bool, default: False
+        Whether to keep the arrays in their native dtype, unscaled.
+
+    Returns
+    -------
+    cutouts : list of np.ndarray
+        One array per square, in the input order.
+    """
+
+    from moon.blocks import BlockReader, bounds_to_windows
+
+    lons, lats, sides = (np.ravel(a) for a in
+                         np.broadcast_arrays(lons, lats, sides))
+    if convert_km_to_deg:
+        sides = Constants.km_to_deg(sides)
+
+    with metrics.span("transform"):
+        lower_x, lower_y, upper_x, upper_y = square_lonlat_to_xy(lons, lats,
+                                                                  sides)
+    lola_reader = _open_lola_reader()
+    windows = bounds_to_windows(lola_reader.transform, lower_x, lower_y,
+                                upper_x, upper_y, lola_reader.shape)
+
+    with metrics.span("read"):
+        cutouts = BlockReader(lola_reader, windows).read_all()
+    metrics.count("bytes_read", sum(cutout.nbytes for cutout in cutouts))
+    if raw:
+        return cutouts
+
+    return [Constants.local_radius(cutout) for cutout in cutouts]
+
+
+def sample_elevation(lons, lats, method="bilinear", absolute=False,
+                     raw=False, backend="rasterio", reader=None):
+    """
+    Elevation at many lon/lat points, interpolated from the DEM pixels
+
+    All the points go through a single vectorized transform into pixel
+    coordinates, and are then sampled block by block, so each GeoTiff block
+    is decoded once however many points fall into it; see
+    `moon.sampling.BlockSampler`.
+
+    Parameters
+    ----------
+    lons, lats : array-like
+        Point coordinates in degrees; broadcast against each other.
+
+    method : str, default: "bilinear"
+        "nearest", "bilinear", or "bicubic".
+
+    absolute : bool, default: False
+        Whether to return the local radius instead of the elevation, see
+        `Constants.local_radius`.
+
+    raw : bool, default: False
+        Whether to return the interpolated raw DEM values, unscaled.
+
+    backend : str, default: "rasterio"
+        Or "memmap", to sample the raw copy made by `moon.rawstore`.
+
+    reader : rasterio.DatasetReader, optional
+        Open LOLA GeoTiff to sample with the rasterio backend, instead of
+        the shared one; e.g. one per thread, as they can't be shared.
+
+    Returns
+    -------
+    elevation : np.ndarray
+        In meters, of the broadcast shape of lons and lats; NaN for the
+        points with non-finite coordinates.
+    """
+
+    from moon.sampling import BlockSampler
+
+    lons, lats = np.broadcast_arrays(np.asarray(lons, dtype=np.float64),
+                                     np.asarray(lats, dtype=np.float64))
+    if np.any(np.abs(lats) > 90):
+        raise ValueError("Latitudes should be within -90 and 90 degrees")
+
+    if backend == "memmap":
+        raw_dem = _open_lola_memmap()
+        source, transform = raw_dem.data, raw_dem.transform
+    elif backend == "rasterio":
+        source = reader or _open_lola_reader()
+        transform = tuple(source.transform)[:6]
+    else:
+        raise ValueError(f"Unknown backend: {backend}")
+
+    # pixel coordinates, counted from the centre of the first pixel; the
+    # sampler wraps the columns, so lons past +-180 are fine
+    with metrics.span("transform"):
+        x, y = _make_lonlat_to_xy().transform(lons, lats)
+    x_size, _, x_off, _, y_size, y_off = transform
+    rows = (np.asarray(y) - y_off) / y_size - 0.5
+    cols = (np.asarray(x) - x_off) / x_size - 0.5
+
+    with metrics.span("sample"):
+        values = BlockSampler(source).sample(rows, cols, method)
+    if raw:
+        return values
+
+    return Constants.local_radius(values, absolute=absolute)
 
 
 def square_lonlat_to_xy(lon, lat, side):
-    """Converts a square of lon/lat centre and degrees size to x/y box"""
+    """
+    Converts a square of lon/lat centre and degrees size to x/y box
+
+    Takes arrays too, with both corners transformed in a single call.
+    """
+
+    lon, lat, side = np.asarray(lon), np.asarray(lat), np.asarray(side)
+    xs, ys = _make_lonlat_to_xy().transform(
+        np.stack([lon - side / 2, lon + side / 2]),
+        np.stack([lat - side / 2, lat + side / 2]))
+    (lower_x, upper_x), (lower_y, upper_y) = xs, ys
 
-    lower_x, lower_y = LONLAT_TO_XY.transform(lon - side / 2, lat - side / 2)
-    upper_x, upper_y = LONLAT_TO_XY.transform(lon + side / 2, lat + side / 2)
+    if lower_x.ndim == 0:
+        return (lower_x.item(), lower_y.item(),
+                upper_x.item(), upper_y.item())
 
     return lower_x, lower_y, upper_x, upper_y
 
 
+def overview_factors(source):
+    """Downsampling factors of the overviews a GeoTiff comes with"""
+
+    if isinstance(source, str):
+        return _cached_overview_factors(source)
+
+    return _dataset_overview_factors(source)
+
+
+@lru_cache(maxsize=None)
+def _cached_overview_factors(source):
+    """Overview factors by path, so that we don't reopen the file each time"""
+
+    import gdal
+
+    return _dataset_overview_factors(gdal.Open(source))
+
+
+def _dataset_overview_factors(dataset):
+    """Overview factors of an open gdal.Dataset"""
+
+    if dataset is None:
+        return ()
+
+    band = dataset.GetRasterBand(1)
+    return tuple(round(dataset.RasterXSize / band.GetOverview(i).XSize)
+                 for i in range(band.GetOverviewCount()))
+
+
+def select_overview_level(resolution, factors,
+                          native_resolution=Constants.lola_dem_resolution):
+    """
+    Picks the coarsest overview level that still meets a resolution
+
+    Parameters
+    ----------
+    resolution : float
+        Requested output pixel size, in meters.
+
+    factors : sequence of int
+        Downsampling factors of the available overviews, e.g. (2, 4, 8).
+
+    native_resolution : float
+        Full-resolution pixel size, in meters.
+
+    Returns
+    -------
+    level : int or None
+        Overview index as GDAL counts them (0 for the first overview), or
+        None if full resolution is needed.
+    """
+
+    level, best_factor = None, 1
+    for i, factor in enumerate(factors):
+        if best_factor < factor and factor * native_resolution <= resolution:
+            level, best_factor = i, factor
+
+    return level
+
+
+def _requested_resolution(side_lat, side_lon, kwargs):
+    """Output pixel size in meters implied by gdal.Warp size options"""
+
+    if kwargs.get("xRes"):
+        return min(kwargs["xRes"], kwargs.get("yRes") or kwargs["xRes"])
+
+    to_meters = Constants.lola_dem_moon_radius * np.pi / 180
+    sizes = [side * to_meters / kwargs[key] for side, key in
+             ((side_lon, "width"), (side_lat, "height")) if kwargs.get(key)]
+
+    return min(sizes) if sizes else None
+
+
 @apply_scaling_factor
 def read_warped_window(lon, lat, side,  # side can be either in deg or km
                        width_correction=True, convert_km_to_deg=False,
                        source=os.path.join(Paths.data_dir, Paths.tif_fname),
-                       **kwargs):
-    """The GDAL way, although ideally I should rewrite this in rasterio.warp"""
+                       overview=True, **kwargs):
+    """
+    The GDAL way, although ideally I should rewrite this in rasterio.warp
+
+    If the output size is constrained (via `width`/`height` or `xRes`/`yRes`
+    keywords of `gdal.Warp`) and `overview` is True, the data is warped from
+    the coarsest overview level that still meets the output resolution,
+    see `moon.overviews` on how to build those.
+
+    The warp keeps the source dtype (int16 for LOLA) unless `outputType` is
+    passed on to gdal.Warp, e.g. gdal.GDT_Float32. GeoTiff outputs come with
+    the scale and offset in their band metadata.
+    """
+
+    import gdal
 
     # might not be the most sensible way of setting defaults but hey it works
     out_format = kwargs.pop("format", "MEM")
     destination = kwargs.pop("destNameOrDestDS", "")
+    creation_options = kwargs.pop("creationOptions", None)
 
     try:
         side_lat, side_lon = side
@@ -102,6 +478,12 @@ def read_warped_window(lon, lat, side,  # side can be either in deg or km
         side_lat = Constants.km_to_deg(side_lat)
         side_lon = Constants.km_to_deg(side_lon)
 
+    # the side is measured before the width correction, as in ortho x/y
+    resolution = _requested_resolution(side_lat, side_lon, kwargs)
+    if overview and resolution and "overviewLevel" not in kwargs:
+        level = select_overview_level(resolution, overview_factors(source))
+        kwargs["overviewLevel"] = "NONE" if level is None else level
+
     # apply a rough correction on the width (~1/cos(lat) for equirectangular)
     if width_correction:
         side_lon /= np.cos(lat / 180 * np.pi)
@@ -112,27 +494,70 @@ def read_warped_window(lon, lat, side,  # side can be either in deg or km
     lunar_r = Constants.lola_dem_moon_radius
 
     # added "+R=..." to outputBoundsSRS/te_srs to avoid errors in GDAL v3.x.x
-    cut = gdal.Warp(destNameOrDestDS=destination, srcDSOrSrcDSTab=source,
-                    format=out_format, resampleAlg=gdal.GRA_CubicSpline,
-                    multithread=True,
-                    outputBounds=(lon_min, lat_min, lon_max, lat_max),
-                    outputBoundsSRS=f"+proj=longlat +R={lunar_r} +no_defs",
-                    srcSRS=f"+proj=eqc +R={lunar_r}",
-                    dstSRS=f"+proj=ortho +lat_0={lat} +lon_0={lon}"
-                           f" +R={lunar_r} +no_defs",
-                    **kwargs)
+    # always warping in memory, so that the file encoding is timed apart
+    with metrics.span("warp"):
+        cut = gdal.Warp(destNameOrDestDS="", srcDSOrSrcDSTab=source,
+                        format="MEM", resampleAlg=gdal.GRA_CubicSpline,
+                        multithread=True,
+                        outputBounds=(lon_min, lat_min, lon_max, lat_max),
+                        outputBoundsSRS=f"+proj=longlat +R={lunar_r}"
+                                        " +no_defs",
+                        srcSRS=f"+proj=eqc +R={lunar_r}",
+                        dstSRS=f"+proj=ortho +lat_0={lat} +lon_0={lon}"
+                               f" +R={lunar_r} +no_defs",
+                        **kwargs)
 
     if not cut:
         return cut
+    metrics.count("output_pixels", cut.RasterXSize * cut.RasterYSize)
+
+    if out_format.upper() != "MEM":
+        # the pixel values in the file are the raw ones, so we let the
+        # GDAL-aware readers know how to turn them into elevation (x * scale
+        # + offset); gdal.Translate carries these over into the file
+        band = cut.GetRasterBand(1)
+        band.SetScale(Constants.lola_dem_scaling_factor)
+        band.SetOffset(0)
+        band.SetUnitType("m")
+
+        with metrics.span("geotiff_encode"):
+            encoded = gdal.Translate(destination, cut, format=out_format,
+                                     creationOptions=creation_options or [])
+            if not encoded:
+                return encoded
+            encoded.FlushCache()
+            encoded = None  # closes the file
 
     return cut.ReadAsArray()
 
 
+@apply_scaling_factor
+def fast_warped_window(lon, lat, side, width_correction=True,
+                       convert_km_to_deg=False, **kwargs):
+    """
+    Same as `read_warped_window` into memory, but with a persistent engine
+
+    The source stays open and the coordinate grids are cached between the
+    calls, which makes a big difference for small and medium cutouts. Takes
+    `size`, `resolution`, `resampling`, and the other keyword arguments of
+    `moon.warp.WarpEngine.warp`.
+    """
+
+    with metrics.span("engine_warp"):
+        return _open_warp_engine().warp(lon, lat, side, width_correction,
+                                        convert_km_to_deg, **kwargs)
+
+
 def crater_cutout(crater_name, pad=1.3, **kwargs):
-    """Returns warped elevation model around a known crater"""
+    """
+    Returns warped elevation model around a known crater
+
+    Takes the keyword arguments of `read_warped_window`, `raw` included.
+    """
 
     lunar_features = LunarFeatures()  # ~100 ns to init, not an issue
-    lat, lon, diameter = lunar_features.crater_position_size(crater_name)
+    with metrics.span("feature_lookup"):
+        lat, lon, diameter = lunar_features.crater_position_size(crater_name)
 
     return read_warped_window(lon, lat, diameter*pad, convert_km_to_deg=True,
                               **kwargs)
@@ -157,17 +582,40 @@ def load_lola_asarray():
     return imdata
 
 
-def downsample_lola(imdata, n=5, save=False, **kwargs):
+def downsample_lola(imdata=None, n=5, save=False, reducer=np.mean,
+                    source=os.path.join(Paths.data_dir, Paths.tif_fname),
+                    max_memory=256 * 1024**2, processes=1, **kwargs):
     """
-    Downsample the image by taking every n'th grid value
+    Downsample the image by averaging over n x n grid cells
+
+    Unless given an image array, the GeoTiff is streamed from disk in
+    block-aligned windows, so that the peak memory use is bounded by
+    `max_memory` rather than by the (8 GB) image size.
 
     Parameters
     ----------
+    imdata : np.ndarray, optional
+        Full resolution image, if it's already in memory.
+
     n : int, default: 5
         Grid downscaling factor.
 
     save : bool, default: False
-        Whether to save the array under DATA_DIR.
+        Whether to save the array under DATA_DIR. When streaming, the output
+        is then written into the .npy file incrementally.
+
+    reducer : callable, default: np.mean
+        Reduction over each n x n cell, e.g. np.max or np.median; called as
+        `reducer(blocks, axis=(1, 3))`.
+
+    source : str
+        Path or URL of the GeoTiff to stream from.
+
+    max_memory : int, default: 256 MB
+        Rough peak memory budget for the streamed windows, in bytes.
+
+    processes : int, default: 1
+        Number of processes to reduce the windows on.
 
     Returns
     -------
@@ -177,15 +625,49 @@ def downsample_lola(imdata, n=5, save=False, **kwargs):
     Other Parameters
     ----------------
     **kwargs
-        All other keyword arguments are passed to
-        `skimage.transform.downscale_local_mean`.
+        Only `cval` is supported when streaming. For in-memory images, all
+        other keyword arguments are passed to
+        `skimage.transform.downscale_local_mean` (if `reducer` is np.mean)
+        or `skimage.measure.block_reduce`.
     """
 
-    from skimage.transform import downscale_local_mean
-    smalldata = downscale_local_mean(imdata, factors=(n, n), **kwargs)
+    out_path = os.path.join(Paths.data_dir, Paths.tif_fname_small)
+
+    if imdata is not None:
+        if reducer is np.mean:
+            from skimage.transform import downscale_local_mean
+            smalldata = downscale_local_mean(imdata, factors=(n, n),
+                                             **kwargs)
+        else:
+            from skimage.measure import block_reduce
+            smalldata = block_reduce(imdata, block_size=(n, n),
+                                     func=reducer, **kwargs)
+
+        if save:
+            np.save(out_path, smalldata)
+
+        return smalldata
+
+    from moon.blocks import downsample_raster
+
+    out = None
+    if save:
+        import rasterio
+        with rasterio.open(source) as reader:
+            shape = -(-reader.height // n), -(-reader.width // n)
+        # written into block by block, never fully in memory
+        out = np.lib.format.open_memmap(out_path + '.part', mode='w+',
+                                        dtype=np.float64, shape=shape)
+
+    smalldata = downsample_raster(source, n, out=out, reducer=reducer,
+                                  cval=kwargs.pop('cval', 0),
+                                  max_memory=max_memory, processes=processes)
 
     if save:
-        np.save(os.path.join(Paths.data_dir, Paths.tif_fname_small), smalldata)
+        smalldata.flush()
+        del smalldata, out
+        os.replace(out_path + '.part', out_path)
+        smalldata = np.load(out_path, mmap_mode='r')
 
     return smalldata
 
@@ -209,10 +691,10 @@ def get_tycho_cutout(range_x=np.array([42400, 43850]),
     try:
         dem_tycho = np.load(cutout_path)
     except FileNotFoundError:
-        from skimage import io as skimage_io
-        impath = os.path.join(Paths.data_dir, Paths.tif_fname)
-        imdata = skimage_io.imread(impath)
-        dem_tycho = imdata[slice(*range_y), slice(*range_x)]
+        # no need to load the whole image for that, a window read will do
+        from rasterio.windows import Window
+        dem_tycho = _open_lola_reader().read(1, window=Window(
+            range_x[0], range_y[0], np.ptp(range_x), np.ptp(range_y)))
         np.save(cutout_path, dem_tycho)
 
     return dem_tycho
@@ -7,19 +7,22 @@ https://astrogeology.usgs.gov/search/map/Moon/LRO/LOLA/Lunar_LRO_LOLA_Global_LDE
 
 import os
 import numpy as np
-import pandas as pd
 from skimage.transform import downscale_local_mean
 import matplotlib.pyplot as plt
 import cartopy.crs as ccrs
-from cartopy import geodesic
-import shapely
 from moon.config import Paths, Constants
 from moon import io as mio
+from moon.overlay import add_catalogue_outlines
 from moon.plot_mayavi import make_figure as make_mayavi_figure
 
 
-def overplot_craters():
-    """Overplot a lunar map with known crater outlines"""
+def overplot_craters(iau_fname=os.path.join(Paths.table_dir,
+                                             Paths.iau_craters_fname)):
+    """
+    Overplot a lunar map with known crater outlines
+
+    Pass the `Paths.iau_features_fname` table to show all the features.
+    """
 
     imdata_small = mio.load_lola_downsampled()
     smalldata = downscale_local_mean(imdata_small, factors=(10, 10))
@@ -43,26 +46,9 @@ def overplot_craters():
     # CSV data downloaded from:  https://planetarynames.wr.usgs.gov/
     # Check the page here for all the history behind the moon feature naming:
     # https://the-moon.us/wiki/IAU_nomenclature
-    iau_fname = os.path.join(Paths.table_dir, 'iau_approved_craters.csv')
-    #iau_fname = os.path.join(Paths.table_dir, 'iau_approved_features.csv')
-    iau_lunar_craters = pd.read_csv(iau_fname)
-    lons = iau_lunar_craters.Center_Longitude
-    lats = iau_lunar_craters.Center_Latitude
-    radii_in_meters = iau_lunar_craters.Diameter * 500  # km to m
-    moon_geodesic = geodesic.Geodesic(radius=Constants.moon_radius,
-                                      flattening=Constants.moon_flattening)
-    craters = []
-    crater_proj = ccrs.Geodetic(globe=moon_globe)
-    for lon, lat, radius in zip(lons, lats, radii_in_meters):
-        if not radius:
-            continue
-
-        crater = moon_geodesic.circle(lon=lon, lat=lat, radius=radius,
-                                      n_samples=15)
-        craters.append(crater)
-        geom = shapely.geometry.Polygon(crater)
-        ax.add_geometries((geom,), crs=crater_proj, alpha=0.6,
-                          facecolor='none', edgecolor='white', linewidth=0.5)
+    # all the outlines go in as a single collection, the ones too small to
+    # see at this scale are dropped
+    add_catalogue_outlines(ax, iau_fname, globe=moon_globe)
 
     plt.savefig(os.path.join(Paths.fig_dir, "lunar_craters.png"), dpi=120)
 
@@ -74,22 +60,14 @@ def main():
         imdata_small = mio.load_lola_downsampled()
         moon_slice = np.load(os.path.join(Paths.data_dir, "lola_slice.npy"))
     except FileNotFoundError:
-        # won't run on <16 GB RAM machine - look into
-        # out-of-core solutions if that's ever an issue
-        imdata_large = mio.load_lola_asarray()
-
-        # We need to invoke a copy on a slice - otherwise the .base
-        # .base attribute won't get released and the big array
-        # will not get garbage collected!
-        moon_slice = imdata_large[20000:30000, 20000:30000].copy()
+        # the GeoTiff is streamed in blocks, so this runs in bounded memory
+        from rasterio.windows import Window
+        moon_slice = mio.LOLA_READER.read(
+            1, window=Window(20000, 20000, 10000, 10000))
         np.save(os.path.join(Paths.data_dir, "lola_slice.npy"), moon_slice)
 
         # radical downsampling for performance and profit
-        imdata_small = mio.downsample_lola(imdata_large, n=5, save=True).copy()
-
-        # FIXME this doesn't always release memory - I may have left
-        #       a reference to a big array somewhere - but where?
-        del imdata_large
+        imdata_small = mio.downsample_lola(n=5, save=True)
 
     # the whole image is too large to display! slices of it look awesome though
     # .ipynb this
@@ -0,0 +1,497 @@
+"""
+Simplified terrain meshes of elevation cutouts, exported as binary glTF
+
+A dense cutout grid makes two triangles per pixel, millions of them for the
+larger craters, most of which are wasted on flat ground. Here the grid is
+triangulated as a right-triangulated irregular network (RTIN, the scheme of
+Mapbox's Martini): triangles are split in half only while the grid
+deviates from them by more than a given vertical error, which gives a
+crack-free mesh with the detail where the terrain needs it. Unlike Martini,
+which only checks the hypotenuse midpoints, the error covers all the grid
+points within a triangle, so it's a proper bound.
+
+The errors are worked out once per cutout, after which meshes for any error
+bound (levels of detail) are cheap to extract. These are written into a
+.glb file with quantized vertices (KHR_mesh_quantization), which three.js
+and the other web viewers load directly. The .glb files are written with
+the standard library alone; `pygltflib`, an optional dependency, is only
+needed to read them back into Python, e.g. in the tests.
+
+Call it from command line as `python -m moon.mesh`, e.g.:
+$ python -m moon.mesh tycho --max-error 20 5 1 --output tycho.glb
+"""
+
+import io
+import json
+import math
+import struct
+import argparse
+from functools import lru_cache
+from collections import namedtuple
+import numpy as np
+
+# vertex positions in meters (x east, y up, z south, centred on the cutout),
+# and the triangles as vertex index triplets, counter-clockwise from above
+Mesh = namedtuple("Mesh", ["positions", "triangles"])
+
+# glTF constants
+_GLB_MAGIC = 0x46546C67
+_CHUNK_JSON = 0x4E4F534A
+_CHUNK_BIN = 0x004E4942
+_ARRAY_BUFFER, _ELEMENT_ARRAY_BUFFER = 34962, 34963
+_COMPONENT_TYPES = {np.dtype(np.int8): 5120, np.dtype(np.uint16): 5123,
+                    np.dtype(np.uint32): 5125}
+
+
+def rtin_grid(elevation):
+    """
+    Resamples a grid to the 2^k + 1 square an RTIN needs, bilinearly
+
+    The corners stay put, so the grid covers the same area as before.
+    """
+
+    from scipy import ndimage
+
+    elevation = np.asarray(elevation, dtype=np.float64)
+    size = 2 ** math.ceil(math.log2(max(max(elevation.shape) - 1, 1))) + 1
+    if elevation.shape == (size, size):
+        return elevation
+
+    rows = np.linspace(0, elevation.shape[0] - 1, size)
+    cols = np.linspace(0, elevation.shape[1] - 1, size)
+
+    return ndimage.map_coordinates(elevation, np.meshgrid(rows, cols,
+                                                          indexing='ij'),
+                                   order=1, mode='nearest')
+
+
+def _triangle_corners(ids, tile_size):
+    """
+    Grid corners of RTIN triangles of one level, from their ids
+
+    Triangle ids encode the path from one of the two top triangles, a bit
+    per split (see Martini); all ids here have the same number of bits.
+
+    Returns
+    -------
+    a, b, c : np.ndarray
+        (x, y) corner columns, with a-b being the hypotenuse.
+    """
+
+    shape = (ids.size, 2)
+    a, b, c = (np.zeros(shape, dtype=np.int64) for _ in range(3))
+    odd = (ids & 1).astype(bool)
+    # the bottom-left and top-right halves of the whole grid
+    b[odd], c[odd, 0] = tile_size, tile_size
+    a[~odd], c[~odd, 1] = tile_size, tile_size
+
+    ids = ids >> 1
+    for _ in range(int(ids[0]).bit_length() - 1):
+        middle = (a + b) >> 1
+        left = (ids & 1).astype(bool)[:, np.newaxis]
+        a, b = np.where(left, c, b), np.where(left, a, c)
+        c = middle
+        ids = ids >> 1
+
+    return a, b, c
+
+
+@lru_cache(maxsize=None)
+def _triangle_template(leg_a, leg_b):
+    """
+    Grid points within a triangle with a corner at the origin
+
+    Returns
+    -------
+    offsets : np.ndarray
+        (x, y) grid offsets of the points from the corner.
+
+    s, t : np.ndarray
+        Their coordinates along the two legs, as fractions of the legs.
+    """
+
+    corners = np.array([(0, 0), leg_a, leg_b])
+    low, high = corners.min(axis=0), corners.max(axis=0)
+    xs, ys = np.meshgrid(np.arange(low[0], high[0] + 1),
+                         np.arange(low[1], high[1] + 1))
+    offsets = np.stack([xs.ravel(), ys.ravel()], axis=-1)
+
+    s, t = np.linalg.solve(np.array([leg_a, leg_b], dtype=np.float64).T,
+                           offsets.T)
+    inside = (s >= -1e-9) & (t >= -1e-9) & (s + t <= 1 + 1e-9)
+
+    return offsets[inside], s[inside], t[inside]
+
+
+def _triangle_errors(terrain, size, a, b, c):
+    """
+    Largest vertical distance between the grid and each triangle
+
+    All the triangles of an RTIN level are the same shape, in one of a few
+    orientations, so the grid points within them come from a handful of
+    templates, each applied to all its triangles at once.
+    """
+
+    def _heights(points):
+        return terrain[points[..., 1] * size + points[..., 0]]
+
+    errors = np.empty(len(a))
+    legs = np.concatenate([a - c, b - c], axis=1)
+    # the legs are all the same length, so their directions tell the
+    # orientations apart; cheaper than a np.unique over the rows
+    orientations = (np.sign(legs) + 1) @ (27, 9, 3, 1)
+
+    for orientation in np.flatnonzero(np.bincount(orientations)):
+        members = np.flatnonzero(orientations == orientation)
+        leg_a, leg_b = legs[members[0]].reshape(2, 2).tolist()
+        offsets, s, t = _triangle_template(tuple(leg_a), tuple(leg_b))
+        z_a, z_b, z_c = (_heights(corner[members])[:, np.newaxis]
+                         for corner in (a, b, c))
+        planes = z_c + s * (z_a - z_c) + t * (z_b - z_c)
+        heights = _heights(c[members, np.newaxis, :] + offsets)
+        errors[members] = np.abs(planes - heights).max(axis=1)
+
+    return errors
+
+
+def rtin_errors(grid):
+    """
+    Approximation error at every vertex of an RTIN over a grid
+
+    The error of a vertex is the largest vertical distance between the grid
+    and the two triangles whose hypotenuse it splits, or any of the
+    triangles below them. Splitting triangles until their error is within a
+    bound then never leaves cracks between neighbouring triangles, and no
+    grid point is further off the mesh than that bound.
+
+    Parameters
+    ----------
+    grid : np.ndarray
+        Square elevation grid of 2^k + 1 pixels a side, see `rtin_grid`.
+
+    Returns
+    -------
+    errors : np.ndarray
+        Float64 array of the grid shape.
+    """
+
+    size = grid.shape[0]
+    tile_size = size - 1
+    if grid.shape != (size, size) or tile_size & (tile_size - 1):
+        raise ValueError("Need a square grid of 2^k + 1 pixels a side")
+
+    terrain = np.asarray(grid, dtype=np.float64).ravel()
+    errors = np.zeros(size * size)
+    n_levels = 2 * int(math.log2(tile_size))
+
+    # from the smallest triangles up, so that the children are done first
+    for level in range(n_levels, 0, -1):
+        ids = np.arange(2 ** level, 2 ** (level + 1), dtype=np.int64)
+        a, b, c = _triangle_corners(ids, tile_size)
+        middle = (a + b) >> 1
+        error = _triangle_errors(terrain, size, a, b, c)
+
+        if level < n_levels:
+            left = (a + c) >> 1
+            right = (b + c) >> 1
+            error = np.maximum.reduce([
+                error, errors[left[:, 1] * size + left[:, 0]],
+                errors[right[:, 1] * size + right[:, 0]]])
+        # two triangles share every hypotenuse
+        np.maximum.at(errors, middle[:, 1] * size + middle[:, 0], error)
+
+    return errors.reshape(size, size)
+
+
+def rtin_triangles(errors, max_error):
+    """
+    Triangles of an RTIN within a maximum error
+
+    Returns
+    -------
+    vertices : np.ndarray
+        (row, col) grid positions of the vertices used.
+
+    triangles : np.ndarray
+        Vertex index triplets.
+    """
+
+    size = errors.shape[0]
+    tile_size = size - 1
+    flat_errors = errors.ravel()
+
+    # the two top-level triangles, as (x, y) corners
+    a = np.array([[0, 0], [tile_size, tile_size]])
+    b = np.array([[tile_size, tile_size], [0, 0]])
+    c = np.array([[tile_size, 0], [0, tile_size]])
+
+    done = []
+    while a.size:
+        middle = (a + b) >> 1
+        # the smallest triangles, with legs one pixel long, are left as is
+        splittable = np.abs(a - c).sum(axis=1) > 1
+        split = splittable & (flat_errors[middle[:, 1] * size
+                                          + middle[:, 0]] > max_error)
+
+        done.append(np.stack([a[~split], b[~split], c[~split]], axis=1))
+        a, b, c, middle = a[split], b[split], c[split], middle[split]
+        a, b, c = (np.concatenate([c, b]), np.concatenate([a, c]),
+                   np.concatenate([middle, middle]))
+
+    corners = np.concatenate(done)  # (triangles, 3, xy)
+    vertex_ids, triangles = np.unique(corners[..., 1] * size
+                                      + corners[..., 0],
+                                      return_inverse=True)
+
+    return (np.stack(np.divmod(vertex_ids, size), axis=-1),
+            triangles.reshape(-1, 3))
+
+
+def build_meshes(elevation, pixel_size, max_errors=(5,),
+                 vertical_exaggeration=1):
+    """
+    Error-bounded terrain meshes of an elevation grid
+
+    Parameters
+    ----------
+    elevation : np.ndarray
+        Elevation grid in meters, rows running north to south.
+
+    pixel_size : float or tuple of float
+        Pixel size in meters, or a (row, column) pair of them.
+
+    max_errors : sequence of float, default: (5,)
+        Largest vertical error allowed, in meters, one mesh for each;
+        e.g. (20, 5, 1) for three levels of detail, coarse to fine.
+
+    vertical_exaggeration : float, default: 1
+        Factor to scale the elevation by.
+
+    Returns
+    -------
+    meshes : list of Mesh
+        One for every maximum error.
+    """
+
+    pixel_h, pixel_w = np.broadcast_to(pixel_size, 2)
+    height = (elevation.shape[0] - 1) * pixel_h
+    width = (elevation.shape[1] - 1) * pixel_w
+
+    grid = rtin_grid(elevation)
+    errors = rtin_errors(grid)
+    tile_size = grid.shape[0] - 1
+
+    meshes = []
+    for max_error in max_errors:
+        vertices, triangles = rtin_triangles(errors, max_error)
+        rows, cols = vertices[:, 0], vertices[:, 1]
+        positions = np.stack([
+            cols / tile_size * width - width / 2,
+            grid[rows, cols] * vertical_exaggeration,
+            rows / tile_size * height - height / 2], axis=-1)
+
+        # counter-clockwise when seen from above, i.e. normals up
+        edge_1 = positions[triangles[:, 1]] - positions[triangles[:, 0]]
+        edge_2 = positions[triangles[:, 2]] - positions[triangles[:, 0]]
+        down = np.cross(edge_1, edge_2)[:, 1] < 0
+        triangles[down] = triangles[down][:, ::-1]
+
+        meshes.append(Mesh(positions.astype(np.float32),
+                           triangles.astype(np.uint32)))
+
+    return meshes
+
+
+def vertex_normals(mesh):
+    """Unit vertex normals, averaged over the faces weighted by area"""
+
+    positions = mesh.positions.astype(np.float64)
+    corners = positions[mesh.triangles]
+    faces = np.cross(corners[:, 1] - corners[:, 0],
+                     corners[:, 2] - corners[:, 0])
+
+    normals = np.zeros_like(positions)
+    for i in range(3):
+        np.add.at(normals, mesh.triangles[:, i], faces)
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+
+    return normals / np.where(lengths > 0, lengths, 1)
+
+
+class _GLBBuilder:
+    """Collects the buffer views and accessors of a binary glTF"""
+
+    def __init__(self):
+        self.binary = io.BytesIO()
+        self.buffer_views = []
+        self.accessors = []
+
+    def add(self, array, target, accessor_type, byte_stride=None,
+            normalized=False, min_max=False):
+        """Appends an array as a buffer view with an accessor, returns it"""
+
+        # buffer views start on 4-byte boundaries
+        self.binary.write(b'\0' * (-self.binary.tell() % 4))
+        view = {"buffer": 0, "byteOffset": self.binary.tell(),
+                "byteLength": array.nbytes, "target": target}
+        if byte_stride:
+            view["byteStride"] = byte_stride
+        self.binary.write(np.ascontiguousarray(array).tobytes())
+        self.buffer_views.append(view)
+
+        n_components = {"SCALAR": 1, "VEC3": 3}[accessor_type]
+        values = array.reshape(len(array), -1)[:, :n_components]
+        accessor = {"bufferView": len(self.buffer_views) - 1,
+                    "componentType": _COMPONENT_TYPES[array.dtype],
+                    "count": len(array), "type": accessor_type}
+        if normalized:
+            accessor["normalized"] = True
+        if min_max:
+            accessor["min"] = values.min(axis=0).tolist()
+            accessor["max"] = values.max(axis=0).tolist()
+        self.accessors.append(accessor)
+
+        return len(self.accessors) - 1
+
+
+def to_glb(meshes, names=None, normals=True):
+    """
+    Binary glTF of one or more meshes, with quantized vertices
+
+    Positions are stored as 16-bit integers over the mesh bounding box,
+    with the node transform scaling them back to meters, and normals as
+    8-bit ones, per KHR_mesh_quantization; that's 8 + 4 bytes a vertex.
+    Every mesh gets a scene of its own, e.g. for the levels of detail.
+
+    Parameters
+    ----------
+    meshes : list of Mesh
+
+    names : list of str, optional
+        Names of the meshes, their nodes, and scenes.
+
+    normals : bool, default: True
+        Whether to include vertex normals, for smooth shading.
+
+    Returns
+    -------
+    glb : bytes
+    """
+
+    names = names or [f"mesh_{i}" for i in range(len(meshes))]
+    builder = _GLBBuilder()
+    gltf_meshes, nodes = [], []
+
+    for mesh, name in zip(meshes, names):
+        low = mesh.positions.min(axis=0).astype(np.float64)
+        scale = (mesh.positions.max(axis=0) - low) / 65535
+        scale[scale == 0] = 1
+        quantized = np.zeros((len(mesh.positions), 4), dtype=np.uint16)
+        quantized[:, :3] = np.round((mesh.positions - low) / scale)
+        attributes = {"POSITION": builder.add(quantized, _ARRAY_BUFFER,
+                                              "VEC3", byte_stride=8,
+                                              min_max=True)}
+
+        if normals:
+            # stored stretched by the node scale, which the renderers then
+            # undo along with the non-uniform scaling of the positions
+            stretched = vertex_normals(mesh) * scale
+            stretched /= np.linalg.norm(stretched, axis=1, keepdims=True)
+            packed = np.zeros((len(mesh.positions), 4), dtype=np.int8)
+            packed[:, :3] = np.round(stretched * 127)
+            attributes["NORMAL"] = builder.add(packed, _ARRAY_BUFFER, "VEC3",
+                                               byte_stride=4, normalized=True)
+
+        index_dtype = np.uint16 if len(mesh.positions) < 2**16 else np.uint32
+        indices = builder.add(mesh.triangles.ravel().astype(index_dtype),
+                              _ELEMENT_ARRAY_BUFFER, "SCALAR")
+
+        gltf_meshes.append({"name": name, "primitives": [{
+            "attributes": attributes, "indices": indices, "material": 0}]})
+        nodes.append({"name": name, "mesh": len(gltf_meshes) - 1,
+                      "translation": low.tolist(), "scale": scale.tolist()})
+
+    binary = builder.binary.getvalue()
+    binary += b'\0' * (-len(binary) % 4)
+    gltf = {
+        "asset": {"version": "2.0", "generator": "moon.mesh"},
+        "extensionsUsed": ["KHR_mesh_quantization"],
+        "extensionsRequired": ["KHR_mesh_quantization"],
+        "scene": 0,
+        "scenes": [{"name": name, "nodes": [i]}
+                   for i, name in enumerate(names)],
+        "nodes": nodes, "meshes": gltf_meshes,
+        "materials": [{"name": "regolith", "pbrMetallicRoughness": {
+            "baseColorFactor": [0.6, 0.6, 0.6, 1], "metallicFactor": 0,
+            "roughnessFactor": 1}}],
+        "accessors": builder.accessors,
+        "bufferViews": builder.buffer_views,
+        "buffers": [{"byteLength": len(binary)}],
+    }
+    content = json.dumps(gltf, separators=(',', ':')).encode()
+    content += b' ' * (-len(content) % 4)
+
+    return b''.join([
+        struct.pack('<III', _GLB_MAGIC, 2, 12 + 8 + len(content) + 8
+                    + len(binary)),
+        struct.pack('<II', len(content), _CHUNK_JSON), content,
+        struct.pack('<II', len(binary), _CHUNK_BIN), binary])
+
+
+def crater_meshes(crater_name, pad=1.3, size=513, max_errors=(5,),
+                  vertical_exaggeration=1, **kwargs):
+    """
+    Error-bounded meshes of a crater cutout, see `build_meshes`
+
+    The cutout is `size` pixels a side, and `pad` crater diameters across;
+    other keyword arguments go to `moon.io.crater_cutout`.
+    """
+
+    from moon import io as mio
+    from moon.features import LunarFeatures
+    from moon.config import Constants
+
+    _, _, diameter = LunarFeatures().crater_position_size(crater_name)
+    elevation = mio.crater_cutout(crater_name, pad=pad, width=size,
+                                  height=size, **kwargs)
+
+    # the ortho cutout spans about `side` km, corner pixel centres included
+    side = Constants.km_to_deg(diameter * pad)
+    extent = 2 * Constants.lola_dem_moon_radius * math.sin(
+        math.radians(side) / 2)
+
+    return build_meshes(elevation, extent / size, max_errors,
+                        vertical_exaggeration)
+
+
+def main(argv=None):
+    """Command line entry point for the crater meshes"""
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument("crater_name")
+    parser.add_argument("--output", help="output .glb file; defaults to"
+                        " the crater name")
+    parser.add_argument("--pad", type=float, default=1.3)
+    parser.add_argument("--size", type=int, default=513,
+                        help="cutout side in pixels")
+    parser.add_argument("--max-error", type=float, nargs="+", default=[5],
+                        help="vertical error bounds in meters, one level of"
+                        " detail for each")
+    parser.add_argument("--exaggeration", type=float, default=1)
+    args = parser.parse_args(argv)
+
+    meshes = crater_meshes(args.crater_name, args.pad, args.size,
+                           args.max_error, args.exaggeration)
+    fname = args.output or args.crater_name.replace(' ', '_') + '.glb'
+    with open(fname, 'wb') as glbfile:
+        glbfile.write(to_glb(meshes, [f"lod{i}_{max_error:g}m" for i,
+                                      max_error in enumerate(args.max_error)]))
+
+    for max_error, mesh in zip(args.max_error, meshes):
+        print(f"{max_error:g} m: {len(mesh.positions)} vertices,"
+              f" {len(mesh.triangles)} triangles")
+    print(f"Wrote {fname}")
+
+
+if __name__ == '__main__':
+    main()
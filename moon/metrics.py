@@ -0,0 +1,193 @@
+"""
+Opt-in timing spans and counters for the hot paths
+
+The instrumented code calls `span` and `count` unconditionally, and those go
+to whatever hook is installed with `set_hook`. The default hook does
+nothing, so unless someone asks for the numbers (the API does, see
+`lunar_api.py`), the cost is a function call and an attribute lookup:
+>>> from moon import metrics
+>>> recorder = metrics.set_hook(metrics.Recorder())
+>>> with metrics.span("warp"):
+...     pass
+>>> recorder.snapshot()["spans"]["warp"]["count"]
+1
+"""
+
+import bisect
+import threading
+import time
+from contextlib import nullcontext
+
+# upper bucket bounds of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, float("inf"))
+
+_NULL_SPAN = nullcontext()
+
+
+class NullHook:
+    """Default hook, throws everything away"""
+
+    def span(self, name):  # pylint: disable=unused-argument
+        """Context manager timing a block of code"""
+
+        return _NULL_SPAN
+
+    def count(self, name, value=1):
+        """Adds a value to a counter"""
+
+
+class _Span:
+    """Times a `with` block into a `Recorder`"""
+
+    __slots__ = ("recorder", "name", "t_start")
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+        self.t_start = None
+
+    def __enter__(self):
+        self.t_start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.recorder.observe(self.name, time.perf_counter() - self.t_start)
+
+
+class Recorder(NullHook):
+    """
+    Hook that aggregates spans into latency histograms, and sums counters
+
+    Safe to share between threads.
+
+    Parameters
+    ----------
+    buckets : sequence of float
+        Upper bounds of the histogram buckets, in seconds, increasing and
+        ending with infinity.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def span(self, name):
+        return _Span(self, name)
+
+    def observe(self, name, seconds):
+        """Records a duration into the histogram of a span"""
+
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            if name not in self._histograms:
+                self._histograms[name] = {
+                    "counts": [0] * len(self.buckets), "count": 0,
+                    "sum": 0.0, "max": 0.0}
+            histogram = self._histograms[name]
+            histogram["counts"][i] += 1
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+            histogram["max"] = max(histogram["max"], seconds)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def reset(self):
+        """Drops everything recorded so far"""
+
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def snapshot(self):
+        """
+        Copy of the aggregates, JSON-serializable
+
+        Returns
+        -------
+        snapshot : dict
+            With "counters" (name -> total) and "spans" (name -> count,
+            sum, max, mean, and the per-bucket counts keyed by the bucket
+            upper bounds, not cumulative) entries.
+        """
+
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {name: dict(histogram, counts=list(
+                histogram["counts"])) for name, histogram in
+                self._histograms.items()}
+
+        spans = {}
+        for name, histogram in histograms.items():
+            spans[name] = {
+                "count": histogram["count"], "sum": histogram["sum"],
+                "max": histogram["max"],
+                "mean": histogram["sum"] / histogram["count"],
+                "buckets": {str(bound): n for bound, n in
+                            zip(self.buckets, histogram["counts"])}}
+
+        return {"counters": counters, "spans": spans}
+
+    def to_prometheus(self, prefix="moon"):
+        """Aggregates in the Prometheus text exposition format"""
+
+        snapshot = self.snapshot()
+        lines = []
+        for name, total in sorted(snapshot["counters"].items()):
+            metric = f"{prefix}_{_sanitize(name)}_total"
+            lines += [f"# TYPE {metric} counter", f"{metric} {total}"]
+
+        metric = f"{prefix}_span_seconds"
+        lines.append(f"# TYPE {metric} histogram")
+        for name, span_stats in sorted(snapshot["spans"].items()):
+            cumulative = 0
+            for bound in self.buckets:
+                cumulative += span_stats["buckets"][str(bound)]
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lines.append(f'{metric}_bucket{{span="{name}",le="{le}"}}'
+                             f" {cumulative}")
+            lines.append(f'{metric}_sum{{span="{name}"}} {span_stats["sum"]}')
+            lines.append(f'{metric}_count{{span="{name}"}}'
+                         f' {span_stats["count"]}')
+
+        return "\n".join(lines) + "\n"
+
+
+def _sanitize(name):
+    """Metric name safe for Prometheus"""
+
+    return "".join(c if c.isalnum() else "_" for c in name)
+
+
+_HOOK = NullHook()
+
+
+def set_hook(hook):
+    """Installs a metrics hook (None for the no-op one), returns it"""
+
+    global _HOOK  # pylint: disable=global-statement
+    _HOOK = hook or NullHook()
+
+    return _HOOK
+
+
+def get_hook():
+    """The currently installed metrics hook"""
+
+    return _HOOK
+
+
+def span(name):
+    """Times a block of code, `with span("warp"): ...`"""
+
+    return _HOOK.span(name)
+
+
+def count(name, value=1):
+    """Adds a value to a named counter"""
+
+    _HOOK.count(name, value)
@@ -0,0 +1,458 @@
+"""
+Crater morphometry over the IAU catalogue: depth, rim height, profiles
+
+Every crater is cut out at the same pixel size, its side a fixed multiple of
+the crater diameter, and resampled onto a polar grid with the radius in
+units of the diameter. The grid offsets are the same for all the craters,
+so they're worked out once; what differs between the cutouts is a scale
+and a shift, applied to a whole batch of them at once. Radial profiles and
+the summary numbers are then reductions over the stacked polar arrays.
+
+Call it from command line as `python -m moon.morphometry`, e.g.:
+$ python -m moon.morphometry morphometry.npz --min-diameter 10 -j 8
+"""
+
+import os
+import sys
+import argparse
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from moon.config import Paths, Constants
+
+# per-process reprojection engine for the pool workers, see `_init_worker`
+_WORKER_ENGINE = None
+
+# radii, in crater diameters, of the zones the summary numbers come from:
+# the floor, where to look for the rim crest, and the surrounding terrain
+FLOOR_ZONE = (0, 0.2)
+RIM_ZONE = (0.3, 0.8)
+SURROUNDINGS_ZONE = (1.0, 1.5)
+
+
+class PolarGrid:
+    """
+    Polar sampling grid normalized to the crater diameter
+
+    Parameters
+    ----------
+    n_radii : int, default: 60
+        Number of radii, evenly spaced from the centre to `max_radius`.
+
+    n_azimuths : int, default: 72
+        Number of azimuths, clockwise from north.
+
+    max_radius : float, default: 1.5
+        Outermost radius, in crater diameters (the rim is at about 0.5).
+    """
+
+    def __init__(self, n_radii=60, n_azimuths=72, max_radius=1.5):
+        self.radii = np.linspace(0, max_radius, n_radii)
+        self.azimuths = np.arange(n_azimuths) * 360 / n_azimuths
+        self.max_radius = max_radius
+
+        # unit offsets east and north, shared by all the craters
+        azimuths = np.radians(self.azimuths)
+        self._east = self.radii[:, np.newaxis] * np.sin(azimuths)
+        self._north = self.radii[:, np.newaxis] * np.cos(azimuths)
+
+    @property
+    def shape(self):
+        """(radii, azimuths)"""
+
+        return self._east.shape
+
+    def pixel_coords(self, diameters, extents, shape):
+        """
+        Fractional (row, col) of the grid points in a stack of cutouts
+
+        Parameters
+        ----------
+        diameters : np.ndarray
+            Crater diameters in meters.
+
+        extents : np.ndarray
+            (x_min, y_min, x_max, y_max) orthographic bounds of the cutouts,
+            centred on the craters, in meters; one row per crater.
+
+        shape : tuple of int
+            (height, width) of the cutouts.
+
+        Returns
+        -------
+        rows, cols : np.ndarray
+            Of shape (craters, radii, azimuths).
+        """
+
+        radius = Constants.lola_dem_moon_radius
+        diameters = np.asarray(diameters, dtype=np.float64)
+        x_min, y_min, x_max, y_max = (np.asarray(extents, dtype=np.float64)
+                                      .T[:, :, np.newaxis, np.newaxis])
+
+        # orthographic distance from the centre along the surface arc; the
+        # same for any centre, so the offsets only need the scaling
+        arc = diameters[:, np.newaxis, np.newaxis] * self.radii[
+            :, np.newaxis] / radius
+        scale = radius * np.sin(arc) / np.where(self.radii[:, np.newaxis],
+                                                self.radii[:, np.newaxis], 1)
+        x, y = scale * self._east, scale * self._north
+
+        cols = (x - x_min) / (x_max - x_min) * shape[1] - 0.5
+        rows = (y_max - y) / (y_max - y_min) * shape[0] - 0.5
+
+        return rows, cols
+
+    def resample(self, cutouts, rows, cols):
+        """
+        Bilinear values of a stack of cutouts at fractional pixel positions
+
+        NaN where a grid point falls outside of its cutout.
+
+        Returns
+        -------
+        polar : np.ndarray
+            Of shape (craters, radii, azimuths).
+        """
+
+        n_craters, height, width = cutouts.shape
+        flat = cutouts.reshape(-1)
+        offsets = (np.arange(n_craters) * height * width)[:, np.newaxis,
+                                                          np.newaxis]
+
+        row_0 = np.clip(np.floor(rows).astype(np.int64), 0, height - 2)
+        col_0 = np.clip(np.floor(cols).astype(np.int64), 0, width - 2)
+        t_row, t_col = rows - row_0, cols - col_0
+        first = offsets + row_0 * width + col_0
+
+        polar = ((1 - t_row) * ((1 - t_col) * flat[first]
+                                + t_col * flat[first + 1])
+                 + t_row * ((1 - t_col) * flat[first + width]
+                            + t_col * flat[first + width + 1]))
+
+        outside = ((rows < 0) | (rows > height - 1)
+                   | (cols < 0) | (cols > width - 1))
+        polar[outside] = np.nan
+
+        return polar
+
+
+def _zone(grid, zone):
+    """Boolean mask of the grid radii within a (min, max) zone"""
+
+    return (grid.radii >= zone[0]) & (grid.radii <= zone[1])
+
+
+def rim_circularity(rim_radii, azimuths):
+    """
+    Circularity of the rim crest polygons, 4 pi area / perimeter^2
+
+    One for a circle, less for anything else, NaN if any of the rim radii
+    is missing.
+
+    Parameters
+    ----------
+    rim_radii : np.ndarray
+        Rim crest radius per crater and azimuth, (craters, azimuths).
+
+    azimuths : np.ndarray
+        The azimuths, in degrees, evenly spaced all around.
+    """
+
+    step = np.radians(azimuths[1] - azimuths[0])
+    next_radii = np.roll(rim_radii, -1, axis=1)
+
+    area = 0.5 * np.sum(rim_radii * next_radii * np.sin(step), axis=1)
+    perimeter = np.sum(np.sqrt(rim_radii**2 + next_radii**2 - 2 * rim_radii
+                               * next_radii * np.cos(step)), axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return 4 * np.pi * area / perimeter**2
+
+
+def summarize(polar, grid, diameters):
+    """
+    Radial profiles and summary numbers of a stack of polar elevation grids
+
+    Parameters
+    ----------
+    polar : np.ndarray
+        Elevation in meters, (craters, radii, azimuths), see `PolarGrid`.
+
+    grid : PolarGrid
+
+    diameters : np.ndarray
+        Crater diameters, in km.
+
+    Returns
+    -------
+    columns : dict
+        Column name -> np.ndarray with a value per crater; "profile" holds
+        the azimuthally averaged radial profiles, (craters, radii).
+    """
+
+    n_craters = len(polar)
+    diameters = np.asarray(diameters, dtype=np.float64)
+
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        # all-NaN zones, e.g. cutouts off the edge, give NaNs, loudly
+        warnings.simplefilter('ignore', RuntimeWarning)
+
+        profile = np.nanmean(polar, axis=2)
+
+        # robust against central peaks, which the minimum wouldn't be
+        floor = np.nanpercentile(polar[:, _zone(grid, FLOOR_ZONE)].reshape(
+            n_craters, -1), 10, axis=1)
+        surroundings = np.nanmedian(polar[:, _zone(
+            grid, SURROUNDINGS_ZONE)].reshape(n_craters, -1), axis=1)
+
+        # rim crest: the highest point along every azimuth
+        rim_zone = _zone(grid, RIM_ZONE)
+        rim_polar = np.where(np.isnan(polar[:, rim_zone]), -np.inf,
+                             polar[:, rim_zone])
+        crest = np.argmax(rim_polar, axis=1)
+        rim_crest = np.take_along_axis(rim_polar, crest[:, np.newaxis],
+                                       axis=1)[:, 0]
+        # argmax says 0 for the azimuths with no data at all, masked here
+        no_crest = np.isinf(rim_crest)
+        rim_crest[no_crest] = np.nan
+        rim_radii = np.where(no_crest, np.nan, grid.radii[rim_zone][crest])
+        rim_elevation = np.nanmean(rim_crest, axis=1)
+        rim_diameter = 2 * np.nanmean(rim_radii, axis=1) * diameters
+
+    depth = rim_elevation - floor
+
+    return {"floor_elevation": floor,
+            "rim_elevation": rim_elevation,
+            "surroundings_elevation": surroundings,
+            "depth": depth,
+            "rim_height": rim_elevation - surroundings,
+            "depth_to_diameter": depth / (diameters * 1000),
+            "rim_diameter": rim_diameter,
+            "circularity": rim_circularity(rim_radii, grid.azimuths),
+            "profile": profile}
+
+
+def measure_craters(engine, lons, lats, diameters, grid=None, size=128,
+                    pad=3.2):
+    """
+    Morphometry of a batch of craters
+
+    Parameters
+    ----------
+    engine : moon.warp.WarpEngine
+        Engine to make the cutouts with.
+
+    lons, lats, diameters : np.ndarray
+        Crater centres in degrees, diameters in km.
+
+    grid : PolarGrid, optional
+        Polar grid to resample onto, the default one if not given.
+
+    size : int, default: 128
+        Cutout side in pixels.
+
+    pad : float, default: 3.2
+        Cutout side in crater diameters; should cover the grid, i.e. be over
+        twice its `max_radius`.
+
+    Returns
+    -------
+    columns : dict
+        See `summarize`.
+    """
+
+    from moon.warp import ortho_extent
+
+    grid = grid or PolarGrid()
+
+    cutouts = np.empty((len(lons), size, size), dtype=np.float32)
+    extents = np.empty((len(lons), 4))
+    for i, (lon, lat, diameter) in enumerate(zip(lons, lats, diameters)):
+        cutouts[i] = engine.warp(lon, lat, diameter * pad,
+                                 convert_km_to_deg=True, size=(size, size),
+                                 dtype=np.float32)
+        # same box as the engine warps, see `WarpEngine.warp`
+        side_lat = Constants.km_to_deg(diameter * pad)
+        extents[i] = ortho_extent(side_lat, side_lat / np.cos(np.radians(
+            lat)), lat)
+
+    rows, cols = grid.pixel_coords(np.asarray(diameters) * 1000, extents,
+                                   (size, size))
+    polar = grid.resample(Constants.local_radius(cutouts), rows, cols)
+
+    return summarize(polar, grid, diameters)
+
+
+def select_craters(min_diameter=None, max_diameter=None, names=None):
+    """
+    Names, centres, and diameters of the IAU craters, optionally by size
+
+    Taken from the `LunarFeatures` catalogue, which has all the named
+    features; the craters among them are the ones in the IAU crater table.
+
+    Parameters
+    ----------
+    min_diameter, max_diameter : float, optional
+        Diameter range, in km.
+
+    names : sequence of str, optional
+        Features to measure instead of the IAU craters.
+
+    Returns
+    -------
+    columns : dict
+        With a "name" list of str, and "lon", "lat", and "diameter" (km)
+        arrays, in the order of the catalogue.
+    """
+
+    from moon.catalogue import FeatureCatalogue, NAME_COLUMN
+    from moon.features import LunarFeatures
+
+    catalogue = LunarFeatures().catalogue
+    if names is None:
+        names = FeatureCatalogue.from_csv(os.path.join(
+            Paths.table_dir, Paths.iau_craters_fname))[NAME_COLUMN]
+
+    keep = np.isin(np.char.lower(catalogue[NAME_COLUMN]),
+                   np.char.lower(np.asarray(names, dtype=str)))
+    keep &= catalogue["diameter"] > 0
+    if min_diameter is not None:
+        keep &= catalogue["diameter"] >= min_diameter
+    if max_diameter is not None:
+        keep &= catalogue["diameter"] <= max_diameter
+
+    # plain str names, same as `LunarFeatures` hands out, not np.str_
+    return {"name": catalogue[NAME_COLUMN][keep].tolist(),
+            "lon": catalogue["center_longitude"][keep],
+            "lat": catalogue["center_latitude"][keep],
+            "diameter": catalogue["diameter"][keep]}
+
+
+def _init_worker(source):
+    """Process pool initializer - opens the source once per worker"""
+
+    from moon.warp import WarpEngine
+
+    global _WORKER_ENGINE  # pylint: disable=global-statement
+    _WORKER_ENGINE = WarpEngine(source)
+
+
+def _measure_batch(lons, lats, diameters, grid, size, pad):
+    """Pool task for a batch of craters"""
+
+    return measure_craters(_WORKER_ENGINE, lons, lats, diameters, grid,
+                           size, pad)
+
+
+def run_morphometry(out_fname, craters=None,
+                    source=os.path.join(Paths.data_dir, Paths.tif_fname),
+                    grid=None, size=128, pad=3.2, batch_size=64,
+                    processes=None, log=sys.stderr):
+    """
+    Morphometry of many craters, written into a single columnar .npz file
+
+    Parameters
+    ----------
+    out_fname : str
+        Output .npz path; it gets a column per crater property, plus the
+        `radii` (in diameters) of the `profile` columns.
+
+    craters : dict, optional
+        "name", "lon", "lat", and "diameter" arrays, see `select_craters`;
+        all the IAU craters by default.
+
+    source : str
+        Path or URL of the LOLA GeoTiff.
+
+    grid, size, pad
+        See `measure_craters`.
+
+    batch_size : int, default: 64
+        Craters per pool task.
+
+    processes : int, optional
+        Number of worker processes, defaults to the number of CPUs; 1
+        measures in the calling process.
+
+    log : file-like, optional
+        Where to report progress; None for silence.
+
+    Returns
+    -------
+    columns : dict
+    """
+
+    from moon.warp import WarpEngine
+
+    craters = craters if craters is not None else select_craters()
+    grid = grid or PolarGrid()
+    batches = [slice(start, start + batch_size)
+               for start in range(0, len(craters["name"]), batch_size)]
+
+    def _args(batch):
+        return (craters["lon"][batch], craters["lat"][batch],
+                craters["diameter"][batch], grid, size, pad)
+
+    if processes == 1:
+        engine = WarpEngine(source)
+        try:
+            results = [measure_craters(engine, *_args(batch))
+                       for batch in batches]
+        finally:
+            engine.close()
+    else:
+        with ProcessPoolExecutor(max_workers=processes,
+                                 initializer=_init_worker,
+                                 initargs=(source,)) as executor:
+            results = []
+            # in order, so the rows line up with the crater table
+            for result in executor.map(_measure_batch,
+                                       *zip(*map(_args, batches))):
+                results.append(result)
+                if log and len(results) % 10 == 0:
+                    done = min(len(results) * batch_size,
+                               len(craters["name"]))
+                    print(f"{done}/{len(craters['name'])} craters", file=log)
+
+    # a unicode array even if empty, for np.load without pickles
+    columns = dict(craters, name=np.array(craters["name"], dtype=str))
+    for key in (results[0] if results else {}):
+        columns[key] = np.concatenate([result[key] for result in results])
+    columns["radii"] = grid.radii
+
+    tmp_fname = f"{out_fname}.{os.getpid()}.part.npz"
+    try:
+        np.savez(tmp_fname, **columns)
+        os.replace(tmp_fname, out_fname)
+    finally:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+
+    return columns
+
+
+def main(argv=None):
+    """Command line entry point for the catalogue morphometry"""
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument("output", help="output .npz file")
+    parser.add_argument("--min-diameter", type=float, help="in km")
+    parser.add_argument("--max-diameter", type=float, help="in km")
+    parser.add_argument("--source",
+                        default=os.path.join(Paths.data_dir, Paths.tif_fname))
+    parser.add_argument("--size", type=int, default=128,
+                        help="cutout side in pixels")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("-j", "--processes", type=int)
+    args = parser.parse_args(argv)
+
+    craters = select_craters(min_diameter=args.min_diameter,
+                             max_diameter=args.max_diameter)
+    columns = run_morphometry(args.output, craters, args.source,
+                              size=args.size, batch_size=args.batch_size,
+                              processes=args.processes)
+    print(f"Measured {len(columns['name'])} craters into {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+"""
+Crater outlines over cartopy maps, thousands at a time
+
+All the circles are computed in one go on the sphere, projected with a single
+`transform_points` call, and drawn as one `LineCollection`, instead of one
+shapely polygon and one cartopy artist per crater. Craters too small to be
+seen at the map scale are dropped before any of that.
+"""
+
+import os
+import numpy as np
+from moon.config import Paths, Constants
+
+
+def circle_outlines(lons, lats, radii, n_samples=64,
+                    radius=Constants.moon_radius):
+    """
+    Small circles on a sphere, for arrays of centres and radii
+
+    Parameters
+    ----------
+    lons, lats : array-like
+        Circle centres, in degrees.
+
+    radii : array-like
+        Circle radii along the surface, in meters.
+
+    n_samples : int, default: 64
+        Number of points per circle.
+
+    radius : float
+        Sphere radius, in meters.
+
+    Returns
+    -------
+    lon, lat : np.ndarray
+        Outlines of shape (n_circles, n_samples + 1), in degrees, with the
+        first point repeated at the end to close them.
+    """
+
+    lon0 = np.radians(np.asarray(lons, dtype=float))[:, np.newaxis]
+    lat0 = np.radians(np.asarray(lats, dtype=float))[:, np.newaxis]
+    # angular radii, as seen from the centre of the sphere
+    delta = (np.asarray(radii, dtype=float) / radius)[:, np.newaxis]
+    bearing = np.linspace(0, 2 * np.pi, n_samples + 1)[np.newaxis, :]
+
+    # destination point given the distance and bearing from the centre
+    sin_lat = (np.sin(lat0) * np.cos(delta)
+               + np.cos(lat0) * np.sin(delta) * np.cos(bearing))
+    lat = np.arcsin(np.clip(sin_lat, -1, 1))
+    lon = lon0 + np.arctan2(np.sin(bearing) * np.sin(delta) * np.cos(lat0),
+                            np.cos(delta) - np.sin(lat0) * sin_lat)
+
+    return (np.degrees(lon) + 180) % 360 - 180, np.degrees(lat)
+
+
+def break_jumps(x, y, max_jump):
+    """
+    Breaks the outlines where they jump across the map edge
+
+    Every other vertex of the output is a gap slot: NaN where the outline
+    jumps by more than max_jump in x (matplotlib lifts the pen at NaNs),
+    and a copy of the next vertex everywhere else.
+
+    Returns
+    -------
+    x, y : np.ndarray
+        Outlines of shape (n_outlines, 2 * n_vertices - 1).
+    """
+
+    jump = ~(np.abs(np.diff(x, axis=1)) <= max_jump)  # NaNs count as jumps
+
+    out_x = np.empty((x.shape[0], 2 * x.shape[1] - 1))
+    out_y = np.empty_like(out_x)
+    out_x[:, ::2], out_y[:, ::2] = x, y
+    out_x[:, 1::2] = np.where(jump, np.nan, x[:, 1:])
+    out_y[:, 1::2] = np.where(jump, np.nan, y[:, 1:])
+
+    return out_x, out_y
+
+
+def map_resolution(ax):
+    """Rough scale of a map, in projected units (meters) per display pixel"""
+
+    x_min, x_max = ax.get_xlim()
+    return abs(x_max - x_min) / ax.bbox.width
+
+
+def add_crater_outlines(ax, lons, lats, diameters, min_pixels=2,
+                        n_samples=64, globe=None, **kwargs):
+    """
+    Overplots crater outlines on a cartopy map as a single collection
+
+    Parameters
+    ----------
+    ax : cartopy.mpl.geoaxes.GeoAxes
+        Map to draw on; set its extent and figure size first, the culling
+        goes by the current map scale.
+
+    lons, lats : array-like
+        Crater centres, in degrees.
+
+    diameters : array-like
+        Crater diameters, in km; zero or NaN diameters are skipped.
+
+    min_pixels : float, default: 2
+        Craters smaller than this many pixels across are dropped; set to 0
+        to draw them all.
+
+    n_samples : int, default: 64
+        Number of points per outline.
+
+    globe : cartopy.crs.Globe, optional
+        Globe of the crater coordinates, defaults to the map one.
+
+    **kwargs
+        Passed on to `LineCollection`, e.g. colors, linewidths, alpha.
+
+    Returns
+    -------
+    collection : matplotlib.collections.LineCollection
+    """
+
+    import cartopy.crs as ccrs
+    from matplotlib.collections import LineCollection
+
+    lons, lats, diameters = (np.asarray(values, dtype=float)
+                             for values in (lons, lats, diameters))
+    radii = diameters * 500  # km to m
+
+    keep = np.isfinite(lons) & np.isfinite(lats) & (radii > 0)
+    if min_pixels:
+        keep &= 2 * radii >= min_pixels * map_resolution(ax)
+
+    lon, lat = circle_outlines(lons[keep], lats[keep], radii[keep],
+                               n_samples)
+    geodetic = ccrs.Geodetic(globe=globe or ax.projection.globe)
+    xyz = ax.projection.transform_points(geodetic, lon.ravel(), lat.ravel())
+    x, y = (xyz[:, i].reshape(lon.shape) for i in (0, 1))
+
+    # outlines crossing the map edge come out wrapped around to the other
+    # side, anything jumping over half the map width is one of those
+    x, y = break_jumps(x, y, np.ptp(ax.projection.x_limits) / 2)
+
+    style = {"colors": "white", "linewidths": 0.5, "alpha": 0.6}
+    style.update(kwargs)
+    collection = LineCollection(np.stack([x, y], axis=-1), **style)
+    ax.add_collection(collection, autolim=False)
+
+    return collection
+
+
+def add_catalogue_outlines(ax, fname=os.path.join(
+        Paths.table_dir, Paths.iau_craters_fname), **kwargs):
+    """
+    Overplots the outlines of all the features in an IAU table
+
+    Works for both the craters and the (larger) features tables; keyword
+    arguments are passed on to `add_crater_outlines`.
+    """
+
+    from moon.catalogue import FeatureCatalogue
+
+    catalogue = FeatureCatalogue.from_csv(fname)
+
+    return add_crater_outlines(ax, catalogue["center_longitude"],
+                               catalogue["center_latitude"],
+                               catalogue["diameter"], **kwargs)
@@ -0,0 +1,113 @@
+"""
+Power-of-two overview pyramid for the LOLA GeoTiff
+
+The overviews are written into an external .ovr file next to the GeoTiff,
+which GDAL and rasterio pick up on their own. Cutout functions in `moon.io`
+then read from the coarsest level that still meets the requested resolution.
+
+Call it from command line as `python -m moon.overviews`, e.g.:
+$ python -m moon.overviews --max-factor 256 --resampling average
+"""
+
+import os
+import argparse
+import gdal
+from moon.config import Paths
+
+
+def pyramid_factors(width, height, max_factor=None, min_size=256):
+    """Powers of two to downsample by, until the image fits in min_size"""
+
+    factors = []
+    factor = 2
+    while max(width, height) / factor >= min_size:
+        if max_factor is not None and factor > max_factor:
+            break
+        factors.append(factor)
+        factor *= 2
+
+    return factors
+
+
+def build_overviews(source=os.path.join(Paths.data_dir, Paths.tif_fname),
+                    max_factor=None, resampling="AVERAGE",
+                    compress="DEFLATE", block_size=512, callback=None):
+    """
+    Builds a power-of-two overview pyramid for a GeoTiff
+
+    Parameters
+    ----------
+    source : str
+        Path to the GeoTiff; it's opened read-only, so the overviews are
+        written into a `<source>.ovr` file.
+
+    max_factor : int, optional
+        Largest downsampling factor; by default go on until the coarsest
+        level is about 256 pixels across.
+
+    resampling : str, default: "AVERAGE"
+        GDAL overview resampling method, e.g. "AVERAGE", "NEAREST", "CUBIC".
+
+    compress : str, default: "DEFLATE"
+        Compression of the overview file.
+
+    block_size : int, default: 512
+        Tile size of the overview file.
+
+    callback : callable, optional
+        GDAL progress callback, e.g. `gdal.TermProgress_nocb`.
+
+    Returns
+    -------
+    factors : list of int
+        Downsampling factors of the levels built.
+    """
+
+    dataset = gdal.Open(source, gdal.GA_ReadOnly)
+    if dataset is None:
+        raise RuntimeError(f"Can't open {source}")
+
+    factors = pyramid_factors(dataset.RasterXSize, dataset.RasterYSize,
+                              max_factor)
+
+    config = {"COMPRESS_OVERVIEW": compress,
+              "PREDICTOR_OVERVIEW": "2",  # horizontal differencing for ints
+              "GDAL_TIFF_OVR_BLOCKSIZE": str(block_size),
+              "BIGTIFF_OVERVIEW": "IF_SAFER"}
+    previous = {key: gdal.GetConfigOption(key) for key in config}
+    try:
+        for key, value in config.items():
+            gdal.SetConfigOption(key, value)
+        # each level is computed from the previous one, so this is cheap
+        # compared to reading the full resolution image once
+        dataset.BuildOverviews(resampling, factors, callback=callback)
+    finally:
+        for key, value in previous.items():
+            gdal.SetConfigOption(key, value)
+
+    # the factors are cached by moon.io, make sure it sees the new ones
+    from moon import io as mio
+    mio._cached_overview_factors.cache_clear()  # pylint: disable=W0212
+
+    return factors
+
+
+def main(argv=None):
+    """Command line entry point for building the overviews"""
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument("--source", default=os.path.join(
+        Paths.data_dir, Paths.tif_fname), help="LOLA GeoTiff path")
+    parser.add_argument("--max-factor", type=int)
+    parser.add_argument("--resampling", default="AVERAGE")
+    parser.add_argument("--compress", default="DEFLATE")
+    args = parser.parse_args(argv)
+
+    factors = build_overviews(args.source, args.max_factor,
+                              args.resampling.upper(), args.compress,
+                              callback=gdal.TermProgress_nocb)
+    print(f"Built overviews for {args.source}: {factors}")
+
+
+if __name__ == '__main__':
+    main()
@@ -8,8 +8,15 @@ from mayavi import mlab
 from moon import io as mio
 
 
-def make_figure(lon=-11.36, lat=-43.31, side=5, title=None, warp_scale=0.2):
-    """Plotting interactive crater DEM data with mayavi"""
+def make_figure(lon=-11.36, lat=-43.31, side=5, title=None, warp_scale=0.2,
+                max_error=None):
+    """
+    Plotting interactive crater DEM data with mayavi
+
+    With a `max_error` (in meters), the DEM is drawn as a simplified
+    triangle mesh within that vertical error instead of the full grid, see
+    `moon.mesh`; a lot lighter for the large craters.
+    """
 
     range_lon = lon - side / 2, lon + side / 2
     range_lat = lat - side / 2, lat + side / 2
@@ -18,8 +25,22 @@ def make_figure(lon=-11.36, lat=-43.31, side=5, title=None, warp_scale=0.2):
     #dem_arr = mio.square_cutout(lon, lat, side)
     dem_arr = mio.read_warped_window(lon, lat, side)
 
-    surf = mlab.surf(range_lat, range_lon, dem_arr,
-                     warp_scale=warp_scale, colormap='gist_earth')
+    if max_error is None:
+        surf = mlab.surf(range_lat, range_lon, dem_arr,
+                         warp_scale=warp_scale, colormap='gist_earth')
+    else:
+        from moon.mesh import build_meshes
+
+        # "pixel sizes" in degrees, so that the mesh x/z come out in them
+        mesh, = build_meshes(dem_arr, (side / (dem_arr.shape[0] - 1),
+                                       side / (dem_arr.shape[1] - 1)),
+                             (max_error,))
+        x, elevation, z = mesh.positions.T
+        # laid out the same as mlab.surf does the grid above: row i at
+        # range_lat[0] + i * step, column j at range_lon[0] + j * step
+        surf = mlab.triangular_mesh(lat + z, lon + x, elevation * warp_scale,
+                                    mesh.triangles, scalars=elevation,
+                                    colormap='gist_earth')
     # TODO: can set a satellite texture on it with
     # surf.actor.actor.texture = optical_moon_image
     if title:
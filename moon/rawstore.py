@@ -0,0 +1,171 @@
+"""
+Uncompressed, memory-mappable copy of the LOLA GeoTiff
+
+The GeoTiff is converted once into a flat row-major int16 file plus a small
+JSON sidecar with its georeferencing. Reading a window out of it afterwards
+is just slicing an `np.memmap`: no decoding, no copies, and the pages are
+shared between all the processes mapping the same file.
+
+Call it from command line as `python -m moon.rawstore` to do the conversion.
+"""
+
+import os
+import json
+import argparse
+import threading
+import numpy as np
+from moon.config import Paths, Constants
+
+SIDECAR_SUFFIX = '.json'
+
+
+def convert_to_raw(source=os.path.join(Paths.data_dir, Paths.tif_fname),
+                   dest=os.path.join(Paths.data_dir, Paths.raw_fname),
+                   max_memory=256 * 1024**2):
+    """
+    Converts a GeoTiff into a raw row-major file with a JSON sidecar
+
+    Parameters
+    ----------
+    source : str
+        Path or URL of the GeoTiff.
+
+    dest : str
+        Path of the raw file, the sidecar goes next to it as `<dest>.json`.
+
+    max_memory : int, default: 256 MB
+        Rough peak memory budget for the windows read from the GeoTiff.
+
+    Returns
+    -------
+    dest : str
+    """
+
+    import rasterio
+    from rasterio.windows import Window
+    from moon.blocks import plan_windows
+
+    with rasterio.open(source) as reader:
+        dtype = np.dtype(reader.dtypes[0])
+        shape = reader.height, reader.width
+        sidecar = {"shape": shape, "dtype": dtype.str,
+                   "transform": tuple(reader.transform)[:6],
+                   "crs": reader.crs.to_wkt(), "nodata": reader.nodata,
+                   "scale": Constants.lola_dem_scaling_factor}
+
+        tmp_dest = f"{dest}.part"
+        raw = np.memmap(tmp_dest, dtype=dtype, mode='w+', shape=shape)
+        for row_off, col_off, height, width in plan_windows(
+                *shape, reader.block_shapes[0],
+                max_memory // dtype.itemsize):
+            raw[row_off:row_off + height, col_off:col_off + width] = \
+                reader.read(1, window=Window(col_off, row_off, width, height))
+        raw.flush()
+        del raw
+
+    with open(f"{tmp_dest}{SIDECAR_SUFFIX}", 'w') as jsonfile:
+        json.dump(sidecar, jsonfile, indent=2)
+
+    # sidecar goes last, its presence means the raw file is complete
+    os.replace(tmp_dest, dest)
+    os.replace(f"{tmp_dest}{SIDECAR_SUFFIX}", dest + SIDECAR_SUFFIX)
+
+    return dest
+
+
+class RawDEM:
+    """
+    Read-only memory-mapped elevation model made by `convert_to_raw`
+
+    Parameters
+    ----------
+    path : str
+        Path to the raw file, with the `<path>.json` sidecar next to it.
+    """
+
+    def __init__(self, path=os.path.join(Paths.data_dir, Paths.raw_fname)):
+        with open(path + SIDECAR_SUFFIX) as jsonfile:
+            self.meta = json.load(jsonfile)
+
+        self.path = path
+        self.shape = tuple(self.meta["shape"])
+        self.dtype = np.dtype(self.meta["dtype"])
+        self.transform = tuple(self.meta["transform"])
+        self.data = np.memmap(path, dtype=self.dtype, mode='r',
+                              shape=self.shape)
+
+        self._lonlat_to_xy = None
+        self._lock = threading.Lock()
+
+    @property
+    def lonlat_to_xy(self):
+        """pyproj lon/lat to x/y transformer for the sidecar CRS"""
+
+        if self._lonlat_to_xy is None:
+            with self._lock:
+                if self._lonlat_to_xy is None:
+                    from pyproj import CRS, Transformer
+                    crs = CRS.from_wkt(self.meta["crs"])
+                    self._lonlat_to_xy = Transformer.from_crs(
+                        crs.geodetic_crs, crs, always_xy=True)
+
+        return self._lonlat_to_xy
+
+    def window(self, row_off, col_off, height, width):
+        """Zero-copy view of a pixel window, clipped to the image edges"""
+
+        row_start, col_start = max(row_off, 0), max(col_off, 0)
+        row_stop = min(row_off + height, self.shape[0])
+        col_stop = min(col_off + width, self.shape[1])
+
+        return self.data[row_start:row_stop, col_start:col_stop]
+
+    def xy_to_pixel(self, x, y):
+        """Fractional (row, col) pixel coordinates for projected x/y"""
+
+        x_size, _, x_off, _, y_size, y_off = self.transform
+        rows = (np.asarray(y) - y_off) / y_size
+        cols = (np.asarray(x) - x_off) / x_size
+
+        return rows, cols
+
+    def bounds_window(self, lower_x, lower_y, upper_x, upper_y):
+        """View of the pixels within a projected x/y bounding box"""
+
+        from moon.blocks import bounds_to_windows
+
+        # whole pixels, rounded the same way as for the GeoTiff reads
+        row_off, col_off, height, width = bounds_to_windows(
+            self.transform, lower_x, lower_y, upper_x, upper_y, self.shape)
+
+        return self.window(int(row_off), int(col_off), int(height),
+                           int(width))
+
+    def square(self, lon, lat, side):
+        """View of a lon/lat square, side in degrees; no reprojection"""
+
+        lower_x, lower_y = self.lonlat_to_xy.transform(lon - side / 2,
+                                                       lat - side / 2)
+        upper_x, upper_y = self.lonlat_to_xy.transform(lon + side / 2,
+                                                       lat + side / 2)
+
+        return self.bounds_window(lower_x, lower_y, upper_x, upper_y)
+
+
+def main(argv=None):
+    """Command line entry point for the GeoTiff conversion"""
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument("--source", default=os.path.join(
+        Paths.data_dir, Paths.tif_fname), help="LOLA GeoTiff path or URL")
+    parser.add_argument("--dest", default=os.path.join(
+        Paths.data_dir, Paths.raw_fname), help="raw file to write")
+    parser.add_argument("--max-memory", type=int, default=256 * 1024**2,
+                        help="in bytes")
+    args = parser.parse_args(argv)
+
+    print(f"Wrote {convert_to_raw(args.source, args.dest, args.max_memory)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,404 @@
+"""
+Remote (HTTP/S3) GeoTiff access through a persistent on-disk block cache
+
+Reading windows straight off `Paths.s3_url` turns every read into a bunch of
+small range requests, and nothing is kept between runs. Here the remote file
+is split into fixed-size blocks that are cached on disk (shared by all the
+processes using the same cache folder, capped in size, least recently used
+evicted first), adjacent missing blocks are fetched with a single range
+request, and a few blocks past the requested range can be read ahead.
+
+The file-like `RemoteFile` plugs into rasterio as a custom opener:
+>>> reader = open_remote("https://example.com/dem.tif")
+
+A local stand-in for the remote server, handy for testing, is one call away:
+>>> server = serve_directory("data/", port=8000)  # in a background thread
+"""
+
+import os
+import io
+import hashlib
+import threading
+import urllib.request
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from functools import partial
+from moon.config import Paths
+from moon import metrics
+
+
+def s3_to_https(url, endpoint=None):
+    """
+    Maps s3://bucket/key to an HTTPS URL of a public bucket
+
+    `endpoint` (e.g. "http://localhost:9000" of a local S3 stand-in) is used
+    in the path-style form, endpoint/bucket/key.
+    """
+
+    if not url.startswith("s3://"):
+        return url
+
+    bucket, _, key = url[len("s3://"):].partition('/')
+    if endpoint:
+        return f"{endpoint.rstrip('/')}/{bucket}/{key}"
+
+    return f"https://{bucket}.s3.amazonaws.com/{key}"
+
+
+class BlockCache:
+    """
+    On-disk cache of fixed-size blocks of remote files
+
+    Blocks are separate files named after a hash of the URL and the block
+    index, written atomically, so several processes can share the folder.
+    Access times are kept in file modification times, which is what the
+    least-recently-used eviction goes by.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Folder to keep the blocks in, created if missing.
+
+    block_size : int, default: 256 KB
+        Size of the blocks the files are split into.
+
+    max_bytes : int, default: 2 GB
+        Cap on the total size of the cached blocks.
+    """
+
+    def __init__(self, cache_dir=Paths.remote_cache_dir,
+                 block_size=256 * 1024, max_bytes=2 * 1024**3):
+        self.cache_dir = cache_dir
+        self.block_size = block_size
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        # other processes add blocks too, so this is only an estimate that
+        # gets corrected by a folder scan whenever it goes over the cap
+        self._bytes = self._scan()[1]
+
+    def _path(self, url, index):
+        url_hash = hashlib.sha1(url.encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir,
+                            f"{url_hash}_{self.block_size}_{index}.blk")
+
+    def _scan(self):
+        """Lists the cached blocks as (mtime, path, size), and their size"""
+
+        blocks = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.blk'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                blocks.append((stat.st_mtime, entry.path, stat.st_size))
+
+        return blocks, sum(size for _, _, size in blocks)
+
+    def __contains__(self, url_index):
+        """Whether a (url, block index) is cached; not counted as a hit"""
+
+        return os.path.exists(self._path(*url_index))
+
+    def get(self, url, index):
+        """Cached block bytes, or None"""
+
+        path = self._path(url, index)
+        try:
+            with open(path, 'rb') as blockfile:
+                data = blockfile.read()
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            metrics.count("remote_cache_misses")
+            return None
+
+        with self._lock:
+            self.hits += 1
+        metrics.count("remote_cache_hits")
+        return data
+
+    def put(self, url, index, data):
+        """Stores a block, atomically, evicting old ones if over the cap"""
+
+        path = self._path(url, index)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+        with open(tmp_path, 'wb') as blockfile:
+            blockfile.write(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._bytes += len(data)
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Drops least recently used blocks down to 90% of the cap"""
+
+        blocks, total = self._scan()
+        for _, path, size in sorted(blocks):
+            if total <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+        self._bytes = total
+
+
+class RemoteFile(io.RawIOBase):
+    """
+    Read-only seekable file over HTTP range requests, with a block cache
+
+    Parameters
+    ----------
+    url : str
+        HTTP(S) URL of the file; s3:// URLs are mapped with `s3_to_https`.
+
+    cache : BlockCache, optional
+        Block cache to go through, a default one is made if not given.
+
+    readahead : int, default: 4
+        Number of extra blocks to fetch past each missing range.
+
+    max_request_blocks : int, default: 64
+        Cap on the number of blocks fetched in one range request.
+
+    s3_endpoint : str, optional
+        Endpoint of an S3-compatible server for s3:// URLs.
+    """
+
+    def __init__(self, url, cache=None, readahead=4, max_request_blocks=64,
+                 s3_endpoint=None):
+        super().__init__()
+        self.url = s3_to_https(url, s3_endpoint)
+        self.cache = cache or BlockCache()
+        self.readahead = readahead
+        self.max_request_blocks = max_request_blocks
+        self.requests = 0
+        self.bytes_fetched = 0
+
+        self._pos = 0
+        self._lock = threading.Lock()
+        self.size = self._fetch_size()
+        # a file replaced with a different-sized one shouldn't hit old blocks
+        self._cache_id = f"{self.url}#{self.size}"
+
+    def _fetch_size(self):
+        """Remote file size, from a single-byte range request"""
+
+        request = urllib.request.Request(self.url,
+                                         headers={"Range": "bytes=0-0"})
+        with urllib.request.urlopen(request) as response:
+            content_range = response.headers.get("Content-Range")
+            if content_range:
+                return int(content_range.rsplit('/', 1)[1])
+            # server ignored the range, but then at least tells the length
+            return int(response.headers["Content-Length"])
+
+    def _fetch(self, start_block, stop_block):
+        """Fetches a run of blocks with one range request, caches them"""
+
+        block_size = self.cache.block_size
+        start = start_block * block_size
+        stop = min(stop_block * block_size, self.size)
+
+        request = urllib.request.Request(
+            self.url, headers={"Range": f"bytes={start}-{stop - 1}"})
+        with metrics.span("remote_fetch"), \
+                urllib.request.urlopen(request) as response:
+            data = response.read()
+            if response.status != 206:
+                # no range support - slice what we need out of the lot
+                data = data[start:stop]
+
+        self.requests += 1
+        self.bytes_fetched += len(data)
+        metrics.count("remote_bytes_fetched", len(data))
+
+        blocks = {}
+        for index in range(start_block, stop_block):
+            block = data[(index - start_block) * block_size:
+                         (index - start_block + 1) * block_size]
+            self.cache.put(self._cache_id, index, block)
+            blocks[index] = block
+
+        return blocks
+
+    def read_range(self, start, stop):
+        """Bytes between two offsets, going through the cache"""
+
+        stop = min(stop, self.size)
+        if start >= stop:
+            return b''
+
+        block_size = self.cache.block_size
+        first, last = start // block_size, (stop - 1) // block_size
+        n_blocks = -(-self.size // block_size)
+
+        blocks = {index: self.cache.get(self._cache_id, index)
+                  for index in range(first, last + 1)}
+        missing = [index for index, block in blocks.items() if block is None]
+
+        # coalesce the runs of missing blocks into single range requests,
+        # the last one also reading a few blocks ahead
+        runs = []
+        for index in missing:
+            if (runs and runs[-1][1] == index
+                    and index - runs[-1][0] < self.max_request_blocks):
+                runs[-1][1] = index + 1
+            else:
+                runs.append([index, index + 1])
+        if runs and self.readahead:
+            run_start, run_stop = runs[-1]
+            ahead = run_stop
+            while (ahead < min(run_stop + self.readahead, n_blocks)
+                   and ahead - run_start < self.max_request_blocks
+                   and (self._cache_id, ahead) not in self.cache):
+                ahead += 1
+            runs[-1][1] = ahead
+
+        for run_start, run_stop in runs:
+            fetched = self._fetch(run_start, run_stop)
+            blocks.update({index: block for index, block in fetched.items()
+                           if index in blocks})
+
+        data = b''.join(blocks[index] for index in range(first, last + 1))
+        offset = start - first * block_size
+
+        return data[offset:offset + stop - start]
+
+    @property
+    def stats(self):
+        """Hit/miss counters of the cache and the remote traffic"""
+
+        return {"hits": self.cache.hits, "misses": self.cache.misses,
+                "requests": self.requests,
+                "bytes_fetched": self.bytes_fetched}
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+
+        return self._pos
+
+    def read(self, size=-1):
+        with self._lock:
+            stop = self.size if size is None or size < 0 else self._pos + size
+            data = self.read_range(self._pos, stop)
+            self._pos += len(data)
+
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+
+        return len(data)
+
+
+def open_remote(url, cache=None, readahead=4, s3_endpoint=None):
+    """
+    Opens a remote GeoTiff with rasterio, reading through a block cache
+
+    Returns
+    -------
+    reader : rasterio.DatasetReader
+        With the underlying `RemoteFile` available as `reader.remote_file`
+        for a look at its hit/miss counters.
+    """
+
+    import rasterio
+
+    files = []
+
+    def opener(path, mode='rb'):  # pylint: disable=unused-argument
+        try:
+            remote_file = RemoteFile(path, cache, readahead,
+                                     s3_endpoint=s3_endpoint)
+        except ValueError as err:
+            # rasterio probes the opener with a bogus path, and wants an
+            # OSError for the paths that don't resolve
+            raise FileNotFoundError(path) from err
+        files.append(remote_file)
+        return remote_file
+
+    reader = rasterio.open(url, opener=opener)
+    # GDAL opens the file once, so the first one is the one we read from
+    reader.remote_file = files[0] if files else None
+
+    return reader
+
+
+class RangeHTTPRequestHandler(SimpleHTTPRequestHandler):
+    """Static file handler that also answers single-range requests"""
+
+    def send_head(self):
+        range_header = self.headers.get("Range")
+        path = self.translate_path(self.path)
+        if not range_header or not os.path.isfile(path):
+            return super().send_head()
+
+        size = os.path.getsize(path)
+        first, _, last = range_header.split('=', 1)[1].partition('-')
+        if not first:
+            # suffix range, "bytes=-N" are the last N bytes
+            start, stop = max(size - int(last), 0), size - 1
+        else:
+            start = int(first)
+            stop = min(int(last), size - 1) if last else size - 1
+
+        with open(path, 'rb') as blob:
+            blob.seek(start)
+            content = blob.read(stop - start + 1)
+
+        self.send_response(206)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Range", f"bytes {start}-{stop}/{size}")
+        self.send_header("Content-Length", str(stop - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+        return io.BytesIO(content)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+def serve_directory(directory, port=0, host="127.0.0.1"):
+    """
+    Serves a folder over HTTP, range requests included, in a daemon thread
+
+    Returns
+    -------
+    server : http.server.ThreadingHTTPServer
+        Its URL is `f"http://{host}:{server.server_port}/"`; call
+        `server.shutdown()` when done.
+    """
+
+    handler = partial(RangeHTTPRequestHandler, directory=directory)
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
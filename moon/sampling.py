@@ -0,0 +1,215 @@
+"""
+Interpolated raster values at many arbitrary points, block by block
+
+Every point needs a small stencil of pixels around it (1, 2 x 2, or 4 x 4 of
+them, depending on the interpolation), and those are gathered from the
+GeoTiff blocks they fall into. The points are sorted by block first, so each
+block is decoded once, no matter how many points land in it, and only the
+blocks a batch of points needs are held in memory.
+
+Columns wrap around the image sides (the DEM spans all 360 degrees of
+longitude), rows are clamped at the top and bottom edges.
+"""
+
+import numpy as np
+from moon import metrics
+
+METHODS = ("nearest", "bilinear", "bicubic")
+
+
+def _cubic_weights(t, a=-0.5):
+    """Keys cubic convolution weights of the 4 pixels around offsets t"""
+
+    t = t[:, np.newaxis] - np.arange(-1, 3)  # distances to the 4 pixels
+    t = np.abs(t)
+
+    return np.where(t <= 1, ((a + 2) * t - (a + 3)) * t**2 + 1,
+                    np.where(t < 2, ((a * t - 5 * a) * t + 8 * a) * t - 4 * a,
+                             0))
+
+
+def stencil(coords, method="bilinear"):
+    """
+    First pixel index and interpolation weights along one axis
+
+    Parameters
+    ----------
+    coords : np.ndarray
+        Fractional pixel coordinates, 0 being the centre of the first pixel.
+
+    method : str, default: "bilinear"
+        One of `METHODS`.
+
+    Returns
+    -------
+    first : np.ndarray
+        Index of the first stencil pixel, int64.
+
+    weights : np.ndarray
+        Of shape (len(coords), stencil size), rows summing up to one.
+    """
+
+    coords = np.asarray(coords, dtype=np.float64)
+
+    if method == "nearest":
+        return np.floor(coords + 0.5).astype(np.int64), \
+            np.ones((coords.size, 1))
+
+    floor = np.floor(coords)
+    t = coords - floor
+    if method == "bilinear":
+        return floor.astype(np.int64), np.stack([1 - t, t], axis=-1)
+    if method == "bicubic":
+        return floor.astype(np.int64) - 1, _cubic_weights(t)
+
+    raise ValueError(f"Unknown interpolation method: {method},"
+                     f" pick one of {', '.join(METHODS)}")
+
+
+class BlockSampler:
+    """
+    Samples a raster at fractional pixel coordinates
+
+    Parameters
+    ----------
+    source : rasterio.DatasetReader or np.ndarray
+        Open raster to read blocks from, or a 2D array (e.g. the memory map
+        of `moon.rawstore`) to take the pixels from directly.
+
+    batch_size : int, default: 65536
+        How many points to gather at once; bounds the memory for the stencil
+        indices, and for the blocks held at a time.
+    """
+
+    def __init__(self, source, batch_size=2**16):
+        self.source = source
+        self.batch_size = batch_size
+        self.reads = 0
+
+        if isinstance(source, np.ndarray):
+            self.shape = source.shape
+            self.block_shape = None
+        else:
+            self.shape = (source.height, source.width)
+            self.block_shape = tuple(source.block_shapes[0])
+
+    def _read_block(self, block_row, block_col):
+        """A single decoded block"""
+
+        from rasterio.windows import Window
+
+        block_h, block_w = self.block_shape
+        row_off, col_off = block_row * block_h, block_col * block_w
+        block = self.source.read(1, window=Window(
+            col_off, row_off, min(block_w, self.shape[1] - col_off),
+            min(block_h, self.shape[0] - row_off)))
+        self.reads += 1
+        metrics.count("bytes_read", block.nbytes)
+
+        return block
+
+    def _gather(self, rows, cols, blocks):
+        """
+        Pixel values at integer rows/cols, reading the blocks as needed
+
+        Parameters
+        ----------
+        rows, cols : np.ndarray
+            Pixel indices, within the image.
+
+        blocks : dict
+            (block row, block col) -> blocks already read by the previous
+            batch; reused where this batch needs them.
+
+        Returns
+        -------
+        values : np.ndarray
+
+        blocks : dict
+            The blocks this batch needed, for the next one.
+        """
+
+        if self.block_shape is None:
+            return self.source[rows, cols], blocks
+
+        block_h, block_w = self.block_shape
+        block_rows, block_cols = rows // block_h, cols // block_w
+        n_block_cols = -(-self.shape[1] // block_w)
+        block_ids = block_rows * n_block_cols + block_cols
+
+        # one contiguous run of pixels per block
+        order = np.argsort(block_ids, kind='stable')
+        starts = np.flatnonzero(np.diff(block_ids[order])) + 1
+        values = np.empty(rows.size, dtype=self.source.dtypes[0])
+        needed = {}
+        for run in np.split(order, starts):
+            block_id = (int(block_rows[run[0]]), int(block_cols[run[0]]))
+            block = blocks.get(block_id)
+            if block is None:
+                block = self._read_block(*block_id)
+            needed[block_id] = block
+            values[run] = block[rows[run] - block_id[0] * block_h,
+                                cols[run] - block_id[1] * block_w]
+
+        return values, needed
+
+    def sample(self, rows, cols, method="bilinear"):
+        """
+        Interpolated values at fractional pixel coordinates
+
+        Parameters
+        ----------
+        rows, cols : np.ndarray
+            Pixel coordinates, 0 being the centre of the first pixel.
+
+        method : str, default: "bilinear"
+            One of `METHODS`; "bicubic" is Keys' cubic convolution.
+
+        Returns
+        -------
+        values : np.ndarray
+            Float64, NaN where either coordinate isn't finite.
+        """
+
+        rows, cols = np.broadcast_arrays(np.asarray(rows, dtype=np.float64),
+                                         np.asarray(cols, dtype=np.float64))
+        shape = rows.shape
+        rows, cols = rows.ravel(), cols.ravel()
+        out = np.full(rows.size, np.nan)
+        valid = np.flatnonzero(np.isfinite(rows) & np.isfinite(cols))
+
+        first_row, row_weights = stencil(rows[valid], method)
+        first_col, col_weights = stencil(cols[valid], method)
+        size = row_weights.shape[1]
+        offsets = np.arange(size)
+
+        # sorted by the block the stencil starts in, so that the batches
+        # touch as few blocks as possible, and neighbouring batches share
+        # the blocks on their boundaries
+        height, width = self.shape
+        if self.block_shape is not None:
+            start_rows = np.clip(first_row, 0, height - 1)
+            order = np.lexsort((first_col % width // self.block_shape[1],
+                                start_rows // self.block_shape[0]))
+        else:
+            # by row for the memory maps, to touch the pages in order
+            order = np.argsort(first_row, kind='stable')
+
+        blocks = {}
+        for start in range(0, valid.size, self.batch_size):
+            batch = order[start:start + self.batch_size]
+            stencil_rows = np.clip(first_row[batch, np.newaxis] + offsets,
+                                   0, height - 1)
+            stencil_cols = (first_col[batch, np.newaxis] + offsets) % width
+            stencil_rows, stencil_cols = np.broadcast_arrays(
+                stencil_rows[:, :, np.newaxis],
+                stencil_cols[:, np.newaxis, :])
+
+            values, blocks = self._gather(stencil_rows.ravel(),
+                                          stencil_cols.ravel(), blocks)
+            values = values.reshape(-1, size, size)
+            out[valid[batch]] = np.einsum('ni,nij,nj->n',
+                                          row_weights[batch], values,
+                                          col_weights[batch])
+
+        return out.reshape(shape)
@@ -0,0 +1,206 @@
+"""
+Spatial index over lunar features for nearest and within-radius queries
+
+Feature centres are put on a unit sphere, and a KD-tree over their x/y/z
+coordinates answers the queries, which are then converted back to the
+great-circle distances on the surface of the Moon. All the queries take
+arrays of lon/lat points, so annotating thousands of cutouts is one call.
+"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+from moon.config import Constants
+
+
+def lonlat_to_xyz(lon, lat):
+    """Unit-sphere cartesian coordinates for lon/lat arrays, in degrees"""
+
+    lon, lat = np.radians(lon), np.radians(lat)
+    cos_lat = np.cos(lat)
+
+    return np.stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon),
+                     np.sin(lat)], axis=-1)
+
+
+def chord_to_km(chord):
+    """Converts a unit-sphere chord length into a great-circle distance"""
+
+    angle = 2 * np.arcsin(np.clip(np.asarray(chord) / 2, 0, 1))
+    return angle * Constants.lola_dem_moon_radius / 1000
+
+
+def km_to_chord(dist):
+    """Converts a great-circle distance into a unit-sphere chord length"""
+
+    angle = np.asarray(dist) * 1000 / Constants.lola_dem_moon_radius
+    return 2 * np.sin(np.clip(angle, 0, np.pi) / 2)
+
+
+def great_circle_km(lon1, lat1, lon2, lat2):
+    """Haversine distance between (arrays of) lon/lat points, in km"""
+
+    lon1, lat1, lon2, lat2 = (np.radians(x) for x in (lon1, lat1, lon2, lat2))
+    hav = (np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2)
+           * np.sin((lon2 - lon1) / 2) ** 2)
+
+    return (2 * np.arcsin(np.sqrt(np.clip(hav, 0, 1)))
+            * Constants.lola_dem_moon_radius / 1000)
+
+
+class FeatureIndex:
+    """
+    KD-tree on unit-sphere x/y/z of feature centres
+
+    Parameters
+    ----------
+    lon, lat : array-like
+        Feature centres, in degrees.
+
+    diameter : array-like, optional
+        Feature diameters in km, needed for the `min_diameter` filters.
+
+    Notes
+    -----
+    The queries return indices into the arrays the index was built from.
+    """
+
+    def __init__(self, lon, lat, diameter=None):
+        self.lon = np.asarray(lon, dtype=float)
+        self.lat = np.asarray(lat, dtype=float)
+        self.diameter = (None if diameter is None
+                         else np.asarray(diameter, dtype=float))
+        self.xyz = lonlat_to_xyz(self.lon, self.lat)
+        self.tree = cKDTree(self.xyz)
+
+        # sub-indices of features above a certain diameter, made on demand
+        self._subsets = {}
+
+    def __len__(self):
+        return self.lon.size
+
+    def _subset(self, min_diameter):
+        """(index, original indices) pair over features above min_diameter"""
+
+        if not min_diameter:
+            return self, None
+
+        if self.diameter is None:
+            raise ValueError("Need diameters to filter features by size")
+
+        if min_diameter not in self._subsets:
+            keep = np.flatnonzero(self.diameter >= min_diameter)
+            self._subsets[min_diameter] = (
+                FeatureIndex(self.lon[keep], self.lat[keep],
+                             self.diameter[keep]), keep)
+
+        return self._subsets[min_diameter]
+
+    def nearest(self, lon, lat, k=1, min_diameter=None):
+        """
+        Finds k nearest features to each of the lon/lat points
+
+        Returns
+        -------
+        dist_km : np.ndarray
+            Great-circle distances, shape of `lon` (plus a k axis if k > 1);
+            inf where fewer than k features match.
+
+        idx : np.ndarray
+            Feature indices, same shape as `dist_km`; -1 where fewer than k
+            features match.
+        """
+
+        index, keep = self._subset(min_diameter)
+        xyz = lonlat_to_xyz(lon, lat)
+        if not len(index):
+            # nothing to query, every neighbour is missing
+            shape = xyz.shape[:-1] + ((k,) if k > 1 else ())
+            return np.full(shape, np.inf)[()], np.full(shape, -1)[()]
+
+        chord, idx = index.tree.query(xyz, k=k)
+
+        # not enough features around, scipy pads with the index size (and
+        # an infinite distance, which chord_to_km would clip)
+        missing = idx == len(index)
+        idx = np.where(missing, 0, idx)
+        if keep is not None:
+            idx = keep[idx]
+        idx = np.where(missing, -1, idx)
+
+        return np.where(missing, np.inf, chord_to_km(chord))[()], idx
+
+    def within_radius(self, lon, lat, radius_km, min_diameter=None,
+                      sort=True):
+        """
+        Finds all features within a great-circle radius of lon/lat points
+
+        Returns
+        -------
+        idx : np.ndarray or list of np.ndarray
+            Feature indices, one array per point for array inputs, sorted by
+            distance unless `sort` is False.
+        """
+
+        index, keep = self._subset(min_diameter)
+        xyz = lonlat_to_xyz(lon, lat)
+        scalar = xyz.ndim == 1
+        xyz = np.atleast_2d(xyz)
+        chord = np.broadcast_to(km_to_chord(radius_km), xyz.shape[:1])
+
+        # a tiny bit of slack so that features right on the edge are in
+        found = index.tree.query_ball_point(xyz, chord * (1 + 1e-12))
+
+        results = []
+        for point, idx in zip(xyz, found):
+            idx = np.asarray(idx, dtype=int)
+            if sort and idx.size:
+                dist = np.linalg.norm(index.xyz[idx] - point, axis=1)
+                idx = idx[np.argsort(dist, kind='stable')]
+            results.append(idx if keep is None else keep[idx])
+
+        return results[0] if scalar else results
+
+    def within_square(self, lon, lat, side_km, min_diameter=None):
+        """
+        Finds the features inside a square cutout centred at lon/lat
+
+        The square is taken in the orthographic projection around its centre,
+        same as the one `moon.io.read_warped_window` uses to make cutouts.
+        """
+
+        half_side = np.asarray(side_km) / 2
+        # first a coarse cut on the circumscribed circle, its orthographic
+        # radius turned into the (longer) great-circle one...
+        radius = Constants.lola_dem_moon_radius / 1000
+        radius_km = radius * np.arcsin(np.minimum(
+            half_side * np.sqrt(2) / radius, 1))
+        candidates = self.within_radius(lon, lat, radius_km, min_diameter,
+                                        sort=False)
+        scalar = isinstance(candidates, np.ndarray)
+        if scalar:
+            candidates = [candidates]
+
+        lons = np.broadcast_to(lon, len(candidates))
+        lats = np.broadcast_to(lat, len(candidates))
+        half_sides = np.broadcast_to(half_side, len(candidates))
+
+        # ... then an exact one in the orthographic plane
+        results = []
+        for lon0, lat0, half, idx in zip(lons, lats, half_sides, candidates):
+            x, y = ortho_xy_km(self.lon[idx], self.lat[idx], lon0, lat0)
+            results.append(idx[(np.abs(x) <= half) & (np.abs(y) <= half)])
+
+        return results[0] if scalar else results
+
+
+def ortho_xy_km(lon, lat, lon0, lat0):
+    """Orthographic projection around lon0/lat0 on the lunar sphere, in km"""
+
+    lon, lat, lon0, lat0 = (np.radians(x) for x in (lon, lat, lon0, lat0))
+    radius = Constants.lola_dem_moon_radius / 1000
+
+    x = radius * np.cos(lat) * np.sin(lon - lon0)
+    y = radius * (np.cos(lat0) * np.sin(lat)
+                  - np.sin(lat0) * np.cos(lat) * np.cos(lon - lon0))
+
+    return x, y
@@ -1,40 +1,294 @@
-"""Toying around with moon globe rotatiton"""
+"""
+Toying around with moon globe rotatiton
+
+The frames are rendered on a process pool. The downsampled elevation array
+is put into shared memory once instead of being pickled for every frame, and
+each worker keeps its own figure and orthographic pixel grid around. Encoded
+frames are streamed into the .gif in order as they come in, so only a few of
+them are held in memory at any time. That takes the GIF block encoders of
+Pillow, which aren't a public API; if they're gone, the quantized frames are
+collected and saved with `Image.save(..., save_all=True)` instead.
+
+Call it from command line as `python -m moon.spinning_gif`, e.g.:
+$ python -m moon.spinning_gif --frames 120 --size 1000 --processes 8
+"""
 
 import os
+import argparse
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-import matplotlib.pyplot as plt
-import cartopy.crs as ccrs
-import gif
 from moon.config import Paths, Constants
-from moon.io import load_lola_downsampled
+from moon.warp import ortho_inverse
+
+# per-process renderer for the pool workers, see `_init_worker`
+_WORKER_RENDERER = None
+# the worker's handle on the shared array, has to outlive the renderer
+_WORKER_SHM = None
+
+
+class GlobeRenderer:
+    """
+    Draws orthographic globe views of a global equirectangular map
+
+    One figure is made and reused for all the frames. The reprojection is
+    done here rather than by cartopy: an orthographic view only depends on
+    the central longitude through a shift in longitude, so the output pixel
+    -> lon/lat grid is computed once, and every frame is a nearest-neighbour
+    lookup into the map.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Global map, covering -180..180 in lon and 90..-90 in lat.
+
+    size : int, default: 600
+        Frame side in pixels.
+
+    lat : float, default: -15
+        Central latitude of the views.
+
+    dpi : int, default: 100
+        Figure resolution; only changes the gridline and margin scale.
+    """
+
+    def __init__(self, data, size=600, lat=-15, dpi=100):
+        import cartopy.crs as ccrs
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        self.data = data
+        self.lat = lat
+        self.globe = ccrs.Globe(ellipse=None,  # can remove after #1588/#564
+                                semimajor_axis=Constants.moon_radius,
+                                flattening=Constants.moon_flattening)
+        self.figure = Figure(figsize=(size / dpi, size / dpi), dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+        # fixed color limits, otherwise every frame gets its own colormap
+        self.vmin, self.vmax = np.nanmin(data), np.nanmax(data)
+
+        # pixel centres of the image, on a grid spanning the globe disc
+        radius = Constants.moon_radius
+        xy = (np.arange(size) + 0.5) / size * 2 * radius - radius
+        self._dlon, grid_lat = ortho_inverse(xy[np.newaxis, :],
+                                             xy[::-1, np.newaxis], lat,
+                                             radius)
+        self._outside = np.hypot(xy[np.newaxis, :],
+                                 xy[:, np.newaxis]) > radius
+
+        height, width = data.shape
+        rows = np.round((90 - grid_lat) / 180 * height - 0.5)
+        self._rows = np.clip(rows, 0, height - 1).astype(np.intp)
+
+    def reproject(self, lon):
+        """Orthographic view of the map centred at lon, masked off-disc"""
+
+        width = self.data.shape[1]
+        cols = np.round(((self._dlon + lon + 180) % 360) / 360 * width - 0.5)
+        cols = cols.astype(np.intp) % width
+
+        return np.ma.masked_array(self.data[self._rows, cols],
+                                  mask=self._outside)
+
+    def render(self, lon):
+        """RGB frame of the globe centred at lon"""
+
+        import cartopy.crs as ccrs
+
+        projection = ccrs.Orthographic(lon, self.lat, globe=self.globe)
+        radius = Constants.moon_radius
+
+        self.figure.clf()
+        ax = self.figure.add_subplot(projection=projection)
+        ax.gridlines(color='#252525', linestyle='dotted')
+        # already in the target projection, so cartopy won't regrid it
+        ax.imshow(self.reproject(lon), origin="upper", transform=projection,
+                  extent=(-radius, radius, -radius, radius),
+                  vmin=self.vmin, vmax=self.vmax)
+        ax.set_global()
+
+        self.canvas.draw()
+        return np.asarray(self.canvas.buffer_rgba())[..., :3].copy()
+
+
+def can_stream_frames():
+    """Whether this Pillow has the (undocumented) GIF block encoders"""
+
+    from PIL import GifImagePlugin
+
+    return all(callable(getattr(GifImagePlugin, name, None))
+               for name in ("getheader", "getdata"))
+
+
+def quantize_frame(rgb):
+    """RGB frame as a palette image, with a palette of its own"""
+
+    from PIL import Image
+
+    return Image.fromarray(rgb).quantize(256)
+
 
+def encode_frame(rgb, duration=100):
+    """Quantizes an RGB frame and encodes it as a .gif frame block"""
 
-@gif.frame
-def make_frame(data, globe, transform, lon=-85, lat=-15):
-    """Makes a globe frame for lon/lat pair"""
+    from PIL import GifImagePlugin
 
-    plt.figure(figsize=(6, 6), dpi=100)
+    # every frame carries its own palette, so they're encoded independently
+    return b''.join(GifImagePlugin.getdata(quantize_frame(rgb),
+                                           duration=duration,
+                                           include_color_table=True))
 
-    ax = plt.axes(projection=ccrs.Orthographic(lon, lat, globe=globe))
-    ax.gridlines(color='#252525', linestyle='dotted')
-    ax.imshow(data, origin="upper", transform=transform)
 
+def _init_worker(shm_name, shape, dtype, size, lat, dpi):
+    """Process pool initializer - attaches the map, makes a renderer"""
 
-def main():
+    global _WORKER_RENDERER, _WORKER_SHM  # pylint: disable=global-statement
+    _WORKER_SHM = shared_memory.SharedMemory(name=shm_name)
+    data = np.ndarray(shape, dtype=dtype, buffer=_WORKER_SHM.buf)
+    _WORKER_RENDERER = GlobeRenderer(data, size, lat, dpi)
+
+
+def _render_frame(lon, duration, renderer=None, stream=True):
+    """Renders a single frame, encoded if streaming, else just quantized"""
+
+    renderer = renderer or _WORKER_RENDERER
+    rgb = renderer.render(lon)
+
+    return encode_frame(rgb, duration) if stream else quantize_frame(rgb)
+
+
+def render_gif(data, fname=os.path.join(Paths.fig_dir, "moon.gif"),
+               n_frames=24, size=600, lat=-15, duration=100, dpi=100,
+               processes=None):
+    """
+    Renders a spinning globe .gif of a global map
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Global equirectangular map, e.g. `load_lola_downsampled()`.
+
+    fname : str
+        Output .gif path.
+
+    n_frames : int, default: 24
+        Number of frames for a full turn.
+
+    size : int, default: 600
+        Frame side in pixels.
+
+    lat : float, default: -15
+        Central latitude of the views.
+
+    duration : int, default: 100
+        Frame duration in milliseconds.
+
+    dpi : int, default: 100
+        Figure resolution.
+
+    processes : int, optional
+        Number of worker processes, defaults to the CPU count; 1 renders in
+        the calling process.
+
+    Returns
+    -------
+    fname : str
+    """
+
+    from PIL import Image
+
+    lons = np.linspace(0, 360, n_frames + 1)[:-1]
+    processes = processes or os.cpu_count()
+    stream = can_stream_frames()
+
+    tmp_fname = f"{fname}.part"
+    with open(tmp_fname, 'wb') as giffile:
+        if stream:
+            from PIL import GifImagePlugin
+            header, _ = GifImagePlugin.getheader(
+                Image.new("P", (size, size)), info={"loop": 0})
+            giffile.writelines(header)
+            write, frames = giffile.write, None
+        else:
+            frames = []
+            write = frames.append
+
+        if processes == 1:
+            renderer = GlobeRenderer(data, size, lat, dpi)
+            for i, lon in enumerate(lons):
+                print(f"{i+1}/{n_frames}...")
+                write(_render_frame(lon, duration, renderer, stream))
+        else:
+            shm = shared_memory.SharedMemory(create=True, size=data.nbytes)
+            shared = np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)
+            shared[:] = data
+            try:
+                _stream_frames(write, lons, duration, processes,
+                               (shm.name, data.shape, data.dtype, size, lat,
+                                dpi), stream)
+            finally:
+                # the view has to go before the segment can be closed
+                del shared
+                shm.close()
+                shm.unlink()
+
+        if stream:
+            giffile.write(b";")  # trailer
+        else:
+            frames[0].save(giffile, format="GIF", save_all=True,
+                           append_images=frames[1:], duration=duration,
+                           loop=0)
+
+    os.replace(tmp_fname, fname)
+
+    return fname
+
+
+def _stream_frames(write, lons, duration, processes, initargs, stream=True):
+    """Renders frames on a pool, passing them to `write` in order"""
+
+    # a couple of frames per worker in flight keeps them all busy without
+    # piling up finished frames in memory
+    in_flight = 2 * processes
+    written = 0
+
+    def _write(future):
+        nonlocal written
+        write(future.result())
+        written += 1
+        print(f"{written}/{lons.size}...")
+
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                             initargs=initargs) as executor:
+        pending = []
+        for lon in lons:
+            if len(pending) >= in_flight:
+                _write(pending.pop(0))
+            pending.append(executor.submit(_render_frame, lon, duration,
+                                           None, stream))
+        for future in pending:
+            _write(future)
+
+
+def main(argv=None):
     """Makes a spinning globe .gif of Moon elevation"""
 
-    imdata_small = load_lola_downsampled()
+    from moon.io import load_lola_downsampled
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument("--output", default=os.path.join(Paths.fig_dir,
+                                                         "moon.gif"))
+    parser.add_argument("--frames", type=int, default=24)
+    parser.add_argument("--size", type=int, default=600, help="in pixels")
+    parser.add_argument("--lat", type=float, default=-15)
+    parser.add_argument("--duration", type=int, default=100,
+                        help="frame duration in ms")
+    parser.add_argument("--processes", type=int)
+    args = parser.parse_args(argv)
 
-    moon_globe = ccrs.Globe(ellipse=None,  # can remove after #1588/#564
-                            semimajor_axis=Constants.moon_radius,
-                            flattening=Constants.moon_flattening)
-    transform = ccrs.PlateCarree(globe=moon_globe)
+    render_gif(load_lola_downsampled(), args.output, args.frames, args.size,
+               args.lat, args.duration, processes=args.processes)
 
-    frames = []
-    all_the_angles = np.linspace(0, 360, 25)[:-1]
-    for i, lon in enumerate(all_the_angles):
-        print(f"{i+1}/{all_the_angles.size}...")
-        frame = make_frame(imdata_small, moon_globe, transform, lon)
-        frames.append(frame)
 
-    gif.save(frames, os.path.join(Paths.fig_dir, "moon.gif"), duration=100)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+"""
+Synthetic stand-in for the LOLA GeoTiff, for benchmarks and offline work
+
+Same CRS, dtype, tiling, and scale factor as the real thing, only smaller:
+rolling terrain with parabolic bowls at the IAU crater positions, so that
+crater cutouts show something crater-like. The terrain is a function of the
+pixel position alone, so the output is the same on every run and machine.
+
+Call it from command line as `python -m moon.synthetic`, e.g.:
+$ python -m moon.synthetic /tmp/lola --width 9216
+"""
+
+import os
+import argparse
+import numpy as np
+from moon.config import Paths, Constants
+
+# the real GeoTiff is 92160 x 46080 pixels
+LOLA_WIDTH = 92160
+
+# coarse grid the rolling terrain is interpolated from, and its amplitude
+_TERRAIN_GRID = (32, 64)
+_TERRAIN_AMPLITUDE = 3000  # in meters
+
+
+def _crater_table():
+    """Lon/lat/radius (degrees) of the IAU craters to put bowls at"""
+
+    from moon.catalogue import FeatureCatalogue
+
+    catalogue = FeatureCatalogue.from_csv(
+        os.path.join(Paths.table_dir, Paths.iau_craters_fname))
+    radii = Constants.km_to_deg(catalogue["diameter"]) / 2
+    keep = radii > 0
+
+    return (catalogue["center_longitude"][keep],
+            catalogue["center_latitude"][keep], radii[keep])
+
+
+def synthetic_elevation(lon, lat, craters, seed=0):
+    """
+    Synthetic elevation in meters on a lon/lat grid, in degrees
+
+    Parameters
+    ----------
+    lon : np.ndarray
+        Longitudes of the grid columns, 1D.
+
+    lat : np.ndarray
+        Latitudes of the grid rows, 1D.
+
+    craters : tuple of np.ndarray
+        Crater lon, lat, and radius (in degrees) arrays.
+
+    seed : int, default: 0
+        Seed of the random terrain.
+    """
+
+    from scipy import ndimage
+
+    coarse = np.random.default_rng(seed).standard_normal(_TERRAIN_GRID)
+    rows = (90 - lat) / 180 * _TERRAIN_GRID[0]
+    cols = (lon + 180) / 360 * _TERRAIN_GRID[1]
+    rows, cols = np.meshgrid(rows, cols, indexing='ij')
+    elevation = _TERRAIN_AMPLITUDE * ndimage.map_coordinates(
+        coarse, [rows, cols], order=3, mode='grid-wrap')
+
+    # only the craters overlapping the grid, each a bowl with a raised rim,
+    # evaluated over its bounding box; lon and lat are assumed to be
+    # regular grids, increasing and decreasing respectively
+    crater_lon, crater_lat, crater_radius = craters
+    reach = 1.5 * crater_radius
+    near = ((crater_lat + reach >= lat.min())
+            & (crater_lat - reach <= lat.max()))
+    lon_step, lat_step = lon[1] - lon[0], lat[0] - lat[1]
+    for c_lon, c_lat, radius in zip(crater_lon[near], crater_lat[near],
+                                    crater_radius[near]):
+        lat_reach = 1.5 * radius
+        lon_reach = min(lat_reach / max(np.cos(np.radians(c_lat)), 1e-3),
+                        180)
+        # columns wrap around the antimeridian, rows are clipped
+        cols = np.arange(int((c_lon - lon_reach - lon[0]) // lon_step),
+                         int((c_lon + lon_reach - lon[0]) // lon_step) + 2)
+        cols = np.unique(cols % lon.size)
+        rows = np.arange(max(int((lat[0] - c_lat - lat_reach) // lat_step),
+                             0),
+                         min(int((lat[0] - c_lat + lat_reach) // lat_step)
+                             + 2, lat.size))
+        if not rows.size:
+            continue
+
+        # distance in crater radii, roughly, with the lon scale at c_lat
+        d_lon = (lon[cols] - c_lon + 180) % 360 - 180
+        dist = np.hypot(d_lon[np.newaxis, :] * np.cos(np.radians(c_lat)),
+                        lat[rows][:, np.newaxis] - c_lat) / radius
+        # deeper for larger craters, up to a few km as the basins go
+        depth = min(200 + radius * 1e3, 4000)
+        bowl = np.where(dist < 1, dist**2 - 1,
+                        0.2 * np.sin(2 * np.pi * (dist - 1)))
+        bowl[dist >= 1.5] = 0
+        elevation[np.ix_(rows, cols)] += depth * bowl
+
+    return elevation
+
+
+def make_synthetic_lola(dest, width=LOLA_WIDTH // 10, block_size=256,
+                        compress="DEFLATE", craters=True, seed=0,
+                        overwrite=False):
+    """
+    Writes a synthetic LOLA-like GeoTiff
+
+    Parameters
+    ----------
+    dest : str
+        Output path, e.g. `Paths.tif_fname` in a scratch data folder; no
+        default, so that the real GeoTiff isn't overwritten by accident.
+
+    width : int, default: 9216
+        Image width in pixels, the height is half of it.
+
+    block_size : int, default: 256
+        Side of the internal GeoTiff tiles.
+
+    compress : str, default: "DEFLATE"
+        GeoTiff compression.
+
+    craters : bool, default: True
+        Whether to add bowls at the IAU crater positions.
+
+    seed : int, default: 0
+        Seed of the random terrain.
+
+    overwrite : bool, default: False
+        Whether to remake an existing file.
+
+    Returns
+    -------
+    dest : str
+    """
+
+    import rasterio
+    from rasterio.transform import from_origin
+    from rasterio.windows import Window
+
+    if os.path.exists(dest) and not overwrite:
+        return dest
+
+    height = width // 2
+    radius = Constants.lola_dem_moon_radius
+    pixel_size = 2 * np.pi * radius / width
+    profile = {"driver": "GTiff", "width": width, "height": height,
+               "count": 1, "dtype": "int16",
+               "crs": f"+proj=eqc +R={radius} +units=m +no_defs",
+               "transform": from_origin(-np.pi * radius, np.pi * radius / 2,
+                                        pixel_size, pixel_size),
+               "tiled": True, "blockxsize": block_size,
+               "blockysize": block_size, "compress": compress,
+               "predictor": 2}
+    crater_table = _crater_table() if craters else (np.empty(0),) * 3
+    lon = (np.arange(width) + 0.5) / width * 360 - 180
+
+    os.makedirs(os.path.dirname(os.path.abspath(dest)), exist_ok=True)
+    tmp_dest = f"{dest}.part"
+    with rasterio.open(tmp_dest, 'w', **profile) as writer:
+        # a row of tiles at a time, in bounded memory
+        for row_off in range(0, height, block_size):
+            rows = min(block_size, height - row_off)
+            lat = 90 - (np.arange(row_off, row_off + rows) + 0.5) / height \
+                * 180
+            elevation = synthetic_elevation(lon, lat, crater_table, seed)
+            pixels = np.round(elevation / Constants.lola_dem_scaling_factor)
+            writer.write(pixels.astype(np.int16), 1,
+                         window=Window(0, row_off, width, rows))
+        writer.scales = (Constants.lola_dem_scaling_factor,)
+        writer.offsets = (0,)
+        writer.units = ("m",)
+    os.replace(tmp_dest, dest)
+
+    return dest
+
+
+def main(argv=None):
+    """Command line entry point for making the synthetic GeoTiff"""
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument("data_dir", help="folder to write the GeoTiff into")
+    parser.add_argument("--width", type=int, default=LOLA_WIDTH // 10)
+    parser.add_argument("--block-size", type=int, default=256)
+    parser.add_argument("--no-craters", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--overwrite", action="store_true")
+    args = parser.parse_args(argv)
+
+    dest = make_synthetic_lola(os.path.join(args.data_dir, Paths.tif_fname),
+                               args.width, args.block_size,
+                               craters=not args.no_craters, seed=args.seed,
+                               overwrite=args.overwrite)
+    print(f"Wrote {dest}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""
+Terrain kernels on elevation grids: gradients, slope, hillshade, roughness
+
+Everything takes the pixel sizes in meters. For lon/lat grids the pixel
+width shrinks with latitude, so `dx` can be given per row, as a column
+vector broadcasting against the image (see `lonlat_pixel_sizes`).
+"""
+
+import numpy as np
+from moon.config import Constants
+
+
+def lonlat_pixel_sizes(lats, lon_step, lat_step,
+                       radius=Constants.lola_dem_moon_radius):
+    """
+    Pixel sizes in meters on a lon/lat grid
+
+    Parameters
+    ----------
+    lats : array-like
+        Latitudes of the grid rows, in degrees.
+
+    lon_step, lat_step : float
+        Pixel sizes in degrees.
+
+    Returns
+    -------
+    dx : np.ndarray
+        Pixel widths, a (rows, 1) column; kept away from zero at the poles.
+
+    dy : float
+        Pixel height.
+    """
+
+    dy = radius * np.radians(abs(lat_step))
+    cos_lat = np.maximum(np.cos(np.radians(np.asarray(lats, dtype=float))),
+                         1e-6)
+    dx = radius * np.radians(abs(lon_step)) * cos_lat
+
+    return dx.reshape(-1, 1), dy
+
+
+def gradient(elevation, dx, dy):
+    """
+    Elevation gradient along east and north, central differences
+
+    Rows are assumed to go from north to south, as in the GeoTiff.
+
+    Returns
+    -------
+    dz_dx, dz_dy : np.ndarray
+    """
+
+    d_row, d_col = np.gradient(np.asarray(elevation, dtype=np.float64))
+
+    return d_col / dx, -d_row / dy
+
+
+def slope(elevation, dx, dy):
+    """Slope angle in degrees"""
+
+    dz_dx, dz_dy = gradient(elevation, dx, dy)
+
+    return np.degrees(np.arctan(np.hypot(dz_dx, dz_dy)))
+
+
+def aspect(elevation, dx, dy):
+    """Downslope direction in degrees clockwise from north; NaN if flat"""
+
+    dz_dx, dz_dy = gradient(elevation, dx, dy)
+    directions = np.degrees(np.arctan2(-dz_dx, -dz_dy)) % 360
+
+    return np.where((dz_dx == 0) & (dz_dy == 0), np.nan, directions)
+
+
+def hillshade(elevation, dx, dy, azimuth=315, altitude=45, z_factor=1):
+    """
+    Lambertian hillshade, from 0 (in shadow) to 1 (facing the light)
+
+    Parameters
+    ----------
+    elevation : np.ndarray
+        Elevation in meters.
+
+    dx, dy : float or np.ndarray
+        Pixel sizes in meters.
+
+    azimuth : float, default: 315
+        Direction the light comes from, degrees clockwise from north.
+
+    altitude : float, default: 45
+        Light elevation above the horizon, in degrees.
+
+    z_factor : float, default: 1
+        Vertical exaggeration.
+    """
+
+    dz_dx, dz_dy = gradient(elevation, dx, dy)
+    dz_dx, dz_dy = dz_dx * z_factor, dz_dy * z_factor
+
+    azimuth, altitude = np.radians(azimuth), np.radians(altitude)
+    light = (np.sin(azimuth) * np.cos(altitude),
+             np.cos(azimuth) * np.cos(altitude), np.sin(altitude))
+
+    # dot product of the light direction and the unit surface normal,
+    # which is (-dz/dx, -dz/dy, 1) normalized
+    shade = ((light[2] - light[0] * dz_dx - light[1] * dz_dy)
+             / np.sqrt(1 + dz_dx**2 + dz_dy**2))
+
+    return np.clip(shade, 0, 1)
+
+
+def roughness(elevation, size=3):
+    """
+    Largest elevation difference within a size x size neighbourhood
+
+    Same definition as GDAL's `gdaldem roughness`, in the units of the
+    elevation. Pixels on the array edges only see the neighbours they have.
+    """
+
+    from scipy import ndimage
+
+    elevation = np.asarray(elevation, dtype=np.float64)
+
+    return (ndimage.maximum_filter(elevation, size, mode='nearest')
+            - ndimage.minimum_filter(elevation, size, mode='nearest'))
@@ -0,0 +1,219 @@
+"""
+Z/X/Y map tiles of the LOLA DEM, rendered on the fly
+
+The tiles follow a geographic (plate carree) tile matrix, same as the DEM
+itself, so no reprojection is needed: zoom 0 is two 180 x 180 degree tiles
+side by side, and every next zoom level splits each tile into four. Rows
+count from the north, as for the usual web map tiles.
+
+A tile is a single decimated window read: rasterio (GDAL underneath) takes
+it from the coarsest overview that still has enough pixels, so the zoomed
+out tiles are as cheap as the zoomed in ones once the overviews are built,
+see `moon.overviews`.
+"""
+
+import os
+import io
+import math
+import threading
+import numpy as np
+from moon.config import Paths, Constants
+from moon import metrics
+
+TILE_SIZE = 256
+
+# tile layers -> (file extension, mimetype)
+LAYERS = {"raw": ("bin", "application/octet-stream"),
+          "hillshade": ("png", "image/png")}
+
+
+def tile_bounds(z, x, y):
+    """Lon/lat bounds (west, south, east, north) of a tile, in degrees"""
+
+    if z < 0 or not 0 <= x < 2 ** (z + 1) or not 0 <= y < 2 ** z:
+        raise ValueError(f"No such tile: {z}/{x}/{y}")
+
+    span = 180 / 2 ** z
+    west, north = -180 + x * span, 90 - y * span
+
+    return west, north - span, west + span, north
+
+
+def tile_latitudes(z, y, tile_size=TILE_SIZE, halo=0):
+    """Latitudes of the pixel row centres of a tile, halo rows included"""
+
+    _, _, _, north = tile_bounds(z, 0, y)
+    step = 180 / 2 ** z / tile_size
+
+    return north + (halo - 0.5 - np.arange(tile_size + 2 * halo)) * step
+
+
+def encode_raw(data):
+    """Raw tile bytes: little-endian int16, row-major, north up"""
+
+    return np.ascontiguousarray(data, dtype='<i2').tobytes()
+
+
+def encode_png(image):
+    """8-bit grayscale PNG of an array of values between 0 and 1"""
+
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.fromarray(np.round(image * 255).astype(np.uint8)).save(
+        buffer, format="PNG", compress_level=1)
+
+    return buffer.getvalue()
+
+
+class TileSource:
+    """
+    Renders tiles from an equirectangular GeoTiff
+
+    Every thread gets its own open dataset, as they can't be shared, so
+    tiles can be rendered in parallel on a threaded server.
+
+    Parameters
+    ----------
+    source : str
+        Path or URL of the GeoTiff; http(s):// and s3:// URLs are read
+        through the on-disk block cache of `moon.remote`.
+
+    tile_size : int, default: 256
+        Tile side in pixels.
+    """
+
+    def __init__(self, source=os.path.join(Paths.data_dir, Paths.tif_fname),
+                 tile_size=TILE_SIZE):
+        self.source = source
+        self.tile_size = tile_size
+        self._local = threading.local()
+        self._version = None
+
+    def reader(self):
+        """This thread's open dataset"""
+
+        reader = getattr(self._local, "reader", None)
+        if reader is None:
+            if self.source.startswith(("s3://", "http://", "https://")):
+                from moon.remote import open_remote
+                reader = open_remote(self.source)
+            else:
+                import rasterio
+                reader = rasterio.open(self.source)
+            self._local.reader = reader
+
+        return reader
+
+    @property
+    def version(self):
+        """Tag of the source data, changes if the file does"""
+
+        if self._version is None:
+            try:
+                stat = os.stat(self.source)
+                self._version = f"{stat.st_size}-{stat.st_mtime_ns}"
+            except OSError:
+                # remote, the size is all we have
+                self._version = str(self.reader().remote_file.size)
+
+        return self._version
+
+    @property
+    def max_zoom(self):
+        """Zoom level at which the tiles reach the full resolution"""
+
+        pixels_per_tile = self.reader().width / 2  # along a zoom 0 tile
+        return max(0, math.ceil(math.log2(pixels_per_tile / self.tile_size)))
+
+    def _read_bounds(self, west, south, east, north, out_shape):
+        """Resampled DEM values within lon/lat bounds, in degrees"""
+
+        from rasterio.enums import Resampling
+        from rasterio.windows import from_bounds
+
+        to_meters = Constants.lola_dem_moon_radius * np.pi / 180
+        reader = self.reader()
+        window = from_bounds(west * to_meters, south * to_meters,
+                             east * to_meters, north * to_meters,
+                             transform=reader.transform)
+
+        with metrics.span("tile_read"):
+            data = reader.read(1, window=window, out_shape=out_shape,
+                               resampling=Resampling.bilinear)
+        metrics.count("bytes_read", data.nbytes)
+
+        return data
+
+    def read(self, z, x, y, halo=0):
+        """
+        Raw DEM values of a tile, optionally with a halo of extra pixels
+
+        The halo is resampled the same way as the tile itself. It wraps
+        around the +-180 degree meridian, as the map spans all longitudes,
+        and is padded with the edge rows past the poles.
+
+        Returns
+        -------
+        data : np.ndarray
+            Of shape (tile_size + 2 * halo, tile_size + 2 * halo).
+        """
+
+        if z > self.max_zoom:
+            raise ValueError(f"Zoom {z} is past the maximum of"
+                             f" {self.max_zoom}")
+
+        west, south, east, north = tile_bounds(z, x, y)
+        step = (east - west) / self.tile_size
+
+        # halo pixels on each side, as far as the map goes
+        pad_west = min(halo, round((west + 180) / step))
+        pad_east = min(halo, round((180 - east) / step))
+        pad_south = min(halo, round((south + 90) / step))
+        pad_north = min(halo, round((90 - north) / step))
+
+        south, north = south - pad_south * step, north + pad_north * step
+        height = self.tile_size + pad_north + pad_south
+        columns = [self._read_bounds(
+            west - pad_west * step, south, east + pad_east * step, north,
+            (height, self.tile_size + pad_west + pad_east))]
+
+        # whatever runs over the antimeridian comes from the other side
+        wrap_west, wrap_east = halo - pad_west, halo - pad_east
+        if wrap_west:
+            columns.insert(0, self._read_bounds(
+                180 - wrap_west * step, south, 180, north,
+                (height, wrap_west)))
+        if wrap_east:
+            columns.append(self._read_bounds(
+                -180, south, -180 + wrap_east * step, north,
+                (height, wrap_east)))
+
+        return np.pad(np.concatenate(columns, axis=1),
+                      ((halo - pad_north, halo - pad_south), (0, 0)),
+                      mode='edge')
+
+    def render(self, layer, z, x, y):
+        """
+        Encoded tile bytes of a layer, see `LAYERS`
+
+        "raw" tiles are the int16 DEM values (times the scale factor gives
+        meters), "hillshade" ones are grayscale PNGs.
+        """
+
+        if layer == "raw":
+            return encode_raw(self.read(z, x, y))
+
+        if layer == "hillshade":
+            from moon.terrain import hillshade, lonlat_pixel_sizes
+
+            # one pixel of halo, so the gradients match across tile edges
+            data = self.read(z, x, y, halo=1)
+            step = 180 / 2 ** z / self.tile_size
+            lats = tile_latitudes(z, y, self.tile_size, halo=1)
+            dx, dy = lonlat_pixel_sizes(lats, step, step)
+            with metrics.span("tile_shade"):
+                shade = hillshade(Constants.local_radius(data), dx, dy)
+            return encode_png(shade[1:-1, 1:-1])
+
+        raise ValueError(f"Unknown tile layer: {layer}")
@@ -0,0 +1,307 @@
+"""
+In-process reprojection of LOLA windows into orthographic cutouts
+
+Same geometry as `moon.io.read_warped_window`, but instead of handing a file
+path to gdal.Warp on every call (which reopens the dataset and sets up a new
+transformer each time), the engine keeps the source open and caches the
+output-pixel -> source lon/lat grids. An orthographic projection centred at
+lon0/lat0 only depends on lon0 through a shift in longitude, so a grid made
+for one latitude band serves all the cutouts of the same size within it.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from scipy import ndimage
+from moon.config import Paths, Constants
+from moon import metrics
+
+# resampling name -> spline order for `scipy.ndimage.map_coordinates`; no
+# "cubic", which for GDAL is cubic convolution, not a spline
+RESAMPLING_ORDERS = {"nearest": 0, "bilinear": 1, "cubic_spline": 3}
+
+# points per edge when working out the orthographic extent of a lon/lat box
+_EDGE_SAMPLES = 21
+
+
+def ortho_forward(lon, lat, lat0, radius=Constants.lola_dem_moon_radius):
+    """Orthographic x/y (meters) around lon=0/lat0, lon/lat in degrees"""
+
+    lon, lat, lat0 = np.radians(lon), np.radians(lat), np.radians(lat0)
+    x = radius * np.cos(lat) * np.sin(lon)
+    y = radius * (np.cos(lat0) * np.sin(lat)
+                  - np.sin(lat0) * np.cos(lat) * np.cos(lon))
+
+    return x, y
+
+
+def ortho_inverse(x, y, lat0, radius=Constants.lola_dem_moon_radius):
+    """Lon/lat (degrees, lon relative to the centre) of orthographic x/y"""
+
+    lat0 = np.radians(lat0)
+    rho = np.hypot(x, y)
+    c = np.arcsin(np.clip(rho / radius, -1, 1))
+    sin_c, cos_c = np.sin(c), np.cos(c)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        lat = np.arcsin(cos_c * np.sin(lat0)
+                        + np.where(rho > 0, y * sin_c * np.cos(lat0) / rho,
+                                   0))
+    lon = np.arctan2(x * sin_c, rho * cos_c * np.cos(lat0)
+                     - y * sin_c * np.sin(lat0))
+
+    return np.degrees(lon), np.degrees(lat)
+
+
+def ortho_extent(side_lat, side_lon, lat0):
+    """Orthographic bounding box of a lon/lat box centred at 0/lat0"""
+
+    lons = np.linspace(-side_lon / 2, side_lon / 2, _EDGE_SAMPLES)
+    lats = np.linspace(lat0 - side_lat / 2, lat0 + side_lat / 2,
+                       _EDGE_SAMPLES)
+    edge_lons = np.concatenate([lons, lons, np.full_like(lats, lons[0]),
+                                np.full_like(lats, lons[-1])])
+    edge_lats = np.concatenate([np.full_like(lons, lats[0]),
+                                np.full_like(lons, lats[-1]), lats, lats])
+    x, y = ortho_forward(edge_lons, edge_lats, lat0)
+
+    return x.min(), y.min(), x.max(), y.max()
+
+
+class WarpEngine:
+    """
+    Keeps a LOLA GeoTiff open and reprojects windows of it on demand
+
+    Parameters
+    ----------
+    source : str or rasterio.DatasetReader
+        Path or URL of an equirectangular GeoTiff, or an open reader.
+
+    lat_band : float, default: 0.01
+        Grids are cached per this many degrees of centre latitude; the
+        offset within the band is then corrected to the first order, which
+        is good to a small fraction of a pixel for cutouts up to a few
+        degrees across. Set to 0 to only reuse grids at the same latitude.
+
+    max_grids : int, default: 64
+        Number of cached coordinate grids.
+    """
+
+    def __init__(self, source=os.path.join(Paths.data_dir, Paths.tif_fname),
+                 lat_band=0.01, max_grids=64):
+        import rasterio
+
+        if isinstance(source, str):
+            source = rasterio.open(source)
+        self.reader = source
+        self.lat_band = lat_band
+        self.max_grids = max_grids
+        self.overview_factors = tuple(self.reader.overviews(1))
+
+        self._grids = OrderedDict()
+        self._grid_lock = threading.Lock()
+        # rasterio datasets aren't safe to read from several threads at once
+        self._read_lock = threading.Lock()
+
+        transform = self.reader.transform
+        self._x_size, self._x_off = transform.a, transform.c
+        self._y_size, self._y_off = transform.e, transform.f
+        self.native_resolution = abs(self._x_size)
+        self.grid_hits = 0
+        self.grid_misses = 0
+
+    def close(self):
+        """Closes the source dataset"""
+
+        self.reader.close()
+
+    def _grid(self, shape, side_lat, side_lon, lat):
+        """Cached source lon offset / lat grid for the output pixel centres"""
+
+        if self.lat_band:
+            band_lat = round(lat / self.lat_band) * self.lat_band
+        else:
+            band_lat = lat
+        key = shape, round(side_lat, 9), round(side_lon, 9), round(band_lat, 9)
+
+        with self._grid_lock:
+            if key in self._grids:
+                self._grids.move_to_end(key)
+                self.grid_hits += 1
+                return self._grids[key], band_lat
+            self.grid_misses += 1
+
+        x_min, y_min, x_max, y_max = ortho_extent(side_lat, side_lon,
+                                                  band_lat)
+        height, width = shape
+        x_res = (x_max - x_min) / width
+        y_res = (y_max - y_min) / height
+        x = x_min + (np.arange(width) + 0.5) * x_res
+        y = y_max - (np.arange(height) + 0.5) * y_res
+        grid = ortho_inverse(x[np.newaxis, :], y[:, np.newaxis], band_lat)
+        grid = tuple(np.ascontiguousarray(g, dtype=np.float64) for g in grid)
+
+        with self._grid_lock:
+            self._grids[key] = grid
+            while len(self._grids) > self.max_grids:
+                self._grids.popitem(last=False)
+
+        return grid, band_lat
+
+    def output_shape(self, side_lat, side_lon, lat, size=None,
+                     resolution=None):
+        """Output (height, width) for a given size or resolution in meters"""
+
+        x_min, y_min, x_max, y_max = ortho_extent(side_lat, side_lon, lat)
+        if size is not None:
+            try:
+                height, width = size
+            except TypeError:
+                # square pixels, longer side gets `size` pixels
+                longest = max(x_max - x_min, y_max - y_min)
+                resolution = longest / size
+            else:
+                return height, width
+
+        resolution = resolution or self.native_resolution
+        return (max(1, int(round((y_max - y_min) / resolution))),
+                max(1, int(round((x_max - x_min) / resolution))))
+
+    def _read_source(self, row_min, row_max, col_min, col_max, factor):
+        """
+        Reads source pixels, wrapping around in longitude
+
+        Returns the data and the (row, col) of its first pixel in
+        full-resolution pixel units.
+        """
+
+        from rasterio.windows import Window
+
+        row_min = max(row_min, 0)
+        row_max = min(row_max, self.reader.height)
+        # snap to the overview grid, so pixel coordinates stay exact
+        row_min -= row_min % factor
+        col_min -= col_min % factor
+        row_max += -row_max % factor
+        col_max += -col_max % factor
+
+        pieces = []
+        col = col_min
+        while col < col_max:
+            wrapped = col % self.reader.width
+            stop = min(col_max - col, self.reader.width - wrapped) + wrapped
+            window = Window(wrapped, row_min, stop - wrapped,
+                            row_max - row_min)
+            out_shape = (-(-(row_max - row_min) // factor),
+                         -(-(stop - wrapped) // factor))
+            with self._read_lock:
+                pieces.append(self.reader.read(1, window=window,
+                                               out_shape=out_shape))
+            metrics.count("bytes_read", pieces[-1].nbytes)
+            col += stop - wrapped
+
+        return np.concatenate(pieces, axis=1), row_min, col_min
+
+    def warp(self, lon, lat, side, width_correction=True,
+             convert_km_to_deg=False, size=None, resolution=None,
+             resampling="cubic_spline", overview=True, dtype=None):
+        """
+        Reprojects a lon/lat box around lon/lat into an orthographic cutout
+
+        Parameters
+        ----------
+        lon, lat, side, width_correction, convert_km_to_deg
+            Same as for `moon.io.read_warped_window`.
+
+        size : int or (int, int), optional
+            Output side of the longer axis in pixels, or (height, width).
+
+        resolution : float, optional
+            Output pixel size in meters, defaults to the source one.
+
+        resampling : str, default: "cubic_spline"
+            One of "nearest", "bilinear", "cubic_spline".
+
+        overview : bool, default: True
+            Whether to read from the coarsest overview level that still
+            meets the output resolution.
+
+        dtype : np.dtype, optional
+            Output dtype, defaults to the source one (values are rounded for
+            integer types), same as gdal.Warp does.
+
+        Returns
+        -------
+        image : np.ndarray
+        """
+
+        from moon.io import select_overview_level
+
+        try:
+            order = RESAMPLING_ORDERS[resampling]
+        except KeyError:
+            raise ValueError(f"Unknown resampling: {resampling}, pick one of"
+                             f" {', '.join(RESAMPLING_ORDERS)}") from None
+
+        try:
+            side_lat, side_lon = side
+        except TypeError:
+            side_lat, side_lon = side, side
+
+        if convert_km_to_deg:
+            side_lat = Constants.km_to_deg(side_lat)
+            side_lon = Constants.km_to_deg(side_lon)
+
+        if width_correction:
+            side_lon /= np.cos(lat / 180 * np.pi)
+
+        shape = self.output_shape(side_lat, side_lon, lat, size, resolution)
+        (dlon, grid_lat), band_lat = self._grid(shape, side_lat, side_lon,
+                                                lat)
+
+        # first order correction for the offset from the latitude band centre
+        src_lon = (dlon + lon + 180) % 360 - 180
+        src_lat = grid_lat + (lat - band_lat)
+
+        # equirectangular source: x = R * lon, y = R * lat
+        to_meters = Constants.lola_dem_moon_radius * np.pi / 180
+        cols = (src_lon * to_meters - self._x_off) / self._x_size - 0.5
+        rows = (src_lat * to_meters - self._y_off) / self._y_size - 0.5
+
+        factor = 1
+        if overview:
+            x_min, _, x_max, _ = ortho_extent(side_lat, side_lon, lat)
+            level = select_overview_level((x_max - x_min) / shape[1],
+                                          self.overview_factors,
+                                          self.native_resolution)
+            if level is not None:
+                factor = self.overview_factors[level]
+
+        # unwrap the columns around the centre, so that windows crossing
+        # the antimeridian are contiguous
+        center_col = np.median(cols)
+        width = self.reader.width
+        cols = (cols - center_col + width / 2) % width + center_col - width / 2
+
+        margin = (order + 1) * factor
+        data, row_off, col_off = self._read_source(
+            int(np.floor(rows.min())) - margin,
+            int(np.ceil(rows.max())) + margin + 1,
+            int(np.floor(cols.min())) - margin,
+            int(np.ceil(cols.max())) + margin + 1, factor)
+
+        # source pixel coordinates in the (possibly decimated) window
+        coords = np.stack([(rows - row_off + 0.5) / factor - 0.5,
+                           (cols - col_off + 0.5) / factor - 0.5])
+        with metrics.span("engine_resample"):
+            image = ndimage.map_coordinates(data.astype(np.float32), coords,
+                                            order=order, mode='nearest')
+        metrics.count("output_pixels", image.size)
+
+        dtype = np.dtype(dtype or data.dtype)
+        if dtype.kind in 'iu':
+            info = np.iinfo(dtype)
+            image = np.clip(np.round(image), info.min, info.max)
+
+        return image.astype(dtype, copy=False)
@@ -0,0 +1,69 @@
+"""Bounded worker pool that refuses work instead of queueing it forever"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Overloaded(RuntimeError):
+    """Raised when the worker pool queue is full"""
+
+
+class BoundedExecutor:
+    """
+    A thread pool with a cap on the number of queued tasks
+
+    Threads are good enough here: GDAL releases the GIL while warping, so the
+    warps run in parallel while the request threads just wait on them.
+
+    Parameters
+    ----------
+    max_workers : int
+        Number of worker threads, i.e. of warps running at the same time.
+
+    max_queued : int
+        How many tasks may wait for a free worker before `submit` starts
+        raising `Overloaded`.
+    """
+
+    def __init__(self, max_workers, max_queued):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix="warp")
+        self._slots = threading.BoundedSemaphore(max_workers + max_queued)
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    @property
+    def pending(self):
+        """Number of tasks either running or waiting in the queue"""
+
+        return self._pending
+
+    def submit(self, func, *args, **kwargs):
+        """Like `Executor.submit`, but raises `Overloaded` if queue is full"""
+
+        if not self._slots.acquire(blocking=False):
+            raise Overloaded(f"{self._pending} tasks are already pending")
+
+        with self._lock:
+            self._pending += 1
+
+        try:
+            future = self._executor.submit(func, *args, **kwargs)
+        except BaseException:
+            self._release()
+            raise
+
+        future.add_done_callback(lambda _: self._release())
+        return future
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+
+    def shutdown(self, wait=True):
+        """Stops accepting tasks and frees the worker threads"""
+
+        self._executor.shutdown(wait=wait)
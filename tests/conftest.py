@@ -0,0 +1,15 @@
+"""Shared fixtures: a small synthetic LOLA GeoTiff, see `moon.synthetic`"""
+
+import pytest
+
+
+@pytest.fixture(scope="session")
+def synthetic_lola(tmp_path_factory):
+    """Path to a 2048 x 1024 synthetic DEM with the IAU crater bowls"""
+
+    pytest.importorskip("rasterio")
+    from moon.config import Paths
+    from moon.synthetic import make_synthetic_lola
+
+    return make_synthetic_lola(
+        str(tmp_path_factory.mktemp("lola") / Paths.tif_fname), width=2048)
@@ -0,0 +1,82 @@
+"""Checks that the API turns malformed queries down before any work"""
+
+import pytest
+
+
+@pytest.fixture
+def client(monkeypatch):
+    lunar_api = pytest.importorskip("lunar_api")
+
+    def _no_work(*args, **kwargs):
+        raise AssertionError("a malformed query got to the worker pool")
+
+    monkeypatch.setattr(lunar_api.WARP_POOL, "submit", _no_work)
+    return lunar_api.app.test_client()
+
+
+@pytest.mark.parametrize("query", [
+    "name=tycho&pad=nan",
+    "name=tycho&pad=inf",
+    "name=tycho&pad=0",
+    "name=tycho&pad=-1",
+    "name=tycho&pad=wide",
+])
+def test_craters_validation(client, query):
+    assert client.get(f"/craters?{query}").status_code == 400
+
+
+@pytest.mark.parametrize("query", [
+    "lon=nan&lat=0&side=10",
+    "lon=inf&lat=0&side=10",
+    "lon=0&lat=nan&side=10",
+    "lon=0&lat=90&side=10",
+    "lon=0&lat=0&side=nan",
+    "lon=0&lat=0&side=inf",
+    "lon=0&lat=0&side=0",
+    "lon=0&lat=0",
+    "name=tycho&pad=nan",
+    "name=tycho&pad=-inf",
+    "lon=0&lat=0&side=10&size=0",
+    "lon=0&lat=0&side=10&format=jpeg",
+])
+def test_window_validation(client, query):
+    assert client.get(f"/window?{query}").status_code == 400
+
+
+def test_unknown_crater(client):
+    assert client.get("/window?name=no such crater").status_code == 404
+
+
+@pytest.mark.parametrize("body", [
+    {"lon": [0], "lat": [0], "method": "cubic"},
+    {"lon": [0], "lat": [0], "absolute": "false"},
+    {"lon": [0], "lat": [0], "absolute": 1},
+    {"lon": [0, 1], "lat": [[0, 1]]},
+    {"lon": "east", "lat": [0]},
+    [0, 0],
+])
+def test_sample_validation(client, body):
+    assert client.post("/sample", json=body).status_code == 400
+
+
+def test_sample_query_validation(client):
+    assert client.post("/sample?method=spline", json={
+        "lon": [0], "lat": [0]}).status_code == 400
+    assert client.post("/sample", data=b"not a npy file",
+                       content_type="application/x-npy").status_code == 400
+
+
+@pytest.mark.parametrize("query", [
+    "name=tycho&pad=nan",
+    "name=tycho&pad=0",
+    "name=tycho&size=1",
+    "name=tycho&size=100000",
+    "name=tycho&max_error=nan",
+    "name=tycho&max_error=-1",
+    "name=tycho&max_error=inf",
+    "name=tycho&max_error=5,fine",
+    "name=tycho&max_error=" + ",".join(["1"] * 100),
+    "pad=1.3",
+])
+def test_mesh_validation(client, query):
+    assert client.get(f"/mesh?{query}").status_code == 400
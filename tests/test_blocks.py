@@ -0,0 +1,49 @@
+"""Checks of the block-aligned window planning, see `moon.blocks`"""
+
+import numpy as np
+import pytest
+from moon.blocks import plan_windows, reduce_blocks
+
+
+@pytest.mark.parametrize("height, width, block_shape, max_pixels, factor", [
+    (1000, 2000, (256, 256), 256 * 2000, 1),  # full rows of blocks
+    (1000, 2000, (256, 256), 300_000, 1),  # split along the columns too
+    (1000, 2000, (256, 256), 1, 1),  # less than a block, a block anyway
+    (4608, 9216, (128, 128), 2**20, 10),  # blocks and factor out of step
+    (5, 7, (256, 256), 2**20, 3),  # smaller than a block
+])
+def test_windows_tile_the_image(height, width, block_shape, max_pixels,
+                                factor):
+    windows = plan_windows(height, width, block_shape, max_pixels, factor)
+
+    covered = np.zeros((height, width), dtype=int)
+    for row_off, col_off, rows, cols in windows:
+        covered[row_off:row_off + rows, col_off:col_off + cols] += 1
+        for off, length, size, block in ((row_off, rows, height,
+                                          block_shape[0]),
+                                         (col_off, cols, width,
+                                          block_shape[1])):
+            # aligned to both the blocks and the factor, but at the edges
+            assert off % block == 0 and off % factor == 0
+            assert off + length == size or length % np.lcm(block,
+                                                           factor) == 0
+        assert (rows * cols <= max_pixels
+                or rows * cols <= np.prod(np.lcm(block_shape, factor)))
+
+    assert (covered == 1).all()
+
+
+def test_windowed_reduction_matches_the_whole():
+    data = np.random.default_rng(0).standard_normal((300, 500))
+    factor = 6
+    whole = reduce_blocks(data, factor)
+
+    stitched = np.full_like(whole, np.nan)
+    for row_off, col_off, rows, cols in plan_windows(*data.shape, (32, 32),
+                                                     20_000, factor):
+        stitched[row_off // factor:(row_off + rows - 1) // factor + 1,
+                 col_off // factor:(col_off + cols - 1) // factor + 1] = \
+            reduce_blocks(data[row_off:row_off + rows,
+                               col_off:col_off + cols], factor)
+
+    np.testing.assert_allclose(stitched, whole)
@@ -0,0 +1,106 @@
+"""Checks of the on-disk LRU cache, see `moon.cache`"""
+
+import os
+import time
+import threading
+from moon.cache import CutoutCache, cache_key, STALE_PART_SECONDS
+
+
+def _writer(data):
+    def producer(tmp_path):
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+    return producer
+
+
+def test_lru_caps(tmp_path):
+    cache = CutoutCache(str(tmp_path), max_entries=2, suffix='.bin')
+    keys = [cache_key(n=n) for n in range(3)]
+    cache.get_or_create(keys[0], _writer(b'a'))
+    cache.get_or_create(keys[1], _writer(b'b'))
+    cache.get(keys[0])  # now keys[1] is the least recently used one
+    cache.get_or_create(keys[2], _writer(b'c'))
+
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) and cache.get(keys[2])
+    assert not os.path.exists(cache.path(keys[1]))
+
+    cache = CutoutCache(str(tmp_path / "bytes"), max_bytes=10, suffix='.bin')
+    for n in range(4):
+        cache.get_or_create(cache_key(n=n), _writer(b'x' * 4))
+    assert len(cache) == 2 and cache.total_bytes == 8
+
+
+def test_concurrent_misses_are_coalesced(tmp_path):
+    cache = CutoutCache(str(tmp_path), suffix='.bin')
+    calls, release = [], threading.Event()
+
+    def producer(tmp_path):
+        calls.append(tmp_path)
+        release.wait(5)
+        _writer(b'data')(tmp_path)
+
+    paths = []
+    threads = [threading.Thread(target=lambda: paths.append(
+        cache.get_or_create('k' * 64, producer))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert paths == [cache.path('k' * 64)] * 4
+    assert cache.misses == 1 and cache.hits == 3
+
+
+def test_opened_file_survives_eviction(tmp_path):
+    cache = CutoutCache(str(tmp_path), max_entries=1, suffix='.bin')
+    with cache.open_or_create(cache_key(n=0), _writer(b'first')) as f:
+        # evicts the file that is still being read
+        cache.get_or_create(cache_key(n=1), _writer(b'second'))
+        assert not os.path.exists(cache.path(cache_key(n=0)))
+        assert f.read() == b'first'
+
+    # a producer's output is opened before it can be evicted
+    cache = CutoutCache(str(tmp_path / "none"), max_entries=0,
+                        suffix='.bin')
+    with cache.open_or_create(cache_key(n=0), _writer(b'gone')) as f:
+        assert len(cache) == 0 and f.read() == b'gone'
+
+
+def test_hit_on_a_deleted_file_makes_it_anew(tmp_path):
+    cache = CutoutCache(str(tmp_path), suffix='.bin')
+    key = cache_key(n=0)
+    cache.get_or_create(key, _writer(b'old'))
+    os.remove(cache.path(key))
+    with cache.open_or_create(key, _writer(b'new')) as f:
+        assert f.read() == b'new'
+
+
+def test_scan_only_cleans_up_own_files(tmp_path):
+    key, old = cache_key(n=0), time.time() - 2 * STALE_PART_SECONDS
+    names = {
+        "entry": f"{key}.bin",
+        "legacy": f"{key}.tif",
+        "stale_part": f"{key}.bin.1.2.part",
+        "stale_cog": f"{key}.bin.1.2.part.warp.tif",
+        "fresh_part": f"{key}.bin.3.4.part",
+        "fresh_cog": f"{key}.bin.3.4.part.warp.tif",
+        "other_cache_part": f"{key}.tile.1.2.part",
+        "foreign": "notes.txt",
+    }
+    for label, fname in names.items():
+        (tmp_path / fname).write_bytes(b'data')
+        if label.startswith("stale") or label == "other_cache_part":
+            os.utime(tmp_path / fname, (old, old))
+
+    cache = CutoutCache(str(tmp_path), suffix='.bin')
+
+    left = set(os.listdir(tmp_path))
+    assert left == {names[label] for label in ("entry", "fresh_part",
+                                               "fresh_cog",
+                                               "other_cache_part",
+                                               "foreign")}
+    assert len(cache) == 1 and cache.get(key) == cache.path(key)
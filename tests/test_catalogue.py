@@ -0,0 +1,41 @@
+"""Checks of the IAU table column store, see `moon.catalogue`"""
+
+import pytest
+from moon.catalogue import FeatureCatalogue
+from moon.features import read_iau_csv
+
+TABLE = '''Feature_Name,Target,Diameter,Center_Latitude,Center_Longitude,
+"Tycho",Moon,85.29,-43.31,-11.36,
+"Copernicus",Moon,96.07,9.62,-20.08,
+'''
+
+
+@pytest.fixture
+def table(tmp_path):
+    fname = tmp_path / "features.csv"
+    fname.write_text(TABLE)
+    return str(fname)
+
+
+def test_rows_are_plain_python_values(table):
+    parsed = FeatureCatalogue.from_csv(table)
+    cached = FeatureCatalogue.from_csv(table)  # from the .npz this time
+
+    for catalogue in (parsed, cached):
+        row = catalogue.row(catalogue.index("tycho"))
+        assert row == {"feature_name": "Tycho", "target": "Moon",
+                       "diameter": 85.29, "center_latitude": -43.31,
+                       "center_longitude": -11.36}
+        assert all(type(key) is str for key in row)
+        assert all(type(name) is str for name in catalogue.column_names)
+
+
+def test_same_rows_as_the_dictionaries(table):
+    catalogue = FeatureCatalogue.from_csv(table, cache=False)
+
+    for i, (_, feature) in enumerate(read_iau_csv(table)):
+        feature.pop('')
+        assert catalogue.row(i) == {
+            key: float(value) if key in ("diameter", "center_latitude",
+                                         "center_longitude") else value
+            for key, value in feature.items()}
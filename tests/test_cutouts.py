@@ -0,0 +1,37 @@
+"""Checks that the square cutout paths agree, see `moon.io`"""
+
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def lola(synthetic_lola, tmp_path, monkeypatch):
+    """moon.io pointed at the synthetic GeoTiff and its raw copy"""
+
+    import rasterio
+    from moon import io as mio
+    from moon.rawstore import RawDEM, convert_to_raw
+
+    reader = rasterio.open(synthetic_lola)
+    monkeypatch.setitem(mio._LAZY_CONSTANTS, "LOLA_READER", reader)
+    monkeypatch.setitem(mio._LAZY_CONSTANTS, "LONLAT_TO_XY",
+                        mio._make_lonlat_to_xy.__wrapped__())
+    monkeypatch.setitem(mio._LAZY_CONSTANTS, "LOLA_MEMMAP", RawDEM(
+        convert_to_raw(synthetic_lola, str(tmp_path / "lola.raw"))))
+    yield mio
+    reader.close()
+
+
+def test_square_cutouts_match_single_ones(lola):
+    rng = np.random.default_rng(0)
+    lons = rng.uniform(-170, 170, 200)
+    lats = rng.uniform(-70, 70, 200)
+    sides = rng.uniform(0.5, 8, 200)
+
+    batched = lola.square_cutouts(lons, lats, sides, raw=True)
+    for lon, lat, side, cutout in zip(lons, lats, sides, batched):
+        np.testing.assert_array_equal(
+            cutout, lola.square_cutout(lon, lat, side, raw=True))
+        np.testing.assert_array_equal(
+            cutout, lola.square_cutout(lon, lat, side, raw=True,
+                                       backend="memmap"))
@@ -0,0 +1,84 @@
+"""Checks of the error-bounded terrain meshes, see `moon.mesh`"""
+
+import numpy as np
+import pytest
+from moon.mesh import build_meshes, to_glb
+
+
+def _terrain(size=65, seed=0):
+    """Rolling hills with a crater-like bowl and some noise, in meters"""
+
+    rows, cols = np.mgrid[:size, :size] / (size - 1)
+    rng = np.random.default_rng(seed)
+    dist = np.hypot(rows - 0.5, cols - 0.5) / 0.3
+    bowl = np.where(dist < 1, 400 * (dist**2 - 1), 0)
+
+    return (200 * np.sin(5 * rows) * np.cos(3 * cols) + bowl
+            + rng.normal(0, 3, (size, size)))
+
+
+def _mesh_heights(mesh, size):
+    """Mesh surface at the grid points, NaN for points no triangle covers"""
+
+    # unit pixels: the columns and rows are x and z, shifted to the centre
+    cols = mesh.positions[:, 0].astype(np.float64) + (size - 1) / 2
+    rows = mesh.positions[:, 2].astype(np.float64) + (size - 1) / 2
+    heights = np.full((size, size), np.nan)
+
+    for a, b, c in mesh.triangles:
+        row_0, row_1 = np.round(sorted([rows[a], rows[b], rows[c]])[::2])
+        col_0, col_1 = np.round(sorted([cols[a], cols[b], cols[c]])[::2])
+        grid_rows, grid_cols = np.mgrid[int(row_0):int(row_1) + 1,
+                                        int(col_0):int(col_1) + 1]
+
+        # barycentric coordinates of the grid points in the triangle
+        basis = np.array([[cols[b] - cols[a], cols[c] - cols[a]],
+                          [rows[b] - rows[a], rows[c] - rows[a]]])
+        offsets = np.stack([grid_cols.ravel() - cols[a],
+                            grid_rows.ravel() - rows[a]])
+        weight_b, weight_c = np.linalg.solve(basis, offsets)
+        inside = ((weight_b >= -1e-6) & (weight_c >= -1e-6)
+                  & (weight_b + weight_c <= 1 + 1e-6))
+
+        y = mesh.positions[[a, b, c], 1].astype(np.float64)
+        height = y[0] + weight_b * (y[1] - y[0]) + weight_c * (y[2] - y[0])
+        heights[grid_rows.ravel()[inside],
+                grid_cols.ravel()[inside]] = height[inside]
+
+    return heights
+
+
+@pytest.mark.parametrize("max_error", [50, 10, 2])
+def test_vertical_error_is_bounded(max_error):
+    elevation = _terrain()
+    mesh, = build_meshes(elevation, 1, [max_error])
+    heights = _mesh_heights(mesh, elevation.shape[0])
+
+    assert not np.isnan(heights).any()
+    # the float32 positions add a little slack on top
+    assert np.abs(heights - elevation).max() <= max_error + 1e-3
+
+
+def test_finer_meshes_have_more_triangles():
+    meshes = build_meshes(_terrain(), 1, [50, 10, 2, 0])
+    counts = [len(mesh.triangles) for mesh in meshes]
+
+    assert counts == sorted(counts)
+    # no error allowed is the full grid, two triangles a pixel
+    assert counts[-1] == 2 * 64 * 64
+
+
+def test_glb_reads_back():
+    pygltflib = pytest.importorskip("pygltflib")
+
+    meshes = build_meshes(_terrain(), 100, [10, 2])
+    gltf = pygltflib.GLTF2.load_from_bytes(to_glb(meshes, ["coarse",
+                                                           "fine"]))
+
+    assert [scene.name for scene in gltf.scenes] == ["coarse", "fine"]
+    for mesh, gltf_mesh in zip(meshes, gltf.meshes):
+        primitive, = gltf_mesh.primitives
+        assert gltf.accessors[primitive.attributes.POSITION].count == \
+            len(mesh.positions)
+        assert gltf.accessors[primitive.indices].count == \
+            mesh.triangles.size
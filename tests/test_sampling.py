@@ -0,0 +1,52 @@
+"""Checks of the interpolation stencils, see `moon.sampling`"""
+
+import numpy as np
+import pytest
+from moon.sampling import METHODS, stencil
+
+
+def _interpolate(values, coords, method):
+    first, weights = stencil(coords, method)
+    idx = first[:, np.newaxis] + np.arange(weights.shape[1])
+    return (values[idx] * weights).sum(axis=1)
+
+
+@pytest.mark.parametrize("method", METHODS)
+def test_weights_sum_to_one(method):
+    coords = np.random.default_rng(0).uniform(2, 10, 1000)
+    first, weights = stencil(coords, method)
+
+    assert first.dtype == np.int64
+    assert weights.shape[0] == coords.size
+    np.testing.assert_allclose(weights.sum(axis=1), 1)
+
+
+@pytest.mark.parametrize("method", METHODS)
+def test_exact_on_pixel_centres(method):
+    values = np.random.default_rng(1).standard_normal(16)
+    coords = np.arange(2, 13, dtype=float)
+
+    np.testing.assert_allclose(_interpolate(values, coords, method),
+                               values[2:13], atol=1e-12)
+
+
+@pytest.mark.parametrize("method", ["bilinear", "bicubic"])
+def test_linear_ramps_are_reproduced(method):
+    values = 3 * np.arange(16) - 5.
+    coords = np.random.default_rng(2).uniform(1, 13, 100)
+
+    np.testing.assert_allclose(_interpolate(values, coords, method),
+                               3 * coords - 5)
+
+
+def test_first_pixels():
+    coords = [0.49, 0.5, 1.51, -0.51]
+
+    assert stencil(coords, "nearest")[0].tolist() == [0, 1, 2, -1]
+    assert stencil(coords, "bilinear")[0].tolist() == [0, 0, 1, -1]
+    assert stencil(coords, "bicubic")[0].tolist() == [-1, -1, 0, -2]
+
+
+def test_unknown_method():
+    with pytest.raises(ValueError, match="Unknown interpolation method"):
+        stencil([0.5], "cubic")
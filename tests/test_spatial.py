@@ -0,0 +1,63 @@
+"""Checks of the spherical feature index, see `moon.spatial`"""
+
+import numpy as np
+import pytest
+from moon.spatial import FeatureIndex, great_circle_km, ortho_xy_km
+from moon.warp import ortho_inverse
+
+
+@pytest.fixture
+def index():
+    """A handful of features around the equator, diameters 1 to 5 km"""
+
+    return FeatureIndex([0, 1, 2, 90, -170], [0, 0, 1, 10, -45],
+                        [1, 2, 3, 4, 5])
+
+
+def test_nearest_matches_brute_force(index):
+    dist, idx = index.nearest(0.4, 0.1, k=3)
+    brute = great_circle_km(0.4, 0.1, index.lon, index.lat)
+
+    np.testing.assert_array_equal(idx, np.argsort(brute)[:3])
+    np.testing.assert_allclose(dist, np.sort(brute)[:3], rtol=1e-9)
+
+
+def test_nearest_with_min_diameter_maps_back(index):
+    _, idx = index.nearest(0, 0, k=2, min_diameter=3)
+
+    np.testing.assert_array_equal(idx, [2, 3])
+
+
+def test_nearest_pads_missing_neighbours(index):
+    dist, idx = index.nearest(0, 0, k=4, min_diameter=3)
+
+    np.testing.assert_array_equal(idx, [2, 3, 4, -1])
+    assert np.isinf(dist[-1]) and np.isfinite(dist[:-1]).all()
+
+
+@pytest.mark.parametrize("k, shape", [(1, (2,)), (3, (2, 3))])
+def test_nearest_with_nothing_left(index, k, shape):
+    dist, idx = index.nearest([0, 1], [0, 1], k=k, min_diameter=1e9)
+
+    assert dist.shape == idx.shape == shape
+    assert np.isinf(dist).all() and (idx == -1).all()
+
+
+def test_within_radius_sorted(index):
+    idx = index.within_radius(0, 0, 200)
+
+    np.testing.assert_array_equal(idx, [0, 1, 2])
+
+
+def test_within_square_keeps_far_corners():
+    # a feature just inside the corner of a 1000 km square, which is ~728
+    # km away along the surface, further than the half diagonal of 707 km
+    lon, lat = ortho_inverse(499e3, 499e3, 0)
+    index = FeatureIndex([lon, 0], [lat, 0])
+
+    np.testing.assert_array_equal(np.sort(index.within_square(0, 0, 1000)),
+                                  [0, 1])
+
+    x, y = ortho_xy_km(index.lon, index.lat, 0, 0)
+    assert max(abs(x[0]), abs(y[0])) < 500
+    assert great_circle_km(0, 0, lon, lat) > 500 * np.sqrt(2)
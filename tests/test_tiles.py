@@ -0,0 +1,41 @@
+"""Checks of the z/x/y DEM tiles, see `moon.tiles`"""
+
+import numpy as np
+import pytest
+from moon.tiles import TileSource, tile_bounds, tile_latitudes
+
+
+def test_tile_latitudes_halo():
+    west, south, east, north = tile_bounds(3, 0, 2)
+    step = (east - west) / 256
+    lats = tile_latitudes(3, 2, halo=1)
+
+    # the halo row is half a pixel north of the tile, the first one inside
+    np.testing.assert_allclose(lats[[0, 1, -2, -1]],
+                               [north + step / 2, north - step / 2,
+                                south + step / 2, south - step / 2])
+
+
+@pytest.fixture
+def tiles(synthetic_lola):
+    return TileSource(synthetic_lola, tile_size=64)
+
+
+@pytest.mark.parametrize("z, y", [(1, 0), (2, 1)])
+def test_halo_wraps_around_the_antimeridian(tiles, z, y):
+    last = 2 ** (z + 1) - 1
+    west_tile = tiles.read(z, 0, y, halo=1)
+    east_tile = tiles.read(z, last, y, halo=1)
+
+    np.testing.assert_array_equal(west_tile[1:-1, 0],
+                                  tiles.read(z, last, y)[:, -1])
+    np.testing.assert_array_equal(east_tile[1:-1, -1],
+                                  tiles.read(z, 0, y)[:, 0])
+
+
+def test_halo_matches_neighbour_tiles(tiles):
+    tile = tiles.read(2, 3, 1, halo=1)
+
+    np.testing.assert_array_equal(tile[1:-1, 1:-1], tiles.read(2, 3, 1))
+    np.testing.assert_array_equal(tile[1:-1, 0], tiles.read(2, 2, 1)[:, -1])
+    np.testing.assert_array_equal(tile[0, 1:-1], tiles.read(2, 3, 0)[-1])